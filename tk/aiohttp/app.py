@@ -0,0 +1,539 @@
+import asyncio
+import json
+import os
+import time
+from functools import wraps
+from xml.etree.ElementTree import ParseError
+
+from aiohttp import BasicAuth, web
+from flask import Config
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags, \
+    parse_range_header, quote_etag
+
+from tk.aiohttp.process import AsyncProcess
+from tk.auth import build_auth
+from tk.bulk import CONTENT_TYPES as BULK_CONTENT_TYPES, MULTIPART, \
+    multipart_boundary, parse_process_ids, render_multipart, render_ndjson
+from tk.callback import build_callback_dispatcher, callback_url_allowed
+from tk.encoding import available_encodings, build_response_compressor
+from tk.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, \
+    REQUEST_DURATION, REQUESTS, UPLOAD_SIZE, exposition, process_gauges
+from tk.process import Process
+from tk.projection import InvalidFields, build_profile_projector, \
+    parse_fields
+from tk.scheduler import QueueFull, build_scheduler, queue_position_headers
+from tk.store import CHUNK_SIZE as RESULT_CHUNK_SIZE, SpilledResult, \
+    build_result_store, result_size
+from tk.timing import ServerTiming, phase
+from tk.upload import CHUNK_SIZE, DocumentSpool, DocumentTooLarge
+from tk.upstream import build_retry_policy, build_upstream_targets
+from tk.users import UserStore
+
+
+def _mimetype(request):
+    """
+    Gets the request body's media type, without parameters.
+    :param request:
+    :return: The media type, or an empty string if there is none.
+    """
+    return request.headers.get('Content-Type', '').split(';')[0].strip().lower()
+
+
+def request_content_type(*content_types):
+    """
+    Check we can accept the request body.
+    :param content_types: The acceptable content types.
+    :return:
+    """
+
+    def decorator(handler):
+        @wraps(handler)
+        async def checker(request):
+            if _mimetype(request) not in content_types:
+                raise web.HTTPUnsupportedMediaType()
+            return await handler(request)
+
+        return checker
+
+    return decorator
+
+
+def response_content_type(*content_types):
+    """
+    Check we can deliver the right content type.
+
+    The negotiated content type is available as
+    request['tk_response_content_type'].
+    :param content_types: The content types we can deliver, in order of
+      preference.
+    :return:
+    """
+
+    def decorator(handler):
+        @wraps(handler)
+        async def checker(request):
+            accept = parse_accept_header(request.headers.get('Accept'),
+                                         MIMEAccept)
+            negotiated_content_type = accept.best_match(content_types)
+            if negotiated_content_type is None:
+                raise web.HTTPNotAcceptable()
+            request['tk_response_content_type'] = negotiated_content_type
+            return await handler(request)
+
+        return checker
+
+    return decorator
+
+
+def _byte_range(request, etag, length):
+    """
+    Gets the part of a response body a request is for.
+    :param request:
+    :param etag: The response's entity tag, unquoted.
+    :param length: The length of the entire body in bytes.
+    :return: A 2-tuple (start: int, stop: int), or None for the entire body.
+    :raises web.HTTPRequestRangeNotSatisfiable: If the range is malformed or
+      out of bounds.
+    """
+    if 'Range' not in request.headers:
+        return None
+    if_range = request.headers.get('If-Range')
+    if if_range is not None and quote_etag(etag) != if_range:
+        return None
+    byte_range = parse_range_header(request.headers['Range'])
+    byte_range = None if byte_range is None else byte_range.range_for_length(length)
+    if byte_range is None:
+        raise web.HTTPRequestRangeNotSatisfiable(headers={
+            'Content-Range': 'bytes */%d' % length,
+        })
+    return byte_range
+
+
+class App:
+    """
+    Serves the same API as tk.flask.app.App, from an asyncio event loop.
+
+    Every request is a coroutine rather than a thread, so a single server
+    process can hold many slow uploads, long polls, and Sourcebox requests at
+    once.
+    """
+
+    def __init__(self, config=None):
+        """
+        :param config: A dictionary of configuration to override the
+          configuration file with.
+        """
+        self.config = Config(os.path.dirname(os.path.dirname(__file__)))
+        self.config.from_object('tk.default_config')
+        self.config.from_envvar('TK_CONFIG_FILE')
+        self.config.update(config or {})
+        self.auth = build_auth(self.config)
+        self.users = UserStore(self.config['USER_PASSWORD_HASH_ITERATIONS'],
+                               self.config['USER_CREDENTIALS_CACHE_SIZE'],
+                               self.config['USER_CREDENTIALS_CACHE_TTL'])
+        for name, password in self.config['USERS']:
+            self.users.add(name, password)
+        self._callback_dispatcher = build_callback_dispatcher(self.config)
+        self.process = AsyncProcess(self.config['SOURCEBOX_URL'],
+                                    self.config['SOURCEBOX_ACCOUNT_NAME'],
+                                    self.config['SOURCEBOX_USER_NAME'],
+                                    self.config['SOURCEBOX_PASSWORD'],
+                                    build_result_store(self.config),
+                                    self.config['PROFILE_CACHE_SIZE'],
+                                    self.config['PROFILE_CACHE_TTL'],
+                                    build_scheduler(self.config),
+                                    retry_policy=build_retry_policy(self.config),
+                                    callback_dispatcher=self._callback_dispatcher,
+                                    max_connections=self.config['ASYNC_SOURCEBOX_MAX_CONNECTIONS'],
+                                    keep_alive=self.config['SOURCEBOX_KEEP_ALIVE'],
+                                    connect_timeout=self.config['SOURCEBOX_CONNECT_TIMEOUT'],
+                                    read_timeout=self.config['SOURCEBOX_READ_TIMEOUT'],
+                                    result_spool_size=self.config['RESULT_SPOOL_SIZE'],
+                                    result_spool_directory=self.config['RESULT_SPOOL_DIRECTORY'],
+                                    upstream_targets=build_upstream_targets(self.config))
+        self._compressor = build_response_compressor(self.config)
+        self._projector = build_profile_projector(self.config)
+        self._gauges = process_gauges(self.process)
+        self.web = web.Application(middlewares=[self._observe_request])
+        self.web.on_startup.append(self._start)
+        self.web.on_cleanup.append(self._close)
+        self._register_routes()
+
+    @web.middleware
+    async def _observe_request(self, request, handler):
+        start_time = time.perf_counter()
+        route = request.match_info.route.name or 'unknown'
+        if self.config['SERVER_TIMING_ENABLED']:
+            request['tk_server_timing'] = ServerTiming()
+        response = None
+        try:
+            response = await handler(request)
+        except web.HTTPException as e:
+            response = e
+            raise
+        finally:
+            REQUEST_DURATION.observe(time.perf_counter() - start_time, route)
+            REQUESTS.inc(route, str(getattr(response, 'status', 500)))
+            # Streamed responses have sent their headers already.
+            if 'tk_server_timing' in request and response is not None and not response.prepared:
+                response.headers['Server-Timing'] = request['tk_server_timing'].header()
+        return response
+
+    async def _start(self, _):
+        await self.process.start()
+
+    async def _close(self, _):
+        await self.process.close()
+        self._callback_dispatcher.close()
+        self._projector.close()
+
+    def add_user(self, name, password):
+        self.users.add(name, password)
+
+    def _phase(self, request, name):
+        """
+        Times a phase of handling a request, for the Server-Timing header.
+        :param request:
+        :param name: The phase's name.
+        :return: A context manager.
+        """
+        return phase(request.get('tk_server_timing'), name)
+
+    async def _stream_file(self, request, file, size, byte_range, etag, headers):
+        """
+        Streams (part of) a profile from a file.
+        :param request:
+        :param file: The binary file to read the profile from.
+        :param size: The file size in bytes.
+        :param byte_range: A 2-tuple (start: int, stop: int), or None to
+          stream the entire file.
+        :param etag: The profile's entity tag, unquoted.
+        :param headers: The response headers.
+        :return: The prepared web.StreamResponse.
+        """
+        headers['ETag'] = quote_etag(etag)
+        headers['Accept-Ranges'] = 'bytes'
+        status_code = 200
+        start, stop = 0, size
+        if byte_range is not None:
+            start, stop = byte_range
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+            status_code = 206
+        response = web.StreamResponse(status=status_code, headers=headers)
+        response.content_type = 'text/xml'
+        response.charset = 'utf-8'
+        response.content_length = stop - start
+        await response.prepare(request)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, file.seek, start)
+        remaining = stop - start
+        while remaining:
+            chunk = await loop.run_in_executor(
+                None, file.read, min(RESULT_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            await response.write(chunk)
+            remaining -= len(chunk)
+        await response.write_eof()
+        return response
+
+    def request_basic_auth(self, handler):
+        """
+        Check the request contains valid HTTP Basic Auth credentials.
+        :return:
+        """
+        @wraps(handler)
+        async def checker(request):
+            try:
+                credentials = BasicAuth.decode(
+                    request.headers.get('Authorization', ''))
+            except ValueError:
+                credentials = None
+            with self._phase(request, 'auth'):
+                # Hashing passwords takes long enough to stall other requests.
+                verified = credentials is not None and await asyncio.get_event_loop().run_in_executor(
+                    None, self.users.verify, credentials.login,
+                    credentials.password)
+            if not verified:
+                raise web.HTTPUnauthorized(headers={
+                    'WWW-Authenticate': 'Basic realm="Authentication Required"',
+                })
+            request['tk_auth_user_name'] = credentials.login
+            return await handler(request)
+
+        return checker
+
+    def request_access_token(self, handler):
+        """
+        Check the request contains a valid access token.
+        :return:
+        """
+        @wraps(handler)
+        async def checker(request):
+            if 'access_token' not in request.query:
+                raise web.HTTPUnauthorized()
+            with self._phase(request, 'auth'):
+                user_name = self.auth.verify_access_token(
+                    request.query['access_token'])
+            if user_name is None:
+                raise web.HTTPForbidden()
+            request['tk_auth_user_name'] = user_name
+            return await handler(request)
+
+        return checker
+
+    def _register_routes(self):
+        @self.request_basic_auth
+        @request_content_type('')
+        @response_content_type('text/plain')
+        async def access_token(request):
+            with self._phase(request, 'token'):
+                access_token = self.auth.grant_access_token(
+                    request['tk_auth_user_name'])
+            return web.Response(text=access_token, content_type='text/plain')
+
+        @self.request_access_token
+        @request_content_type('application/octet-stream')
+        @response_content_type('text/plain')
+        async def submit(request):
+            callback_url = request.query.get('callback_url')
+            if callback_url is not None and not callback_url_allowed(callback_url, self.config['CALLBACK_URLS'].get(
+                    request['tk_auth_user_name'], ())):
+                raise web.HTTPBadRequest(text='This callback URL is not allowed.')
+            max_size = self.config['MAX_DOCUMENT_SIZE']
+            if request.content_length is not None and request.content_length > max_size:
+                raise web.HTTPRequestEntityTooLarge(max_size,
+                                                    request.content_length)
+            # aiohttp decompresses request bodies itself, but passes unknown
+            # encodings through.
+            encoding = request.headers.get('Content-Encoding', 'identity').strip().lower()
+            if encoding not in ('identity', 'gzip', 'x-gzip', 'deflate') + tuple(available_encodings()):
+                raise web.HTTPUnsupportedMediaType()
+            spool = DocumentSpool(max_size, self.config['DOCUMENT_SPOOL_SIZE'])
+            loop = asyncio.get_event_loop()
+            try:
+                with self._phase(request, 'body'):
+                    while True:
+                        chunk = await request.content.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        # Large documents are spooled to disk.
+                        await loop.run_in_executor(None, spool.write, chunk)
+            except DocumentTooLarge:
+                raise web.HTTPRequestEntityTooLarge(max_size, max_size + 1)
+            document = spool.finish()
+            if not document.size:
+                document.close()
+                raise web.HTTPBadRequest()
+            UPLOAD_SIZE.observe(document.size)
+            try:
+                with self._phase(request, 'schedule'):
+                    process_id = await self.process.run_blocking(
+                        self.process.submit, request['tk_auth_user_name'],
+                        document, callback_url)
+            except QueueFull as e:
+                raise web.HTTPServiceUnavailable(headers={
+                    'Retry-After': str(e.retry_after),
+                })
+            return web.Response(text=process_id, content_type='text/plain')
+
+        @self.request_access_token
+        @request_content_type('')
+        @response_content_type('text/xml', 'application/json')
+        async def retrieve(request):
+            process_id = request.match_info['process_id']
+            try:
+                wait = float(request.query.get('wait', 0))
+            except ValueError:
+                raise web.HTTPBadRequest()
+            if not 0 <= wait:
+                raise web.HTTPBadRequest()
+            wait = min(wait, self.config['RETRIEVE_MAX_WAIT'])
+            try:
+                fields = parse_fields(request.query.get('fields'))
+            except InvalidFields as e:
+                raise web.HTTPBadRequest(text=str(e))
+
+            content_type = request['tk_response_content_type']
+            # Requests for part of a profile leave the process in place, so
+            # the other parts can be requested later.
+            conditional = 'text/xml' == content_type and (
+                'Range' in request.headers or 'If-None-Match' in request.headers)
+            # Only the owner may delete a process, so peek before retrieving.
+            process = await self.process.run_blocking(
+                self.process.peek, process_id)
+            if process is None:
+                raise web.HTTPNotFound()
+
+            if request['tk_auth_user_name'] != process[0]:
+                raise web.HTTPForbidden()
+
+            if Process.PROGRESS == process[1] and wait:
+                with self._phase(request, 'wait'):
+                    await self.process.wait_async(process_id, wait)
+                process = await self.process.run_blocking(
+                    self.process.peek, process_id)
+                if process is None:
+                    raise web.HTTPNotFound()
+
+            result = process[1]
+            finished = result not in (Process.PROGRESS, Process.ERROR_INTERNAL, Process.ERROR_UPSTREAM)
+            # Whether we own the result, because the process was deleted.
+            retrieved = False
+            byte_range = None
+            if Process.PROGRESS != result:
+                if not conditional or not finished:
+                    last = True
+                elif parse_etags(request.headers.get('If-None-Match')).contains(process_id):
+                    # The client has the profile already, so keep it.
+                    return web.Response(status=304, headers={
+                        'Vary': 'Accept, Accept-Encoding',
+                        'ETag': quote_etag(process_id),
+                    })
+                else:
+                    length = result_size(result)
+                    byte_range = _byte_range(request, process_id, length)
+                    last = byte_range is None or length == byte_range[1]
+                if last:
+                    # Another request may have retrieved the process since.
+                    process = await self.process.run_blocking(
+                        self.process.retrieve, process_id)
+                    if process is None:
+                        raise web.HTTPNotFound()
+                    result = process[1]
+                    retrieved = True
+
+            headers = {
+                'Vary': 'Accept, Accept-Encoding',
+            }
+            if Process.PROGRESS == result:
+                headers.update(queue_position_headers(
+                    self.process.queue_position(process_id)))
+                if 'application/json' == content_type:
+                    result = json.dumps({'status': 'progress'})
+            elif 'application/json' == content_type and finished:
+                try:
+                    with self._phase(request, 'project'):
+                        result = await self._projector.project_async(
+                            result, fields)
+                except ParseError:
+                    result = Process.ERROR_UPSTREAM
+                    finished = False
+                except FileNotFoundError:
+                    raise web.HTTPNotFound()
+                finally:
+                    # The process was deleted, so its conversions must go too.
+                    self._projector.forget(process[1])
+                    if isinstance(process[1], SpilledResult):
+                        process[1].delete()
+            if Process.ERROR_INTERNAL == result:
+                status_code = 500
+                content_type = 'text/plain'
+            elif Process.ERROR_UPSTREAM == result:
+                status_code = 502
+                content_type = 'text/plain'
+            else:
+                status_code = 200
+
+            if isinstance(result, SpilledResult):
+                # Stream large profiles from disk, uncompressed.
+                try:
+                    file = result.open()
+                except FileNotFoundError:
+                    raise web.HTTPNotFound()
+                if retrieved:
+                    # The open file remains readable.
+                    result.delete()
+                try:
+                    return await self._stream_file(
+                        request, file, result.size, byte_range, process_id,
+                        headers)
+                finally:
+                    file.close()
+
+            body = result.encode('utf-8')
+            if finished and 'text/xml' == content_type:
+                # A process' profile never changes.
+                headers['ETag'] = quote_etag(process_id)
+                headers['Accept-Ranges'] = 'bytes'
+            if byte_range is not None:
+                start, stop = byte_range
+                headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                    start, stop - 1, len(body))
+                body = body[start:stop]
+                status_code = 206
+            elif not conditional:
+                with self._phase(request, 'compress'):
+                    body, encoding = self._compressor.compress(
+                        body,
+                        parse_accept_header(request.headers.get('Accept-Encoding')))
+                if encoding is not None:
+                    headers['Content-Encoding'] = encoding
+                    # Ranges apply to uncompressed profiles.
+                    headers.pop('ETag', None)
+                    headers.pop('Accept-Ranges', None)
+            return web.Response(body=body, status=status_code,
+                                content_type=content_type, charset='utf-8',
+                                headers=headers)
+
+        @self.request_access_token
+        @request_content_type('application/json')
+        @response_content_type(*BULK_CONTENT_TYPES)
+        async def retrieve_batch(request):
+            content_type = request['tk_response_content_type']
+            max_count = self.config['MAX_BATCH_RETRIEVE_PROCESSES']
+            # Allow for generously long process IDs.
+            max_size = max_count * 128 + 2
+            if request.content_length is not None and request.content_length > max_size:
+                raise web.HTTPRequestEntityTooLarge(max_size,
+                                                    request.content_length)
+            body = b''
+            while True:
+                chunk = await request.content.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                body += chunk
+                if len(body) > max_size:
+                    raise web.HTTPRequestEntityTooLarge(max_size, len(body))
+            try:
+                process_ids = parse_process_ids(body, max_count)
+            except ValueError as e:
+                raise web.HTTPBadRequest(text=str(e))
+            profiles = request.query.get('profiles') in ('1', 'true')
+            results = self.process.retrieve_many(
+                request['tk_auth_user_name'], process_ids, profiles)
+            if MULTIPART == content_type:
+                boundary = multipart_boundary()
+                chunks = render_multipart(results, profiles, boundary)
+                content_type = '%s; boundary=%s' % (MULTIPART, boundary)
+            else:
+                chunks = render_ndjson(results, profiles)
+            response = web.StreamResponse(headers={
+                'Content-Type': content_type,
+            })
+            await response.prepare(request)
+            # Rendering reads from the result store and from spilled results.
+            loop = asyncio.get_event_loop()
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+
+        async def metrics(request):
+            return web.Response(text=exposition(self._gauges), headers={
+                'Content-Type': METRICS_CONTENT_TYPE,
+            })
+
+        self.web.router.add_get('/accesstoken', access_token,
+                                name='access_token')
+        self.web.router.add_post('/submit', submit, name='submit')
+        self.web.router.add_post('/retrieve/batch', retrieve_batch,
+                                 name='retrieve_batch')
+        self.web.router.add_get('/retrieve/{process_id}', retrieve,
+                                name='retrieve')
+        if self.config['METRICS_ENABLED']:
+            self.web.router.add_get('/metrics', metrics, name='metrics')
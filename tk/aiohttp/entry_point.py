@@ -0,0 +1,8 @@
+from aiohttp import web
+
+from tk.aiohttp.app import App
+
+app = App()
+
+if __name__ == '__main__':
+    web.run_app(app.web)
@@ -0,0 +1,170 @@
+import asyncio
+from functools import partial
+
+import aiohttp
+
+from tk.process import Process
+from tk.store import MemoryResultStore
+from tk.upload import CHUNK_SIZE
+
+
+class _AsyncBody:
+    """
+    Exposes a MultipartEncoder as an asynchronous iterable of chunks.
+    """
+
+    def __init__(self, body):
+        self._body = body
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = self._body.read(CHUNK_SIZE)
+        if not chunk:
+            raise StopAsyncIteration()
+        return chunk
+
+
+class AsyncProcess(Process):
+    """
+    Processes documents on an asyncio event loop.
+
+    All methods must be called from the event loop, after start() has been
+    awaited, or through run_blocking().
+    """
+
+    def __init__(self, sourcebox_url, sourcebox_account_name, sourcebox_user_name, sourcebox_password,
+                 store=None, profile_cache_size=1024, profile_cache_ttl=3600, scheduler=None,
+                 circuit_breaker=None, retry_policy=None, callback_dispatcher=None, max_connections=1000, keep_alive=True, connect_timeout=5, read_timeout=120,
+                 result_spool_size=1024 * 1024, result_spool_directory=None, upstream_targets=None):
+        """
+        :param max_connections: The maximum number of concurrent connections
+          to Sourcebox.
+        :param keep_alive: Whether to reuse connections across requests.
+        :param connect_timeout: The number of seconds to wait for a connection
+          to be established.
+        :param read_timeout: The number of seconds to wait for a response.
+        """
+        super().__init__(None, sourcebox_url, sourcebox_account_name,
+                         sourcebox_user_name, sourcebox_password, store,
+                         profile_cache_size, profile_cache_ttl, scheduler,
+                         circuit_breaker, retry_policy, callback_dispatcher,
+                         result_spool_size, result_spool_directory,
+                         upstream_targets)
+        self._max_connections = max_connections
+        self._keep_alive = keep_alive
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        # Values are sets of asyncio.Future instances, resolved once processes
+        # finish.
+        self._waiters = {}
+
+    async def start(self):
+        """
+        Opens the Sourcebox connection pool.
+        :return:
+        """
+        self._loop = asyncio.get_event_loop()
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self._max_connections,
+                                           force_close=not self._keep_alive),
+            timeout=aiohttp.ClientTimeout(sock_connect=self._connect_timeout,
+                                          sock_read=self._read_timeout))
+
+    async def close(self):
+        """
+        Closes the Sourcebox connection pool.
+        :return:
+        """
+        await self._session.close()
+
+    async def run_blocking(self, function, *args):
+        """
+        Calls a function that may access the result store, without blocking
+        the event loop on stores that do I/O.
+        :param function: The callable to call.
+        :param args: The positional arguments to call the function with.
+        :return: The function's return value.
+        """
+        if isinstance(self._store, MemoryResultStore):
+            return function(*args)
+        return await self._loop.run_in_executor(None, partial(function, *args))
+
+    def _send(self, target, document_key, document, attempt):
+        # Upstream responses may be handled outside the event loop.
+        self._loop.call_soon_threadsafe(lambda: asyncio.ensure_future(
+            self._post(target, document_key, document, attempt)))
+
+    def _call_later(self, delay, callback):
+        self._loop.call_soon_threadsafe(self._loop.call_later, delay, callback)
+
+    async def _post(self, target, document_key, document, attempt):
+        body = self._build_upstream_body(target, document)
+        spool = None
+        try:
+            async with self._session.post(target.url, data=_AsyncBody(body), headers={
+                'Content-Type': body.content_type,
+                # Send the body with a known length rather than chunked.
+                'Content-Length': str(len(body)),
+            }, params=self.UPSTREAM_PARAMS) as response:
+                status_code = response.status
+                spool = self._spool_result(response.charset or 'utf-8')
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    if spool.size + len(chunk) > self._result_spool_size:
+                        # Write spilled results to disk outside the event loop.
+                        await self._loop.run_in_executor(None, spool.write, chunk)
+                    else:
+                        spool.write(chunk)
+                if spool.size > self._result_spool_size:
+                    result = await self._loop.run_in_executor(None, spool.finish)
+                else:
+                    result = spool.finish()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if spool is not None:
+                spool.discard()
+            status_code = result = None
+        await self.run_blocking(self._handle_upstream_response, target,
+                                document_key, document, attempt, status_code,
+                                result)
+
+    def _deliver(self, process_id, result):
+        super()._deliver(process_id, result)
+        # Processes may be delivered outside the event loop.
+        self._loop.call_soon_threadsafe(self._wake, process_id)
+
+    def _wake(self, process_id):
+        """
+        Wakes up anyone waiting for a process to finish.
+        :param process_id:
+        :return:
+        """
+        for waiter in self._waiters.pop(process_id, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def wait_async(self, process_id, timeout):
+        """
+        Waits until a process has finished, without blocking the event loop.
+        :param process_id:
+        :param timeout: The maximum number of seconds to wait for.
+        :return:
+        """
+        if not isinstance(self._store, MemoryResultStore):
+            # Shared stores may finish processes in other server processes,
+            # which only the store itself can tell us about.
+            await asyncio.get_event_loop().run_in_executor(
+                None, self._store.wait, process_id, timeout)
+            return
+
+        waiter = asyncio.get_event_loop().create_future()
+        waiters = self._waiters.setdefault(process_id, set())
+        waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            waiters.discard(waiter)
+            if not waiters and self._waiters.get(process_id) is waiters:
+                del self._waiters[process_id]
@@ -1,21 +1,215 @@
+import base64
+import binascii
 import datetime
+import hashlib
+import hmac
+import struct
+import time
+from threading import Lock
 
-import jwcrypto.jwk as jwk
-import python_jwt as jwt
+from tk.cache import LruCache
+from tk.metrics import JWT_DURATION
+
+# Marks access tokens that are absent from the verification cache, because a
+# cached None means the token was rejected.
+_UNCACHED = object()
+
+
+class TokenCodec:
+    """
+    Encodes and decodes signed access tokens.
+    """
+
+    def encode(self, user_name, expires):
+        """
+        Encodes an access token.
+        :param user_name: The name of the user the token is for.
+        :param expires: The timestamp after which the token expires, as an
+          int.
+        :return: The access token as a str.
+        """
+        raise NotImplementedError()
+
+    def decode(self, access_token):
+        """
+        Decodes and verifies an access token.
+        :param access_token:
+        :return: A 2-tuple (user_name: str, expires: int), or None if the
+          token is invalid or expired.
+        """
+        raise NotImplementedError()
+
+
+class JwtCodec(TokenCodec):
+    """
+    Encodes access tokens as JWTs signed with HS512.
+    """
+
+    _ALGORITHM = 'HS512'
+
+    def __init__(self, secret_keys):
+        """
+        :param secret_keys: A list of secret keys. Tokens are signed with the
+          first, and tokens signed with any of them are valid.
+        """
+        assert secret_keys and None not in secret_keys
+        self._secret_keys = secret_keys
+        # The keys are built when they are first needed, so importing and
+        # building the app stays cheap.
+        self._jwt_keys = None
+        self._jwt_keys_lock = Lock()
+
+    def _keys(self):
+        """
+        Gets the JWT keys, and the JWT library.
+        :return: A 2-tuple (jwt_keys: List[jwcrypto.jwk.JWK], jwt: module).
+        """
+        # The JWT libraries load the entire cryptography package, so import
+        # them only once a token is granted or verified.
+        import python_jwt as jwt
+        if self._jwt_keys is None:
+            import jwcrypto.jwk as jwk
+            with self._jwt_keys_lock:
+                if self._jwt_keys is None:
+                    jwt_keys = [jwk.JWK(kty='oct', k=base64.urlsafe_b64encode(
+                        secret_key.encode('utf-8')).rstrip(b'=').decode('ascii'))
+                        for secret_key in self._secret_keys]
+                    # A little assurance that we will always enforce a secure
+                    # signature. If the key is None, the JWT signature
+                    # algorithm will be None, leading to unsigned and
+                    # therefore unauthenticated tokens. For more details, see
+                    # https://www.chosenplaintext.ca/2015/03/31/jwt-algorithm-confusion.html.
+                    assert None not in jwt_keys
+                    self._jwt_keys = jwt_keys
+        return self._jwt_keys, jwt
+
+    def encode(self, user_name, expires):
+        jwt_keys, jwt = self._keys()
+        claims = {
+            'user': user_name,
+        }
+        return jwt.generate_jwt(claims, jwt_keys[0], self._ALGORITHM,
+                                datetime.timedelta(seconds=expires - time.time()))
+
+    def decode(self, access_token):
+        jwt_keys, jwt = self._keys()
+        for jwt_key in jwt_keys:
+            try:
+                jwt_header, jwt_claims = jwt.verify_jwt(
+                    access_token, jwt_key, [self._ALGORITHM])
+            # This is an overly broad exception clause, because:
+            # 1) the JWT library does not raise exceptions of a single type.
+            # 2) calling code will convert this to an appropriate HTTP response.
+            except Exception:
+                continue
+            return jwt_claims['user'], jwt_claims['exp']
+        return None
+
+
+class CompactCodec(TokenCodec):
+    """
+    Encodes access tokens in a compact binary layout, signed with HMAC-SHA256.
+
+    Tokens are URL-safe base64 encodings of a version byte, a 4-byte key ID,
+    a 4-byte expiration timestamp, the UTF-8 encoded user name, and a 16-byte
+    truncated HMAC of everything before it. Verifying a token takes a single
+    HMAC and a constant-time comparison, and no JSON.
+    """
+
+    _VERSION = 1
+    _HEADER = struct.Struct('>B4sI')
+    _MAC_SIZE = 16
+
+    def __init__(self, secret_keys):
+        """
+        :param secret_keys: A list of secret keys. Tokens are signed with the
+          first, and tokens signed with any of them are valid.
+        """
+        assert secret_keys and None not in secret_keys
+        # Keys are key IDs, values are HMAC keys.
+        self._keys = {}
+        for secret_key in secret_keys:
+            key = secret_key.encode('utf-8')
+            self._keys.setdefault(self._key_id(key), key)
+        self._signing_key = secret_keys[0].encode('utf-8')
+        self._signing_key_id = self._key_id(self._signing_key)
+
+    @staticmethod
+    def _key_id(key):
+        # The key ID only selects the key, so it reveals nothing useful.
+        return hashlib.sha256(b'tk-key-id:' + key).digest()[:4]
+
+    def _sign(self, key, payload):
+        return hmac.new(key, payload, hashlib.sha256).digest()[:self._MAC_SIZE]
+
+    def encode(self, user_name, expires):
+        payload = self._HEADER.pack(self._VERSION, self._signing_key_id,
+                                    expires) + user_name.encode('utf-8')
+        token = payload + self._sign(self._signing_key, payload)
+        return base64.urlsafe_b64encode(token).rstrip(b'=').decode('ascii')
+
+    def decode(self, access_token):
+        try:
+            token = base64.b64decode(
+                access_token + '=' * (-len(access_token) % 4), b'-_', True)
+        except (binascii.Error, ValueError):
+            return None
+        if len(token) < self._HEADER.size + self._MAC_SIZE:
+            return None
+        version, key_id, expires = self._HEADER.unpack_from(token)
+        key = self._keys.get(key_id)
+        if self._VERSION != version or key is None:
+            return None
+        payload = token[:-self._MAC_SIZE]
+        if not hmac.compare_digest(self._sign(key, payload),
+                                   token[-self._MAC_SIZE:]):
+            return None
+        if expires <= time.time():
+            return None
+        try:
+            return payload[self._HEADER.size:].decode('utf-8'), expires
+        except UnicodeDecodeError:
+            return None
+
+
+# Keys are codec names for configuration, values are TokenCodec classes.
+CODECS = {
+    'jwt': JwtCodec,
+    'compact': CompactCodec,
+}
 
 
 class Auth:
-    def __init__(self, secret_key, ttl):
+    def __init__(self, secret_key, ttl, cache_size=4096, rejection_ttl=10, codec=None, rejection_cache_size=1024):
+        """
+        :param secret_key: The secret key to sign access tokens with.
+        :param ttl: The access token lifetime in seconds.
+        :param cache_size: The maximum number of verified access tokens to
+          remember.
+        :param rejection_ttl: The number of seconds to remember rejected
+          access tokens for.
+        :param codec: The TokenCodec to encode access tokens with. Defaults to
+          a JwtCodec for the secret key.
+        :param rejection_cache_size: The maximum number of rejected access
+          tokens to remember.
+        """
         assert secret_key is not None
-        jwt_key = jwk.JWK.generate(kty='oct', k=secret_key)
-        # A little assurance that we will always enforce a secure signature. If
-        # the key is None, the JWT signature algorithm will be None, leading to
-        # unsigned and therefore unauthenticated tokens. For more details, see
-        # https://www.chosenplaintext.ca/2015/03/31/jwt-algorithm-confusion.html.
-        assert jwt_key is not None
-        self._jwt_key = jwt_key
-        self._algorithm = 'HS512'
+        self._codec = JwtCodec([secret_key]) if codec is None else codec
         self._ttl = ttl
+        # Values are user names.
+        self._verified_access_tokens = LruCache(cache_size)
+        # Rejected access tokens are cached separately, so a flood of invalid
+        # tokens cannot evict valid ones.
+        self._rejected_access_tokens = LruCache(rejection_cache_size)
+        self._rejection_ttl = rejection_ttl
+
+    @property
+    def cache_hits(self):
+        return self._verified_access_tokens.hits + self._rejected_access_tokens.hits
+
+    @property
+    def cache_misses(self):
+        return self._verified_access_tokens.misses
 
     def grant_access_token(self, user_name):
         """
@@ -23,25 +217,47 @@ class Auth:
         :param user_name: The name of the user to grant the access token to.
         :return: str
         """
-        claims = {
-            'user': user_name,
-        }
-        return jwt.generate_jwt(claims, self._jwt_key, self._algorithm,
-                                datetime.timedelta(seconds=self._ttl))
+        with JWT_DURATION.time('grant'):
+            return self._codec.encode(user_name, int(time.time()) + self._ttl)
 
     def verify_access_token(self, access_token):
         """
         Verifies an access token.
+
+        Verification results are cached until the access token expires, so
+        repeated verifications of the same token skip the cryptography.
         :param access_token:
         :return: The name of the authenticated user.
         """
-        try:
-            jwt_header, jwt_claims = jwt.verify_jwt(access_token, self._jwt_key,
-                                                    [self._algorithm])
-        # This is an overly broad exception clause, because:
-        # 1) the JWT library does not raise exceptions of a single type.
-        # 2) calling code will convert this to an appropriate HTTP response.
-        except Exception as e:
+        user_name = self._verified_access_tokens.get(access_token, _UNCACHED)
+        if user_name is not _UNCACHED:
+            return user_name
+        if self._rejected_access_tokens.get(access_token, _UNCACHED) is not _UNCACHED:
             return None
 
-        return jwt_claims['user']
+        with JWT_DURATION.time('verify'):
+            decoded = self._codec.decode(access_token)
+        if decoded is None:
+            self._rejected_access_tokens.set(
+                access_token, None, time.time() + self._rejection_ttl)
+            return None
+
+        user_name, expires = decoded
+        self._verified_access_tokens.set(access_token, user_name, expires)
+        return user_name
+
+
+def build_auth(config):
+    """
+    Builds the configured access token authentication.
+    :param config: The application configuration.
+    :return: Auth
+    """
+    secret_keys = [config['SECRET_KEY']] + list(
+        config['ACCESS_TOKEN_PREVIOUS_SECRET_KEYS'])
+    return Auth(config['SECRET_KEY'],
+                config['ACCESS_TOKEN_TTL'],
+                config['ACCESS_TOKEN_CACHE_SIZE'],
+                config['ACCESS_TOKEN_REJECTION_TTL'],
+                CODECS[config['ACCESS_TOKEN_CODEC']](secret_keys),
+                config['ACCESS_TOKEN_REJECTION_CACHE_SIZE'])
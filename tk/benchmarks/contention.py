@@ -0,0 +1,98 @@
+"""
+Measures lock contention in the memory process store with many threads.
+
+Run with `python -m tk.benchmarks.contention`.
+"""
+
+import argparse
+import time
+from threading import Barrier, Lock, Thread
+
+from tk.store import MemoryResultStore
+
+PROFILE = '<?xml version="1.0" encoding="UTF-8" ?><Profile>%s</Profile>' % (
+    'I am an excellent CV, mind you. ' * 32)
+
+
+class CountingLock:
+    """
+    A lock that counts how often threads had to wait to acquire it.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.acquisitions = 0
+        self.contentions = 0
+        self.wait_time = 0
+
+    def __enter__(self):
+        if not self._lock.acquire(False):
+            start = time.perf_counter()
+            self._lock.acquire()
+            self.wait_time += time.perf_counter() - start
+            self.contentions += 1
+        self.acquisitions += 1
+
+    def __exit__(self, *args):
+        self._lock.release()
+
+
+def run(shards, threads, iterations):
+    """
+    Runs concurrent additions, completions, and retrievals against the store
+    directly, so Process' own locking does not hide the store's.
+    :param shards: The number of process store shards.
+    :param threads: The number of threads.
+    :param iterations: The number of processes every thread stores.
+    :return: A 3-tuple (operations per second: float, share of lock
+      acquisitions that had to wait: float, total seconds spent waiting:
+      float).
+    """
+    store = MemoryResultStore(shards=shards)
+    locks = []
+    for shard in store._shards:
+        shard._lock = CountingLock()
+        locks.append(shard._lock)
+    barrier = Barrier(threads + 1)
+
+    def _work(thread_index):
+        barrier.wait()
+        for iteration in range(iterations):
+            process_id = '%d-%d' % (thread_index, iteration)
+            store.add(process_id, 'User %d' % thread_index)
+            store.complete(process_id, PROFILE)
+            store.retrieve(process_id)
+
+    workers = [Thread(target=_work, args=(index,)) for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    duration = time.perf_counter() - start
+    acquisitions = sum(lock.acquisitions for lock in locks)
+    return (threads * iterations * 3 / duration,
+            sum(lock.contentions for lock in locks) / acquisitions,
+            sum(lock.wait_time for lock in locks))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=32,
+                        help='The number of concurrent threads.')
+    parser.add_argument('--iterations', type=int, default=2000,
+                        help='The number of processes every thread stores.')
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 4, 16],
+                        help='The numbers of shards to compare.')
+    args = parser.parse_args()
+
+    for shards in args.shards:
+        operations, contention, wait_time = run(shards, args.threads,
+                                                args.iterations)
+        print('%d shard(s): %d operations per second, %.2f%% of lock acquisitions waited, %.3f seconds spent waiting' % (
+            shards, operations, contention * 100, wait_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+"""
+Load tests a tk server against a local fake Sourcebox.
+
+Run with `python -m tk.benchmarks.load`. The server runs in a subprocess, so
+its peak memory usage can be measured separately from the load generators.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread, local
+
+import requests
+
+_USER_NAME = 'benchmark'
+_PASSWORD = 'benchmark'
+
+
+class FakeSourcebox:
+    """
+    Serves Sourcebox-like responses from a background thread.
+    """
+
+    def __init__(self, latency=0.05, error_rate=0.0, response_size=8192):
+        """
+        :param latency: The number of seconds to wait before responding.
+        :param error_rate: The fraction of requests to respond to with a 503.
+        :param response_size: The size of profiles in bytes.
+        """
+        profile = ('<?xml version="1.0" encoding="UTF-8" ?><Profile>%s</Profile>' % (
+            'x' * max(0, response_size - 64))).encode('utf-8')
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                time.sleep(latency)
+                if random.random() < error_rate:
+                    status_code, body = 503, b''
+                else:
+                    status_code, body = 200, profile
+                self.send_response(status_code)
+                self.send_header('Content-Type', 'text/xml')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class _Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                # tk may disconnect at any time when it is stopped.
+                if not isinstance(sys.exc_info()[1], ConnectionError):
+                    super().handle_error(request, client_address)
+
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self.url = 'http://127.0.0.1:%d/' % self._server.server_address[1]
+
+    def start(self):
+        thread = Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Server:
+    """
+    Runs tk in a subprocess.
+    """
+
+    def __init__(self, sourcebox_url, server='flask'):
+        """
+        :param sourcebox_url: The URL of the (fake) Sourcebox.
+        :param server: 'flask' or 'async'.
+        """
+        self._config = tempfile.NamedTemporaryFile('w', suffix='.py',
+                                                   delete=False)
+        self._config.write('SECRET_KEY = %r\nSOURCEBOX_URL = %r\nUSERS = [(%r, %r)]\n' % (
+            'benchmark', sourcebox_url, _USER_NAME, _PASSWORD))
+        self._config.close()
+        self._server = server
+        self._port = _free_port()
+        self.url = 'http://127.0.0.1:%d' % self._port
+        self._process = None
+
+    def start(self):
+        self._process = subprocess.Popen(
+            [sys.executable, '-m', 'tk.benchmarks.load', '--serve',
+             self._server, '--port', str(self._port)],
+            env=dict(os.environ, TK_CONFIG_FILE=self._config.name),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self._port), 1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError('The server did not start.')
+
+    def peak_rss(self):
+        """
+        Gets the server's peak resident set size.
+        :return: The size in bytes, or None if it cannot be measured.
+        """
+        try:
+            with open('/proc/%d/status' % self._process.pid) as status:
+                for line in status:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def stop(self):
+        self._process.terminate()
+        self._process.wait()
+        os.unlink(self._config.name)
+
+
+def serve(server, port):
+    """
+    Serves tk until the process is terminated.
+    :param server: 'flask' or 'async'.
+    :param port: The port to listen on.
+    :return:
+    """
+    if 'async' == server:
+        from aiohttp import web
+        from tk.aiohttp.app import App
+        web.run_app(App().web, host='127.0.0.1', port=port, print=None)
+    else:
+        from werkzeug.serving import run_simple
+        from tk.flask.app import App
+        run_simple('127.0.0.1', port, App(), threaded=True)
+
+
+def percentile(values, percent):
+    """
+    Gets a percentile using the nearest-rank method.
+    :param values: A sorted list of values.
+    :param percent: The percentile, from 0 to 100.
+    :return: The value, or None if there are no values.
+    """
+    if not values:
+        return None
+    return values[max(0, int(len(values) * percent / 100.0 + 0.5) - 1)]
+
+
+class LoadGenerator:
+    """
+    Runs a scenario concurrently, and records its latencies.
+    """
+
+    def __init__(self, url, concurrency):
+        """
+        :param url: The tk server URL.
+        :param concurrency: The number of concurrent clients.
+        """
+        self._url = url
+        self._concurrency = concurrency
+        self._counter = 0
+        self._counter_lock = Lock()
+
+    def _unique(self):
+        with self._counter_lock:
+            self._counter += 1
+            return self._counter
+
+    def run(self, scenario, requests_count):
+        """
+        Runs a scenario.
+        :param scenario: A callable taking a requests.Session, which runs a
+          single iteration, and returns whether it succeeded.
+        :param requests_count: The number of iterations.
+        :return: A dictionary of results.
+        """
+        latencies = []
+        errors = 0
+        lock = Lock()
+        # Give every client its own connection pool.
+        sessions = local()
+
+        def _iterate(_):
+            nonlocal errors
+            if not hasattr(sessions, 'session'):
+                sessions.session = requests.Session()
+            start = time.perf_counter()
+            try:
+                success = scenario(sessions.session)
+            except requests.RequestException:
+                success = False
+            latency = time.perf_counter() - start
+            with lock:
+                latencies.append(latency)
+                if not success:
+                    errors += 1
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self._concurrency) as executor:
+            list(executor.map(_iterate, range(requests_count)))
+        duration = time.perf_counter() - start
+        latencies.sort()
+        return {
+            'requests': requests_count,
+            'errors': errors,
+            'duration': duration,
+            'throughput': requests_count / duration,
+            'latency': {
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'max': latencies[-1] if latencies else None,
+            },
+        }
+
+    def access_token(self, session):
+        response = session.get(self._url + '/accesstoken', headers={
+            'Accept': 'text/plain',
+        }, auth=(_USER_NAME, _PASSWORD))
+        return 200 == response.status_code
+
+    def grant_access_token(self, session):
+        return session.get(self._url + '/accesstoken', headers={
+            'Accept': 'text/plain',
+        }, auth=(_USER_NAME, _PASSWORD)).text
+
+    def submit_retrieve(self, session, access_token):
+        """
+        Submits a unique document, and waits for its profile.
+        """
+        response = session.post(self._url + '/submit', headers={
+            'Accept': 'text/plain',
+            'Content-Type': 'application/octet-stream',
+        }, params={
+            'access_token': access_token,
+        }, data=('I am an excellent CV, number %d.' % self._unique()).encode('utf-8'))
+        if 200 != response.status_code:
+            return False
+        process_id = response.text
+        while True:
+            response = session.get(self._url + '/retrieve/' + process_id, headers={
+                'Accept': 'text/xml',
+            }, params={
+                'access_token': access_token,
+                'wait': 30,
+            })
+            if 200 != response.status_code:
+                return False
+            if 'PROGRESS' != response.text:
+                return True
+
+    def upload(self, session, access_token, size):
+        """
+        Submits a large unique document.
+        """
+        document = ('%d ' % self._unique()).encode('utf-8')
+        document += b'x' * (size - len(document))
+        response = session.post(self._url + '/submit', headers={
+            'Accept': 'text/plain',
+            'Content-Type': 'application/octet-stream',
+        }, params={
+            'access_token': access_token,
+        }, data=document)
+        return 200 == response.status_code
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--server', choices=('flask', 'async'), default='flask',
+                        help='The server to load test.')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='The number of concurrent clients.')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='The number of requests per scenario.')
+    parser.add_argument('--upload-size', type=int, default=4 * 1024 * 1024,
+                        help='The size of documents in the upload scenario, in bytes.')
+    parser.add_argument('--sourcebox-latency', type=float, default=0.05,
+                        help='The fake Sourcebox latency in seconds.')
+    parser.add_argument('--sourcebox-error-rate', type=float, default=0.0,
+                        help='The fraction of fake Sourcebox requests that fail.')
+    parser.add_argument('--sourcebox-response-size', type=int, default=8192,
+                        help='The fake Sourcebox profile size in bytes.')
+    parser.add_argument('--output',
+                        help='The file to write the results to as JSON.')
+    parser.add_argument('--serve', choices=('flask', 'async'),
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port)
+        return
+
+    sourcebox = FakeSourcebox(args.sourcebox_latency,
+                              args.sourcebox_error_rate,
+                              args.sourcebox_response_size)
+    sourcebox.start()
+    server = Server(sourcebox.url, args.server)
+    server.start()
+    try:
+        generator = LoadGenerator(server.url, args.concurrency)
+        access_token = generator.grant_access_token(requests.Session())
+        scenarios = (
+            ('access_token', generator.access_token, args.requests),
+            ('submit_retrieve', lambda session: generator.submit_retrieve(
+                session, access_token), args.requests),
+            ('upload', lambda session: generator.upload(
+                session, access_token, args.upload_size), max(1, args.requests // 10)),
+        )
+        results = {}
+        for name, scenario, requests_count in scenarios:
+            results[name] = generator.run(scenario, requests_count)
+            latency = results[name]['latency']
+            print('%s: %.1f requests/s, p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, %d errors' % (
+                name, results[name]['throughput'], latency['p50'] * 1000,
+                latency['p95'] * 1000, latency['p99'] * 1000,
+                results[name]['errors']))
+        peak_rss = server.peak_rss()
+    finally:
+        server.stop()
+        sourcebox.stop()
+    if peak_rss is not None:
+        print('Peak RSS: %.1f MiB' % (peak_rss / 1024 / 1024))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'time': datetime.datetime.utcnow().isoformat() + 'Z',
+                'parameters': {name: value for name, value in vars(args).items()
+                               if name not in ('output', 'serve', 'port')},
+                'scenarios': results,
+                'peak_rss': peak_rss,
+            }, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Measures the memory used per finished, unretrieved profile.
+
+Run with `python -m tk.benchmarks.store`.
+"""
+
+import argparse
+import gc
+import random
+import tracemalloc
+import uuid
+
+from tk.store import MemoryResultStore
+
+_NAMES = ('Jürgen Müller', 'Zoë Çelik', 'Søren Ødegård', 'Łukasz Żółć',
+          'Ἀριστοτέλης', 'Дмитрий Иванов', '山田太郎')
+
+
+def build_profile(index):
+    """
+    Builds a profile resembling Sourcebox output for a non-ASCII CV.
+    :param index: Makes the profile unique.
+    :return: str
+    """
+    rng = random.Random(index)
+    experience = ''.join(
+        '<Experience><Employer>%s B.V.</Employer><Description>%s</Description></Experience>' % (
+            rng.choice(_NAMES), ' '.join(rng.choice(_NAMES) for _ in range(30)))
+        for _ in range(10))
+    return '<?xml version="1.0" encoding="UTF-8" ?><Profile><Name>%s %d</Name>%s</Profile>' % (
+        rng.choice(_NAMES), index, experience)
+
+
+class TupleResultStore:
+    """
+    Stores processes the way MemoryResultStore did before results were
+    compressed: as 2-tuples of a user name and a decoded result.
+    """
+
+    def __init__(self):
+        self._processes = {}
+
+    def add(self, process_id, user_name):
+        self._processes[process_id] = (user_name, None)
+
+    def complete(self, process_id, result):
+        self._processes[process_id] = (self._processes[process_id][0], result)
+
+
+def measure(store, profiles):
+    """
+    Measures the memory a store uses to keep profiles.
+    :param store: The store to fill.
+    :param profiles: The profiles to store, as UTF-8 encoded upstream response
+      bodies.
+    :return: The number of bytes allocated per profile.
+    """
+    process_ids = [str(uuid.uuid4()) for _ in profiles]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for process_id, profile in zip(process_ids, profiles):
+        store.add(process_id, 'User Foo')
+        # Decode every profile like requests' Response.text does.
+        store.complete(process_id, profile.decode('utf-8'))
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(profiles)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=2000,
+                        help='The number of profiles to store.')
+    args = parser.parse_args()
+
+    profiles = [build_profile(index).encode('utf-8') for index in range(args.count)]
+    utf8_size = sum(len(profile) for profile in profiles) / len(profiles)
+    print('Average profile size (UTF-8): %d bytes' % utf8_size)
+    for name, store in (('tuple (before)', TupleResultStore()),
+                        ('MemoryResultStore', MemoryResultStore(max_entries=2 * args.count, max_bytes=2 ** 40))):
+        print('%s: %d bytes per profile' % (name, measure(store, profiles)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import json
+import uuid
+
+from tk.process import Process
+
+NDJSON = 'application/x-ndjson'
+MULTIPART = 'multipart/mixed'
+# The media types bulk retrievals can be streamed as, in order of preference.
+CONTENT_TYPES = (NDJSON, MULTIPART)
+
+PROGRESS = 'progress'
+DONE = 'done'
+ERROR = 'error'
+UNKNOWN = 'unknown'
+
+_ERRORS = {
+    Process.ERROR_INTERNAL: 'internal',
+    Process.ERROR_UPSTREAM: 'upstream',
+}
+
+
+def parse_process_ids(body, max_count):
+    """
+    Parses a bulk retrieval request body.
+    :param body: The body as bytes, containing a JSON array of process IDs.
+    :param max_count: The maximum number of process IDs.
+    :return: A list of unique process IDs, in their original order.
+    :raises ValueError: If the body is malformed or contains too many IDs.
+    """
+    process_ids = json.loads(body.decode('utf-8'))
+    if not isinstance(process_ids, list) or not all(isinstance(process_id, str) for process_id in process_ids):
+        raise ValueError('The body must be a JSON array of process IDs.')
+    process_ids = list(dict.fromkeys(process_ids))
+    if len(process_ids) > max_count:
+        raise ValueError('The body contains more than %d process IDs.' % max_count)
+    return process_ids
+
+
+def _item(process_id, result, profiles):
+    """
+    Builds a bulk retrieval item.
+    :return: A 3-tuple (process_id: str, status: str, profile: Optional[str]).
+    """
+    if result is None:
+        return process_id, UNKNOWN, None
+    if Process.PROGRESS == result:
+        return process_id, PROGRESS, None
+    if result in _ERRORS:
+        return process_id, ERROR, None
+    return process_id, DONE, result if profiles else None
+
+
+def render_ndjson(results, profiles):
+    """
+    Renders bulk retrieval results as newline-delimited JSON.
+    :param results: An iterable of 2-tuples, as Process.retrieve_many() yields.
+    :param profiles: Whether to include finished processes' profiles.
+    :return: An iterable of bytes, with one JSON object per process.
+    """
+    for process_id, result in results:
+        process_id, status, profile = _item(process_id, result, profiles)
+        item = {
+            'process_id': process_id,
+            'status': status,
+        }
+        if ERROR == status:
+            item['error'] = _ERRORS[result]
+        if profile is not None:
+            item['profile'] = profile
+        yield (json.dumps(item) + '\n').encode('utf-8')
+
+
+def multipart_boundary():
+    return uuid.uuid4().hex
+
+
+def render_multipart(results, profiles, boundary):
+    """
+    Renders bulk retrieval results as a multipart/mixed body.
+
+    Every process is a part with X-Tk-Process-Id and X-Tk-Status headers, and
+    finished processes' parts contain their profiles.
+    :param results: An iterable of 2-tuples, as Process.retrieve_many() yields.
+    :param profiles: Whether to include finished processes' profiles.
+    :param boundary: The multipart boundary, from multipart_boundary().
+    :return: An iterable of bytes.
+    """
+    delimiter = ('--%s\r\n' % boundary).encode('ascii')
+    for process_id, result in results:
+        process_id, status, profile = _item(process_id, result, profiles)
+        headers = 'X-Tk-Process-Id: %s\r\nX-Tk-Status: %s\r\n' % (
+            json.dumps(process_id)[1:-1], status)
+        if ERROR == status:
+            headers += 'X-Tk-Error: %s\r\n' % _ERRORS[result]
+        if profile is not None:
+            headers += 'Content-Type: text/xml; charset=utf-8\r\n'
+        yield delimiter + headers.encode('ascii') + b'\r\n' + (
+            b'' if profile is None else profile.encode('utf-8')) + b'\r\n'
+    yield ('--%s--\r\n' % boundary).encode('ascii')
@@ -0,0 +1,79 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LruCache:
+    """
+    A thread-safe, size-bounded, least-recently-used cache.
+
+    Entries may carry an expiration timestamp, after which they are treated as
+    absent and evicted upon access.
+    """
+
+    def __init__(self, max_size, clock=time.time):
+        """
+        :param max_size: The maximum number of entries to keep.
+        :param clock: A callable returning the current time in seconds, to
+          compare expiration timestamps against.
+        """
+        assert max_size > 0
+        self._max_size = max_size
+        self._clock = clock
+        # Values are 2-tuples (expires: Optional[float], value: Any).
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """
+        Gets a cached value, and marks it as recently used.
+        :param key:
+        :param default: The value to return if the key is not cached.
+        :return: The cached value, or the default.
+        """
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= self._clock():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires=None):
+        """
+        Caches a value, evicting the least recently used entries if needed.
+        :param key:
+        :param value:
+        :param expires: The timestamp after which the entry expires, or None
+          to keep it until it is evicted.
+        :return:
+        """
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Removes a value from the cache, if it exists.
+        :param key:
+        :return:
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
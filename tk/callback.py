@@ -0,0 +1,243 @@
+import hashlib
+import hmac
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Timer
+from urllib.parse import urlsplit
+
+from tk.store import CHUNK_SIZE, SpilledResult
+from tk.upstream import RetryPolicy
+
+
+def callback_url_allowed(url, allowed_urls):
+    """
+    Checks a callback URL against an allowlist.
+    :param url: The callback URL.
+    :param allowed_urls: An iterable of allowed URLs. Callback URLs must have
+      the same scheme and host, and their path must be the allowed URL's path
+      or lie below it.
+    :return: bool
+    """
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return False
+    if parts.scheme not in ('http', 'https') or not parts.netloc:
+        return False
+    for allowed_url in allowed_urls:
+        allowed_parts = urlsplit(allowed_url)
+        if (parts.scheme, parts.netloc.lower()) == (allowed_parts.scheme, allowed_parts.netloc.lower()) and _path_allowed(parts.path, allowed_parts.path):
+            return True
+    return False
+
+
+def _path_allowed(path, allowed_path):
+    """
+    Checks a URL path is an allowed path, or lies below it.
+
+    Paths are compared by segment, so "/hooks" allows "/hooks/foo", but not
+    "/hooksfoo".
+    :param path:
+    :param allowed_path:
+    :return: bool
+    """
+    allowed_path = allowed_path.rstrip('/')
+    return path in (allowed_path, allowed_path + '/') or path.startswith(allowed_path + '/')
+
+
+def sign_callback(secret_key, timestamp, body):
+    """
+    Signs a callback payload.
+
+    Receivers can verify callbacks by computing the same signature from the
+    X-Tk-Timestamp header and the request body, and comparing it to the
+    X-Tk-Signature header.
+    :param secret_key: The secret key as a str.
+    :param timestamp: The X-Tk-Timestamp header value as a str.
+    :param body: The request body as bytes, or a binary file to read it from.
+    :return: The X-Tk-Signature header value.
+    """
+    signature = hmac.new(secret_key.encode('utf-8'),
+                         timestamp.encode('ascii') + b'.', hashlib.sha256)
+    if isinstance(body, bytes):
+        signature.update(body)
+    else:
+        for chunk in iter(lambda: body.read(CHUNK_SIZE), b''):
+            signature.update(chunk)
+    return 'sha256=' + signature.hexdigest()
+
+
+class CallbackDispatcher:
+    """
+    POSTs finished processes' results to callback URLs.
+
+    Deliveries run on a fixed number of threads with a shared connection pool,
+    and are retried with backoff after connection errors, 429, and 5xx
+    responses. The threads and connection pool are created on the first
+    delivery.
+    """
+
+    def __init__(self, secret_key, max_concurrency=8, timeout=10, retry_policy=None):
+        """
+        :param secret_key: The secret key to sign payloads with.
+        :param max_concurrency: The maximum number of concurrent deliveries.
+        :param timeout: The number of seconds to wait for a callback URL to
+          respond.
+        :param retry_policy: The RetryPolicy for failed deliveries.
+        """
+        self._secret_key = secret_key
+        self._timeout = timeout
+        self._retry_policy = RetryPolicy(5, 1, 60, 1, 100) if retry_policy is None else retry_policy
+        self._max_concurrency = max_concurrency
+        self._session = None
+        self._executor = None
+        # Keys are futures of queued and running deliveries, values are their
+        # results.
+        self._pending = {}
+        self._closed = False
+        self._delivered = 0
+        self._failed = 0
+        self._lock = Lock()
+
+    def _submit(self, *args):
+        """
+        Runs a delivery attempt on the delivery threads.
+        :param args: The arguments to _post().
+        :return:
+        """
+        with self._lock:
+            if self._closed:
+                self._discard(args[2])
+                return
+            if self._executor is None:
+                # requests is imported here, to keep importing the app fast.
+                import requests
+                from requests.adapters import HTTPAdapter
+                self._session = requests.Session()
+                adapter = HTTPAdapter(pool_maxsize=self._max_concurrency)
+                self._session.mount('http://', adapter)
+                self._session.mount('https://', adapter)
+                self._executor = ThreadPoolExecutor(self._max_concurrency)
+            future = self._executor.submit(self._post, *args)
+            self._pending[future] = args[2]
+        # The callback runs immediately if the delivery finished already.
+        future.add_done_callback(self._forget)
+
+    def _forget(self, future):
+        with self._lock:
+            self._pending.pop(future, None)
+
+    def deliver(self, url, process_id, result, content_type, on_success):
+        """
+        Delivers a result in the background.
+        :param url: The callback URL.
+        :param process_id:
+        :param result: The process result as a str, or a SpilledResult, which
+          the dispatcher takes ownership of.
+        :param content_type: The result's media type.
+        :param on_success: A callable without arguments, called once the result
+          has been delivered.
+        :return:
+        """
+        self._retry_policy.record_request()
+        self._submit(url, process_id, result, content_type, on_success, 0)
+
+    @staticmethod
+    def _discard(result):
+        if isinstance(result, SpilledResult):
+            result.delete()
+
+    def _post(self, url, process_id, result, content_type, on_success, attempt):
+        import requests
+        timestamp = str(int(time.time()))
+        try:
+            if isinstance(result, SpilledResult):
+                # Stream spilled results, rather than reading them into
+                # memory.
+                with result.open() as body:
+                    signature = sign_callback(self._secret_key, timestamp, body)
+                    body.seek(0)
+                    response = self._post_body(url, process_id, content_type,
+                                               timestamp, signature, body)
+            else:
+                body = result.encode('utf-8')
+                response = self._post_body(
+                    url, process_id, content_type, timestamp,
+                    sign_callback(self._secret_key, timestamp, body), body)
+            status_code = response.status_code
+            response.close()
+        except requests.RequestException:
+            status_code = None
+        if status_code is not None and 200 <= status_code < 300:
+            with self._lock:
+                self._delivered += 1
+            self._discard(result)
+            on_success()
+            return
+        if status_code is None or 429 == status_code or 500 <= status_code < 600:
+            delay = self._retry_policy.retry(attempt)
+            if delay is not None:
+                timer = Timer(delay, self._submit, (
+                    url, process_id, result, content_type, on_success,
+                    attempt + 1))
+                timer.daemon = True
+                timer.start()
+                return
+        # The result can still be retrieved through /retrieve.
+        self._discard(result)
+        with self._lock:
+            self._failed += 1
+
+    def _post_body(self, url, process_id, content_type, timestamp, signature, body):
+        return self._session.post(url, data=body, headers={
+            'Content-Type': '%s; charset=utf-8' % content_type,
+            'X-Tk-Process-Id': process_id,
+            'X-Tk-Timestamp': timestamp,
+            'X-Tk-Signature': signature,
+        }, timeout=self._timeout, allow_redirects=False)
+
+    def close(self):
+        """
+        Waits for running deliveries, and stops delivering.
+        :return:
+        """
+        with self._lock:
+            self._closed = True
+            executor, session = self._executor, self._session
+            pending = list(self._pending.items())
+        for future, result in pending:
+            # Deliveries that have not started never will.
+            if future.cancel():
+                self._discard(result)
+        if executor is not None:
+            executor.shutdown(wait=True)
+            session.close()
+
+    def stats(self):
+        """
+        Gets the delivery statistics.
+        :return: A dictionary with the number of 'delivered' and 'failed'
+          deliveries.
+        """
+        with self._lock:
+            return {
+                'delivered': self._delivered,
+                'failed': self._failed,
+            }
+
+
+def build_callback_dispatcher(config):
+    """
+    Builds the configured callback dispatcher.
+    :param config: The application configuration.
+    :return: CallbackDispatcher
+    """
+    return CallbackDispatcher(
+        config['CALLBACK_SECRET_KEY'] or config['SECRET_KEY'],
+        config['CALLBACK_MAX_CONCURRENCY'],
+        config['CALLBACK_TIMEOUT'],
+        RetryPolicy(config['CALLBACK_RETRIES'],
+                    config['CALLBACK_RETRY_BACKOFF'],
+                    config['CALLBACK_RETRY_MAX_BACKOFF'],
+                    config['CALLBACK_RETRY_BUDGET_RATIO'],
+                    config['CALLBACK_RETRY_BUDGET_SIZE']))
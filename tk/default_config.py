@@ -2,9 +2,183 @@ SOURCEBOX_URL = 'https://staging.textkernel.nl/sourcebox/extract.do'
 SOURCEBOX_ACCOUNT_NAME = None
 SOURCEBOX_USER_NAME = None
 SOURCEBOX_PASSWORD = None
-# A list of 2-tuples (username, plain-text password).
+# A list of dictionaries with the 'url', 'account_name', 'user_name', and
+# 'password' of every Sourcebox target to spread documents over, and
+# optionally its 'max_outstanding' number of concurrent requests and a 'name'
+# for statistics. All targets must produce the same profiles. Defaults to a
+# single target for SOURCEBOX_URL and the Sourcebox credentials above.
+SOURCEBOX_TARGETS = []
+# The number of threads to send Sourcebox requests from.
+SOURCEBOX_EXECUTOR_WORKERS = 32
+# The number of Sourcebox hosts to keep connection pools for.
+SOURCEBOX_POOL_CONNECTIONS = 10
+# The maximum number of connections to keep open per Sourcebox host.
+SOURCEBOX_POOL_MAXSIZE = 32
+# Whether to reuse Sourcebox connections across requests.
+SOURCEBOX_KEEP_ALIVE = True
+# The number of seconds to wait for a Sourcebox connection to be established.
+SOURCEBOX_CONNECT_TIMEOUT = 5
+# The number of seconds to wait for a Sourcebox response.
+SOURCEBOX_READ_TIMEOUT = 120
+# The maximum size of submitted documents in bytes.
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+# The size in bytes above which submitted documents are spooled to temporary
+# files instead of being kept in memory.
+DOCUMENT_SPOOL_SIZE = 1024 * 1024
+# The maximum size of batch submissions in bytes.
+MAX_BATCH_SIZE = 1024 * 1024 * 1024
+# The maximum number of documents per batch submission.
+MAX_BATCH_DOCUMENTS = 10000
+# A list of 2-tuples (username, password). Passwords are either plain text, or
+# hashes produced by tk.users.hash_password(). Plain-text passwords are hashed
+# when their users first authenticate.
 USERS = []
+# The number of PBKDF2 iterations to hash plain-text user passwords with.
+USER_PASSWORD_HASH_ITERATIONS = 100000
+# The maximum number of verified user credentials to cache.
+USER_CREDENTIALS_CACHE_SIZE = 1024
+# The number of seconds to cache verified user credentials for.
+USER_CREDENTIALS_CACHE_TTL = 300
 # A secret (private) key for symmetric encryption.
 SECRET_KEY = None
 # The access token lifetime in seconds.
 ACCESS_TOKEN_TTL = 600
+# The maximum number of verified access tokens to cache.
+ACCESS_TOKEN_CACHE_SIZE = 4096
+# The number of seconds to cache rejected access tokens for.
+ACCESS_TOKEN_REJECTION_TTL = 10
+# The maximum number of rejected access tokens to cache. They are cached
+# separately from verified access tokens, so invalid tokens cannot evict valid
+# ones.
+ACCESS_TOKEN_REJECTION_CACHE_SIZE = 1024
+# How to encode access tokens: 'jwt' for JSON Web Tokens, or 'compact' for
+# smaller tokens that are faster to grant and verify. Changing this
+# invalidates all access tokens.
+ACCESS_TOKEN_CODEC = 'jwt'
+# Previous values of SECRET_KEY, so access tokens signed with them remain
+# valid after SECRET_KEY is rotated. Keep them until ACCESS_TOKEN_TTL has
+# passed since the rotation.
+ACCESS_TOKEN_PREVIOUS_SECRET_KEYS = []
+# The maximum number of seconds GET /retrieve/<process_id>?wait=<seconds> may
+# block for while a process is in progress.
+RETRIEVE_MAX_WAIT = 30
+# The maximum number of process IDs per POST /retrieve/batch request.
+MAX_BATCH_RETRIEVE_PROCESSES = 10000
+# Where to keep processes: "memory" keeps them in the server process, and
+# "sqlite" keeps them in an SQLite database at PROCESS_STORE_PATH, that all
+# server processes on the same host can share.
+PROCESS_STORE = 'memory'
+PROCESS_STORE_PATH = None
+# SQLite cannot notify server processes of each other's changes, so while
+# requests wait for processes in the 'sqlite' process store, every server
+# process checks the database for changes this often, in seconds. Processes
+# finished through the same server process are not affected.
+PROCESS_STORE_POLL_INTERVAL = 0.05
+# The number of independently locked shards to spread processes over in the
+# 'memory' process store. PROCESS_MAX_ENTRIES and PROCESS_MAX_BYTES apply to
+# each shard proportionally. With a global interpreter lock, the shards' locks
+# are barely contended (see tk.benchmarks.contention), so only raise this on
+# free-threaded Python builds.
+PROCESS_STORE_SHARDS = 1
+# The number of seconds after which to discard processes still in progress.
+PROCESS_PROGRESS_TTL = 3600
+# The number of seconds after which to discard unretrieved results.
+PROCESS_RESULT_TTL = 3600
+# The maximum number of processes to keep. The oldest are discarded first.
+PROCESS_MAX_ENTRIES = 100000
+# The maximum total size of unretrieved results to keep, in bytes.
+PROCESS_MAX_BYTES = 512 * 1024 * 1024
+# The size in bytes above which Sourcebox responses are spilled to temporary
+# files instead of being kept in memory. Spilled results do not count towards
+# PROCESS_MAX_BYTES.
+RESULT_SPOOL_SIZE = 1024 * 1024
+# The directory to spill results to, or None for the system's temporary
+# directory.
+RESULT_SPOOL_DIRECTORY = None
+# The maximum number of profiles to reuse when identical documents are
+# submitted again, or 0 to always submit documents to Sourcebox.
+PROFILE_CACHE_SIZE = 1024
+# The number of seconds to reuse profiles for.
+PROFILE_CACHE_TTL = 3600
+# The maximum number of concurrent Sourcebox connections for the asyncio server
+# (tk.aiohttp.entry_point).
+ASYNC_SOURCEBOX_MAX_CONNECTIONS = 1000
+# The maximum number of concurrent Sourcebox requests. Further documents are
+# queued per user.
+UPSTREAM_MAX_IN_FLIGHT = 32
+# The maximum number of queued documents, above which /submit responds with
+# 503 Service Unavailable.
+UPSTREAM_MAX_QUEUE_DEPTH = 10000
+# A dictionary of the number of queued documents users may send to Sourcebox
+# per round, keyed by user name. Users default to 1.
+UPSTREAM_USER_WEIGHTS = {}
+# The maximum number of times to retry a Sourcebox request after a connection
+# error or a 5xx response.
+UPSTREAM_RETRIES = 2
+# The maximum number of seconds to wait before the first retry. This doubles
+# for every following retry, up to UPSTREAM_RETRY_MAX_BACKOFF seconds.
+UPSTREAM_RETRY_BACKOFF = 0.25
+UPSTREAM_RETRY_MAX_BACKOFF = 5
+# The number of retries every Sourcebox request earns, and the maximum number
+# of retries that can be saved up. This keeps retries from multiplying the
+# load during an outage.
+UPSTREAM_RETRY_BUDGET_RATIO = 0.2
+UPSTREAM_RETRY_BUDGET_SIZE = 10
+# The number of consecutive failed Sourcebox requests after which to fail
+# documents immediately with an upstream error, or 0 to always send them.
+UPSTREAM_CIRCUIT_FAILURE_THRESHOLD = 5
+# The number of seconds to fail documents for, before sending
+# UPSTREAM_CIRCUIT_PROBES documents to find out whether Sourcebox recovered.
+UPSTREAM_CIRCUIT_RESET_TIMEOUT = 30
+UPSTREAM_CIRCUIT_PROBES = 1
+# The size in bytes below which /retrieve responses are not compressed.
+RESPONSE_COMPRESSION_MIN_SIZE = 1024
+# The compression level for /retrieve responses, from 1 (fast) to 9 (small).
+RESPONSE_COMPRESSION_LEVEL = 6
+# The maximum number of compressed /retrieve responses to reuse for identical
+# profiles, or 0 to always compress responses.
+RESPONSE_COMPRESSION_CACHE_SIZE = 256
+# The number of worker processes to convert profiles to JSON in, None for one
+# per CPU, or 0 to convert profiles in the request threads.
+PROJECTION_WORKERS = None
+# The size in characters below which profiles are converted to JSON in the
+# request threads, because sending them to a worker process costs more.
+PROJECTION_POOL_MIN_SIZE = 65536
+# The maximum number of profiles whose JSON conversions to reuse for identical
+# profiles and ?fields= selectors, or 0 to always convert profiles. Conversions
+# are discarded once their process is retrieved.
+PROJECTION_CACHE_SIZE = 256
+# Whether to add a Server-Timing header with the time spent in each phase of
+# handling a request to every response.
+SERVER_TIMING_ENABLED = False
+# The fraction of requests to profile, from 0 to 1. Profiles are written to
+# PROFILER_OUTPUT_DIRECTORY in the collapsed stack format flamegraph.pl reads.
+PROFILER_SAMPLE_RATE = 0
+PROFILER_OUTPUT_DIRECTORY = None
+# The number of seconds between stack samples of profiled requests.
+PROFILER_INTERVAL = 0.005
+# Whether to serve metrics in the Prometheus text format at /metrics. The
+# endpoint requires no authentication, so only enable it where it cannot be
+# reached publicly.
+METRICS_ENABLED = False
+# A dictionary of the URLs users may pass to /submit as callback_url, keyed by
+# user name. Callback URLs must have the same scheme and host as one of the
+# user's URLs, and its path or a path below it.
+CALLBACK_URLS = {}
+# The secret key to sign callbacks with. Defaults to SECRET_KEY.
+CALLBACK_SECRET_KEY = None
+# The maximum number of concurrent callback requests.
+CALLBACK_MAX_CONCURRENCY = 8
+# The number of seconds to wait for a callback URL to respond.
+CALLBACK_TIMEOUT = 10
+# The maximum number of times to retry a callback, and the maximum number of
+# seconds to wait before the first and any later retry.
+CALLBACK_RETRIES = 5
+CALLBACK_RETRY_BACKOFF = 1
+CALLBACK_RETRY_MAX_BACKOFF = 60
+# The number of callback retries every callback adds to the retry budget, and
+# the maximum number of callback retries that can be saved up. Callbacks have
+# their own budget, separate from Sourcebox requests'. While many callbacks
+# fail, this caps retries below CALLBACK_RETRIES per callback.
+CALLBACK_RETRY_BUDGET_RATIO = 1
+CALLBACK_RETRY_BUDGET_SIZE = 100
@@ -0,0 +1,171 @@
+import gzip
+import hashlib
+import zlib
+
+from tk.cache import LruCache
+from tk.upload import CHUNK_SIZE
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class UnsupportedEncoding(Exception):
+    pass
+
+
+# The exceptions decompressing streams raise for malformed input.
+DECODING_ERRORS = (EOFError, OSError, zlib.error) + (
+    () if brotli is None else (brotli.error,)) + (
+    () if zstandard is None else (zstandard.ZstdError,))
+
+
+class _ZlibReader:
+    """
+    Decompresses a zlib (HTTP deflate) stream as it is read.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._decompressor = zlib.decompressobj()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = CHUNK_SIZE
+        while not self._decompressor.eof:
+            data = self._decompressor.unconsumed_tail or self._stream.read(
+                CHUNK_SIZE)
+            if not data:
+                # Like gzip.GzipFile, reject truncated streams.
+                raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+            # Limit the output, so small bodies cannot expand to fill memory.
+            chunk = self._decompressor.decompress(data, size)
+            if chunk:
+                return chunk
+        return b''
+
+
+class _BrotliReader:
+    """
+    Decompresses a Brotli stream as it is read.
+    """
+
+    # Brotli cannot limit its output, so feed it small inputs instead.
+    _INPUT_SIZE = 1024
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._decompressor = brotli.Decompressor()
+
+    def read(self, size=-1):
+        while True:
+            data = self._stream.read(self._INPUT_SIZE)
+            if not data:
+                return b''
+            chunk = self._decompressor.process(data)
+            if chunk:
+                return chunk
+
+
+def decompressing_stream(stream, content_encoding):
+    """
+    Wraps a request body stream to decompress it as it is read.
+    :param stream: A binary stream.
+    :param content_encoding: The value of the Content-Encoding header, if any.
+    :return: A binary stream, which raises any of DECODING_ERRORS if the
+      input is malformed.
+    :raises UnsupportedEncoding: If the encoding is not supported.
+    """
+    encoding = (content_encoding or 'identity').strip().lower()
+    if 'identity' == encoding:
+        return stream
+    if encoding in ('gzip', 'x-gzip'):
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if 'deflate' == encoding:
+        return _ZlibReader(stream)
+    if 'br' == encoding and brotli is not None:
+        return _BrotliReader(stream)
+    if 'zstd' == encoding and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    raise UnsupportedEncoding()
+
+
+def available_encodings():
+    """
+    Gets the content codings responses can be compressed with.
+    :return: A list of encodings, in order of preference.
+    """
+    encodings = []
+    if brotli is not None:
+        encodings.append('br')
+    if zstandard is not None:
+        encodings.append('zstd')
+    encodings.append('gzip')
+    return encodings
+
+
+class ResponseCompressor:
+    """
+    Compresses response bodies for the encodings clients accept.
+
+    Compressed bodies are cached by their content, so identical responses,
+    such as profiles for duplicate documents, are compressed only once.
+    """
+
+    def __init__(self, min_size=1024, level=6, cache_size=256):
+        """
+        :param min_size: The size in bytes below which not to compress bodies.
+        :param level: The compression level, from 1 (fast) to 9 (small).
+        :param cache_size: The maximum number of compressed bodies to cache,
+          or 0 to disable caching.
+        """
+        self._min_size = min_size
+        self._level = level
+        self._encodings = available_encodings()
+        self._cache = LruCache(cache_size) if cache_size else None
+
+    def compress(self, body, accept_encodings):
+        """
+        Compresses a body, if it is worth it and the client accepts it.
+        :param body: The body as bytes.
+        :param accept_encodings: The parsed Accept-Encoding header, as a
+          werkzeug.datastructures.Accept.
+        :return: A 2-tuple (body: bytes, encoding: str), with a None encoding
+          if the body was not compressed.
+        """
+        if len(body) < self._min_size:
+            return body, None
+        encoding = accept_encodings.best_match(self._encodings)
+        if encoding is None:
+            return body, None
+        key = (encoding, hashlib.sha1(body).digest())
+        compressed = None if self._cache is None else self._cache.get(key)
+        if compressed is None:
+            compressed = self._compress(body, encoding)
+            if self._cache is not None:
+                self._cache.set(key, compressed)
+        return compressed, encoding
+
+    def _compress(self, body, encoding):
+        if 'br' == encoding:
+            return brotli.compress(body, quality=self._level)
+        if 'zstd' == encoding:
+            return zstandard.ZstdCompressor(level=self._level).compress(body)
+        return gzip.compress(body, self._level)
+
+
+def build_response_compressor(config):
+    """
+    Builds the configured response compressor.
+    :param config: The application configuration.
+    :return: ResponseCompressor
+    """
+    return ResponseCompressor(config['RESPONSE_COMPRESSION_MIN_SIZE'],
+                              config['RESPONSE_COMPRESSION_LEVEL'],
+                              config['RESPONSE_COMPRESSION_CACHE_SIZE'])
@@ -1,26 +1,53 @@
+import atexit
+import json
+import os
+import tarfile
+import time
+import weakref
+import zipfile
 from functools import wraps
+from threading import Lock
+from xml.etree.ElementTree import ParseError
 
 from flask import Flask, request, Response
 from flask_httpauth import HTTPBasicAuth
-from requests_futures.sessions import FuturesSession
 from werkzeug.exceptions import NotAcceptable, UnsupportedMediaType, NotFound, \
-    BadRequest, Forbidden, Unauthorized
+    BadRequest, Forbidden, Unauthorized, RequestEntityTooLarge, \
+    RequestedRangeNotSatisfiable, ServiceUnavailable
+from werkzeug.http import quote_etag
+from werkzeug.wsgi import ClosingIterator, wrap_file
 
-from tk.auth import Auth
+from tk.auth import build_auth
+from tk.bulk import CONTENT_TYPES as BULK_CONTENT_TYPES, MULTIPART, \
+    multipart_boundary, parse_process_ids, render_multipart, render_ndjson
+from tk.callback import build_callback_dispatcher, callback_url_allowed
+from tk.encoding import DECODING_ERRORS, UnsupportedEncoding, \
+    build_response_compressor, decompressing_stream
+from tk.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Gauge, \
+    REQUEST_DURATION, REQUESTS, UPLOAD_SIZE, exposition, process_gauges
 from tk.process import Process
+from tk.projection import InvalidFields, build_profile_projector, \
+    parse_fields
+from tk.scheduler import QueueFull, build_scheduler, queue_position_headers
+from tk.store import SpilledResult, build_result_store, result_size
+from tk.timing import ServerTiming, build_sampling_profiler, phase
+from tk.upload import CHUNK_SIZE, DocumentTooLarge, LimitedStream, \
+    StreamTooLarge, spool_document, iter_tar_files, iter_zip_files
+from tk.upstream import build_retry_policy, build_upstream_targets
+from tk.users import UserStore
 
 
-def request_content_type(content_type):
+def request_content_type(*content_types):
     """
     Check we can accept the request body.
-    :param content_type:
+    :param content_types: The acceptable content types.
     :return:
     """
 
     def decorator(route_method):
         @wraps(route_method)
         def checker(*route_method_args, **route_method_kwargs):
-            if request.mimetype != content_type:
+            if request.mimetype not in content_types:
                 raise UnsupportedMediaType()
             return route_method(*route_method_args, **route_method_kwargs)
 
@@ -29,9 +56,14 @@ def request_content_type(content_type):
     return decorator
 
 
-def response_content_type(content_type):
+def response_content_type(*content_types):
     """
     Check we can deliver the right content type.
+
+    The negotiated content type is available as
+    request._tk_response_content_type.
+    :param content_types: The content types we can deliver, in order of
+      preference.
     :return:
     """
 
@@ -39,9 +71,10 @@ def response_content_type(content_type):
         @wraps(route_method)
         def checker(*route_method_args, **route_method_kwargs):
             negotiated_content_type = request.accept_mimetypes.best_match(
-                [content_type])
+                content_types)
             if negotiated_content_type is None:
                 raise NotAcceptable()
+            request._tk_response_content_type = negotiated_content_type
             return route_method(*route_method_args, **route_method_kwargs)
 
         return checker
@@ -49,23 +82,203 @@ def response_content_type(content_type):
     return decorator
 
 
+def _byte_range(etag, length):
+    """
+    Gets the part of a response body the current request is for.
+    :param etag: The response's entity tag, unquoted.
+    :param length: The length of the entire body in bytes.
+    :return: A 2-tuple (start: int, stop: int), or None for the entire body.
+    :raises RequestedRangeNotSatisfiable: If the range is malformed or out of
+      bounds.
+    """
+    if 'Range' not in request.headers:
+        return None
+    if 'If-Range' in request.headers and etag != request.if_range.etag:
+        return None
+    byte_range = None if request.range is None else request.range.range_for_length(length)
+    if byte_range is None:
+        raise RequestedRangeNotSatisfiable(response=Response(status=416, headers={
+            'Content-Range': 'bytes */%d' % length,
+        }))
+    return byte_range
+
+
+def _read_file(file, start, stop):
+    """
+    Reads part of a file.
+    :param file: The binary file to read.
+    :param start: The offset to start reading at.
+    :param stop: The offset to stop reading at.
+    :return: An iterable of chunks of bytes.
+    """
+    file.seek(start)
+    remaining = stop - start
+    while remaining:
+        chunk = file.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+
+# All apps in this Python process, to reset after forking and close on exit.
+_APPS = weakref.WeakSet()
+
+
+def _after_fork():
+    for app in list(_APPS):
+        app._after_fork()
+
+
+def _close_apps():
+    for app in list(_APPS):
+        app.close()
+
+
+# Python 3.5 and 3.6 cannot reset apps after forking, so there apps must not
+# be started before forking.
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+atexit.register(_close_apps)
+
+
 class App(Flask):
     def __init__(self, *args, **kwargs):
         super().__init__('tk', static_folder=None, *args, **kwargs)
         self.config.from_object('tk.default_config')
         self.config.from_envvar('TK_CONFIG_FILE')
         self._http_basic_auth = HTTPBasicAuth()
-        self.auth = Auth(self.config['SECRET_KEY'],
-                         self.config['ACCESS_TOKEN_TTL'])
+        self.users = UserStore(self.config['USER_PASSWORD_HASH_ITERATIONS'],
+                               self.config['USER_CREDENTIALS_CACHE_SIZE'],
+                               self.config['USER_CREDENTIALS_CACHE_TTL'])
+        for name, password in self.config['USERS']:
+            self.users.add(name, password)
+        self.auth = build_auth(self.config)
+        self._compressor = build_response_compressor(self.config)
+        self._projector = build_profile_projector(self.config)
+        self._profiler = build_sampling_profiler(self.config)
         self._register_routes()
-        self._session = FuturesSession()
-        self.process = Process(self._session, self.config['SOURCEBOX_URL'],
-                               self.config['SOURCEBOX_ACCOUNT_NAME'],
-                               self.config['SOURCEBOX_USER_NAME'],
-                               self.config['SOURCEBOX_PASSWORD'])
+        # Threads, executors, and connection pools do not survive forking, so
+        # they are only created when they are first needed, in the process
+        # that needs them. See start().
+        self._session = None
+        self._process = None
+        self._gauges = None
+        self._close_hooks = []
+        self._start_lock = Lock()
+        _APPS.add(self)
+
+    def start(self):
+        """
+        Starts the Sourcebox session and the process manager.
+
+        This happens on first use, so calling this is only needed to avoid
+        doing it while handling the first request, such as from a preforking
+        server's post-fork hook.
+        :return:
+        """
+        with self._start_lock:
+            if self._process is not None:
+                return
+            # This is imported here, because requests is slow to import, and
+            # is not needed until the first document is submitted.
+            from tk.session import UpstreamSession
+            session = UpstreamSession(
+                self.config['SOURCEBOX_EXECUTOR_WORKERS'],
+                self.config['SOURCEBOX_POOL_CONNECTIONS'],
+                self.config['SOURCEBOX_POOL_MAXSIZE'],
+                self.config['SOURCEBOX_KEEP_ALIVE'],
+                self.config['SOURCEBOX_CONNECT_TIMEOUT'],
+                self.config['SOURCEBOX_READ_TIMEOUT'])
+            callback_dispatcher = build_callback_dispatcher(self.config)
+            process = Process(session, self.config['SOURCEBOX_URL'],
+                              self.config['SOURCEBOX_ACCOUNT_NAME'],
+                              self.config['SOURCEBOX_USER_NAME'],
+                              self.config['SOURCEBOX_PASSWORD'],
+                              build_result_store(self.config),
+                              self.config['PROFILE_CACHE_SIZE'],
+                              self.config['PROFILE_CACHE_TTL'],
+                              build_scheduler(self.config),
+                              retry_policy=build_retry_policy(self.config),
+                              callback_dispatcher=callback_dispatcher,
+                              result_spool_size=self.config['RESULT_SPOOL_SIZE'],
+                              result_spool_directory=self.config['RESULT_SPOOL_DIRECTORY'],
+                              upstream_targets=build_upstream_targets(self.config))
+            self._gauges = process_gauges(process) + [
+                Gauge('tk_upstream_executor_queue_depth',
+                      'The number of Sourcebox requests waiting for a thread.',
+                      lambda: session.stats()['executor_queue_depth']),
+            ]
+            self._close_hooks += [session.close, callback_dispatcher.close,
+                                  self._projector.close]
+            self._session = session
+            self._process = process
+
+    @property
+    def process(self):
+        if self._process is None:
+            self.start()
+        return self._process
+
+    def add_close_hook(self, callback):
+        """
+        Registers a callable to call when the app is closed.
+        :param callback: A callable without arguments.
+        :return:
+        """
+        self._close_hooks.append(callback)
+
+    def close(self):
+        """
+        Stops the Sourcebox session and the process manager, and calls the
+        close hooks, in reverse order of registration.
+
+        This happens when the Python interpreter exits, so calling this is
+        only needed to shut down earlier, such as from a preforking server's
+        worker exit hook. The app starts again when it is used after closing.
+        :return:
+        """
+        with self._start_lock:
+            close_hooks = self._close_hooks
+            self._close_hooks = []
+            self._session = None
+            self._process = None
+            self._gauges = None
+        for callback in reversed(close_hooks):
+            callback()
+
+    def _after_fork(self):
+        """
+        Forgets the parent process' threads and connections in a forked child.
+        :return:
+        """
+        self._start_lock = Lock()
+        self._session = None
+        self._process = None
+        self._gauges = None
+        self._close_hooks = []
+        self._projector = build_profile_projector(self.config)
+        self._profiler = build_sampling_profiler(self.config)
+
+    def upstream_stats(self):
+        """
+        Gets the live usage of the Sourcebox executor and connection pools.
+        :return: See UpstreamSession.stats().
+        """
+        self.start()
+        return self._session.stats()
 
     def add_user(self, name, password):
-        self.config['USERS'].append((name, password))
+        self.users.add(name, password)
+
+    def _phase(self, name):
+        """
+        Times a phase of handling the current request, for the Server-Timing
+        header.
+        :param name: The phase's name.
+        :return: A context manager.
+        """
+        return phase(getattr(request, '_tk_server_timing', None), name)
 
     def request_access_token(self, route_method):
         """
@@ -77,7 +290,8 @@ class App(Flask):
             if 'access_token' not in request.args:
                 raise Unauthorized()
             access_token = request.args.get('access_token')
-            user_name = self.auth.verify_access_token(access_token)
+            with self._phase('auth'):
+                user_name = self.auth.verify_access_token(access_token)
             if user_name is None:
                 raise Forbidden()
             request._tk_auth_user_name = user_name
@@ -85,58 +299,378 @@ class App(Flask):
 
         return checker
 
+    def _callback_url(self):
+        """
+        Gets the current request's callback URL.
+        :return: The URL, or None if the request has none.
+        :raises BadRequest: If the user may not use the URL.
+        """
+        callback_url = request.args.get('callback_url')
+        if callback_url is None:
+            return None
+        if not callback_url_allowed(callback_url, self.config['CALLBACK_URLS'].get(
+                request._tk_auth_user_name, ())):
+            raise BadRequest('This callback URL is not allowed.')
+        return callback_url
+
+    def _submit_batch_item(self, name, file, callback_url):
+        """
+        Submits a single document from a batch.
+        :param name: The document's name.
+        :param file: A binary file to read the document from.
+        :param callback_url: The URL to push the result to, if any.
+        :return: A dictionary with the document's name, and either the process
+          ID or an error message.
+        """
+        item = {
+            'name': name,
+        }
+        try:
+            with self._phase('body'):
+                document = spool_document(file, self.config['MAX_DOCUMENT_SIZE'],
+                                          self.config['DOCUMENT_SPOOL_SIZE'])
+        except DocumentTooLarge:
+            item['error'] = 'The document is too large.'
+            return item
+        if not document.size:
+            document.close()
+            item['error'] = 'The document is empty.'
+            return item
+        UPLOAD_SIZE.observe(document.size)
+        try:
+            with self._phase('schedule'):
+                item['process_id'] = self.process.submit(
+                    request._tk_auth_user_name, document, callback_url)
+        except QueueFull:
+            item['error'] = 'Too many documents are queued. Try again later.'
+        return item
+
     def _register_routes(self):
-        @self._http_basic_auth.get_password
-        def _get_user_password(actual_name):
+        @self.before_request
+        def _start_request_timer():
+            request._tk_start_time = time.perf_counter()
+            if self.config['SERVER_TIMING_ENABLED']:
+                request._tk_server_timing = ServerTiming()
+            if self._profiler is not None:
+                request._tk_profile = self._profiler.start()
+
+        @self.after_request
+        def _observe_request(response):
+            route = request.endpoint or 'unknown'
+            REQUEST_DURATION.observe(
+                time.perf_counter() - request._tk_start_time, route)
+            REQUESTS.inc(route, str(response.status_code))
+            server_timing = getattr(request, '_tk_server_timing', None)
+            if server_timing is not None:
+                response.headers['Server-Timing'] = server_timing.header()
+            return response
+
+        @self.teardown_request
+        def _stop_profiler(_):
+            profile = getattr(request, '_tk_profile', None)
+            if profile is not None:
+                self._profiler.stop(profile, request.endpoint or 'unknown')
+
+        if self.config['METRICS_ENABLED']:
+            @self.route('/metrics')
+            def metrics():
+                self.start()
+                return Response(exposition(self._gauges), 200,
+                                content_type=METRICS_CONTENT_TYPE)
+
+        @self._http_basic_auth.verify_password
+        def _verify_user_password(name, password):
             """
-            Retrieves a user's password for HTTP Basic Auth.
-            :param actual_name:
-            :return: The password or None if the user does not exist.
+            Verifies a user's credentials for HTTP Basic Auth.
+            :param name:
+            :param password:
+            :return: Whether the credentials are valid.
             """
-            for name, password in self.config['USERS']:
-                if name == actual_name:
-                    request._tk_auth_user_name = name
-                    return password
-            return None
+            with self._phase('auth'):
+                if not self.users.verify(name, password):
+                    return False
+            request._tk_auth_user_name = name
+            return True
 
         @self.route('/accesstoken')
         @self._http_basic_auth.login_required
         @request_content_type('')
         @response_content_type('text/plain')
         def access_token():
-            return self.auth.grant_access_token(request._tk_auth_user_name)
+            with self._phase('token'):
+                return self.auth.grant_access_token(request._tk_auth_user_name)
 
         @self.route('/submit', methods=['POST'])
         @self.request_access_token
         @request_content_type('application/octet-stream')
         @response_content_type('text/plain')
         def submit():
-            document = request.get_data()
-            if not document:
+            callback_url = self._callback_url()
+            max_size = self.config['MAX_DOCUMENT_SIZE']
+            if request.content_length is not None and request.content_length > max_size:
+                raise RequestEntityTooLarge()
+            try:
+                stream = decompressing_stream(
+                    request.stream, request.headers.get('Content-Encoding'))
+            except UnsupportedEncoding:
+                raise UnsupportedMediaType()
+            try:
+                with self._phase('body'):
+                    document = spool_document(stream, max_size,
+                                              self.config['DOCUMENT_SPOOL_SIZE'])
+            except DocumentTooLarge:
+                raise RequestEntityTooLarge()
+            except DECODING_ERRORS:
+                raise BadRequest()
+            if not document.size:
+                document.close()
                 raise BadRequest()
-            process_id = self.process.submit(
-                request._tk_auth_user_name, document)
+            UPLOAD_SIZE.observe(document.size)
+            try:
+                with self._phase('schedule'):
+                    process_id = self.process.submit(
+                        request._tk_auth_user_name, document, callback_url)
+            except QueueFull as e:
+                raise ServiceUnavailable(response=Response(
+                    status=503, headers={
+                        'Retry-After': str(e.retry_after),
+                    }))
             return Response(process_id, 200, mimetype='text/plain')
 
+        @self.route('/submit/batch', methods=['POST'])
+        @self.request_access_token
+        @request_content_type('multipart/form-data', 'application/x-tar',
+                              'application/zip')
+        @response_content_type('application/json')
+        def submit_batch():
+            callback_url = self._callback_url()
+            max_size = self.config['MAX_BATCH_SIZE']
+            if request.content_length is not None and request.content_length > max_size:
+                raise RequestEntityTooLarge()
+            # Chunked bodies have no Content-Length, so limit what is read.
+            request.environ['wsgi.input'] = LimitedStream(
+                request.environ['wsgi.input'], max_size)
+            archive = None
+            try:
+                if 'multipart/form-data' == request.mimetype:
+                    files = ((file.filename, file.stream)
+                             for _, file in request.files.items(multi=True))
+                elif 'application/x-tar' == request.mimetype:
+                    files = iter_tar_files(request.stream)
+                else:
+                    # Zip archives cannot be read without seeking.
+                    archive = spool_document(request.stream, max_size,
+                                             self.config['DOCUMENT_SPOOL_SIZE'])
+                    files = iter_zip_files(archive.open())
+            except (DocumentTooLarge, StreamTooLarge):
+                raise RequestEntityTooLarge()
+
+            items = []
+            try:
+                for name, file in files:
+                    if len(items) >= self.config['MAX_BATCH_DOCUMENTS']:
+                        # Stop reading, rather than reading any further
+                        # documents only to reject them.
+                        items.append({
+                            'name': name,
+                            'error': 'The batch contains too many documents. Any further documents were ignored.',
+                        })
+                        break
+                    items.append(self._submit_batch_item(
+                        name, file, callback_url))
+            except (tarfile.TarError, zipfile.BadZipFile, EOFError):
+                if not items:
+                    raise BadRequest()
+                items.append({
+                    'error': 'The archive is malformed.',
+                })
+            except StreamTooLarge:
+                if not items:
+                    raise RequestEntityTooLarge()
+                items.append({
+                    'error': 'The batch is too large. Any further documents were ignored.',
+                })
+            finally:
+                if archive is not None:
+                    archive.close()
+            return Response(json.dumps(items), 200,
+                            mimetype='application/json')
+
         @self.route('/retrieve/<process_id>')
         @self.request_access_token
         @request_content_type('')
-        @response_content_type('text/xml')
+        @response_content_type('text/xml', 'application/json')
         def retrieve(process_id):
-            process = self.process.retrieve(process_id)
+            try:
+                wait = float(request.args.get('wait', 0))
+            except ValueError:
+                raise BadRequest()
+            if not 0 <= wait:
+                raise BadRequest()
+            wait = min(wait, self.config['RETRIEVE_MAX_WAIT'])
+            try:
+                fields = parse_fields(request.args.get('fields'))
+            except InvalidFields as e:
+                raise BadRequest(str(e))
+
+            content_type = request._tk_response_content_type
+            # Conditional requests and requests for part of a profile leave
+            # the process in place until we know the profile is sent in full,
+            # so revalidations do not lose it, and the other parts can be
+            # requested later.
+            conditional = 'text/xml' == content_type and (
+                'Range' in request.headers or 'If-None-Match' in request.headers)
+            # Only the owner may delete a process, so peek before retrieving.
+            process = self.process.peek(process_id)
             if process is None:
                 raise NotFound()
 
             if request._tk_auth_user_name != process[0]:
                 raise Forbidden()
 
-            if Process.ERROR_INTERNAL == process[1]:
+            if Process.PROGRESS == process[1] and wait:
+                with self._phase('wait'):
+                    self.process.wait(process_id, wait)
+                process = self.process.peek(process_id)
+                if process is None:
+                    raise NotFound()
+
+            result = process[1]
+            finished = result not in (Process.PROGRESS, Process.ERROR_INTERNAL, Process.ERROR_UPSTREAM)
+            # Whether we own the result, because the process was deleted.
+            retrieved = False
+            byte_range = None
+            if Process.PROGRESS != result:
+                if not conditional or not finished:
+                    last = True
+                elif request.if_none_match.contains(process_id):
+                    # The client has the profile already, so keep it.
+                    return Response(status=304, headers={
+                        'Vary': 'Accept, Accept-Encoding',
+                        'ETag': quote_etag(process_id),
+                    })
+                else:
+                    length = result_size(result)
+                    # A full profile is sent if the range does not apply.
+                    byte_range = _byte_range(process_id, length)
+                    last = byte_range is None or length == byte_range[1]
+                if last:
+                    # Another request may have retrieved the process since.
+                    process = self.process.retrieve(process_id)
+                    if process is None:
+                        raise NotFound()
+                    result = process[1]
+                    retrieved = True
+
+            headers = {
+                'Vary': 'Accept, Accept-Encoding',
+            }
+            if Process.PROGRESS == result:
+                headers.update(queue_position_headers(
+                    self.process.queue_position(process_id)))
+                if 'application/json' == content_type:
+                    result = json.dumps({'status': 'progress'})
+            elif 'application/json' == content_type and finished:
+                try:
+                    with self._phase('project'):
+                        result = self._projector.project(result, fields)
+                except ParseError:
+                    result = Process.ERROR_UPSTREAM
+                    finished = False
+                except FileNotFoundError:
+                    raise NotFound()
+                finally:
+                    # The process was deleted, so its conversions must go too.
+                    self._projector.forget(process[1])
+                    if isinstance(process[1], SpilledResult):
+                        process[1].delete()
+            if Process.ERROR_INTERNAL == result:
                 status_code = 500
                 content_type = 'text/plain'
-            elif Process.ERROR_UPSTREAM == process[1]:
+            elif Process.ERROR_UPSTREAM == result:
                 status_code = 502
                 content_type = 'text/plain'
             else:
                 status_code = 200
-                content_type = 'text/xml'
-            return Response(process[1], status_code, mimetype=content_type)
+
+            if finished and 'text/xml' == content_type:
+                # A process' profile never changes.
+                headers['ETag'] = quote_etag(process_id)
+                headers['Accept-Ranges'] = 'bytes'
+            if isinstance(result, SpilledResult):
+                # Stream large profiles from disk, uncompressed.
+                try:
+                    file = result.open()
+                except FileNotFoundError:
+                    raise NotFound()
+                if retrieved:
+                    # The open file remains readable.
+                    result.delete()
+                if byte_range is None:
+                    body = wrap_file(request.environ, file)
+                    content_length = result.size
+                else:
+                    start, stop = byte_range
+                    headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                        start, stop - 1, result.size)
+                    status_code = 206
+                    body = ClosingIterator(_read_file(file, start, stop),
+                                           file.close)
+                    content_length = stop - start
+                response = Response(body, status_code, headers=headers,
+                                    mimetype=content_type,
+                                    direct_passthrough=True)
+                response.content_length = content_length
+            else:
+                body = result.encode('utf-8')
+                if byte_range is not None:
+                    start, stop = byte_range
+                    headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                        start, stop - 1, len(body))
+                    body = body[start:stop]
+                    status_code = 206
+                elif not conditional:
+                    with self._phase('compress'):
+                        body, encoding = self._compressor.compress(
+                            body, request.accept_encodings)
+                    if encoding is not None:
+                        headers['Content-Encoding'] = encoding
+                        # Entity tags apply to uncompressed profiles.
+                        headers.pop('ETag', None)
+                response = Response(body, status_code, headers=headers,
+                                    mimetype=content_type)
+            return response
+
+        @self.route('/retrieve/batch', methods=['POST'])
+        @self.request_access_token
+        @request_content_type('application/json')
+        @response_content_type(*BULK_CONTENT_TYPES)
+        def retrieve_batch():
+            content_type = request._tk_response_content_type
+            max_count = self.config['MAX_BATCH_RETRIEVE_PROCESSES']
+            # Allow for generously long process IDs.
+            max_size = max_count * 128 + 2
+            if request.content_length is not None and request.content_length > max_size:
+                raise RequestEntityTooLarge()
+            body = b''
+            while True:
+                chunk = request.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                body += chunk
+                if len(body) > max_size:
+                    raise RequestEntityTooLarge()
+            try:
+                process_ids = parse_process_ids(body, max_count)
+            except ValueError as e:
+                raise BadRequest(str(e))
+            profiles = request.args.get('profiles') in ('1', 'true')
+            results = self.process.retrieve_many(
+                request._tk_auth_user_name, process_ids, profiles)
+            if MULTIPART == content_type:
+                boundary = multipart_boundary()
+                return Response(render_multipart(results, profiles, boundary),
+                                200, content_type='%s; boundary=%s' % (
+                                    MULTIPART, boundary))
+            return Response(render_ndjson(results, profiles), 200,
+                            mimetype=content_type)
@@ -1,3 +1,12 @@
 from tk.flask.app import App
 
-app = App()
+
+def create_app():
+    """
+    Builds the app, for servers that take an app factory.
+    :return: App
+    """
+    return App()
+
+
+app = create_app()
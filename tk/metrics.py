@@ -0,0 +1,316 @@
+import math
+import time
+import weakref
+from bisect import bisect_left
+from threading import Lock, current_thread, local
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Histogram buckets in seconds.
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1, 2.5, 5, 10, 30, 60)
+# Histogram buckets in bytes.
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216,
+                67108864)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for name, value in zip(names, values))
+
+
+class _ThreadLocalMetric:
+    """
+    Aggregates a metric per thread, so updates never wait for a lock.
+
+    Every thread updates its own cell, which is a dictionary keyed by label
+    values. Cells are only merged when the metric is collected. The cells of
+    threads that have finished are folded into a single retired cell whenever
+    a new thread registers its cell, so servers that start a thread per
+    request do not accumulate cells, even if the metric is never collected.
+    """
+
+    def __init__(self, name, help, labelnames=()):
+        """
+        :param name: The metric name.
+        :param help: A description of the metric.
+        :param labelnames: The names of the metric's labels.
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._local = local()
+        # A list of 2-tuples (thread: weakref.ref, cell: dict).
+        self._cells = []
+        self._retired = {}
+        self._lock = Lock()
+
+    def _cell(self):
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = {}
+            with self._lock:
+                self._retire()
+                self._cells.append((weakref.ref(current_thread()), cell))
+            return cell
+
+    def _retire(self):
+        """
+        Folds the cells of finished threads into the retired cell.
+
+        The lock must be held when calling this method.
+        :return:
+        """
+        cells = []
+        for thread, cell in self._cells:
+            alive = thread()
+            if alive is None or not alive.is_alive():
+                self._merge(self._retired, dict(cell))
+            else:
+                cells.append((thread, cell))
+        self._cells = cells
+
+    def _merge(self, target, cell):
+        raise NotImplementedError()
+
+    def _collect(self):
+        """
+        Merges all threads' cells.
+        :return: A dictionary keyed by label values.
+        """
+        merged = {}
+        with self._lock:
+            self._retire()
+            self._merge(merged, self._retired)
+            for _, cell in self._cells:
+                # Copying a dictionary is atomic, so this is safe while the
+                # owning thread keeps updating it.
+                self._merge(merged, dict(cell))
+        return merged
+
+
+class Counter(_ThreadLocalMetric):
+    def inc(self, *labelvalues, amount=1):
+        """
+        Increments the counter.
+        :param labelvalues: The values of the metric's labels, in order.
+        :param amount: The amount to increment by.
+        :return:
+        """
+        cell = self._cell()
+        cell[labelvalues] = cell.get(labelvalues, 0) + amount
+
+    def _merge(self, target, cell):
+        for labelvalues, value in cell.items():
+            target[labelvalues] = target.get(labelvalues, 0) + value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s counter' % self.name]
+        for labelvalues, value in sorted(self._collect().items()):
+            lines.append('%s%s %s' % (self.name, _format_labels(
+                self.labelnames, labelvalues), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class Histogram(_ThreadLocalMetric):
+    def __init__(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        """
+        :param buckets: The upper bounds of the buckets, in ascending order.
+        """
+        super().__init__(name, help, labelnames)
+        self._bounds = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, *labelvalues):
+        """
+        Records an observation.
+        :param value: The observed value.
+        :param labelvalues: The values of the metric's labels, in order.
+        :return:
+        """
+        cell = self._cell()
+        values = cell.get(labelvalues)
+        if values is None:
+            # Per-bucket counts, followed by the sum of all observations.
+            values = cell[labelvalues] = [0] * (len(self._bounds) + 1)
+        values[bisect_left(self._bounds, value)] += 1
+        values[-1] += value
+
+    def time(self, *labelvalues):
+        """
+        Times a block of code.
+        :param labelvalues: The values of the metric's labels, in order.
+        :return: A context manager.
+        """
+        return _Timer(self, labelvalues)
+
+    def _merge(self, target, cell):
+        for labelvalues, values in cell.items():
+            merged = target.setdefault(labelvalues, [0] * len(values))
+            for index, value in enumerate(values):
+                merged[index] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s histogram' % self.name]
+        labelnames = self.labelnames + ('le',)
+        for labelvalues, values in sorted(self._collect().items()):
+            cumulative = 0
+            for bound, count in zip(self._bounds, values):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, _format_labels(
+                    labelnames, labelvalues + (_format_value(bound),)), cumulative))
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append('%s_sum%s %s' % (self.name, labels,
+                                          _format_value(values[-1])))
+            lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+class _Timer:
+    def __init__(self, histogram, labelvalues):
+        self._histogram = histogram
+        self._labelvalues = labelvalues
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, *_):
+        self._histogram.observe(time.perf_counter() - self._start,
+                                *self._labelvalues)
+
+
+class Gauge:
+    """
+    A gauge whose values are read when it is collected.
+    """
+
+    def __init__(self, name, help, callback, labelnames=()):
+        """
+        :param name: The metric name.
+        :param help: A description of the metric.
+        :param callback: A callable returning the current value, or a
+          dictionary of values keyed by tuples of label values.
+        :param labelnames: The names of the metric's labels.
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._callback = callback
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s gauge' % self.name]
+        values = self._callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labelvalues, value in sorted(values.items()):
+            lines.append('%s%s %s' % (self.name, _format_labels(
+                self.labelnames, labelvalues), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class Registry:
+    """
+    Collects metrics for exposition in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        """
+        Registers a metric.
+        :param metric: A Counter, Histogram, or Gauge.
+        :return: The metric.
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        """
+        Renders all metrics.
+        :return: str
+        """
+        return ''.join(metric.render() for metric in self._metrics)
+
+
+# The metrics shared by all code in the server process.
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.histogram(
+    'tk_request_duration_seconds', 'The time spent handling requests.',
+    ('route',))
+REQUESTS = REGISTRY.counter(
+    'tk_requests_total', 'The number of handled requests.',
+    ('route', 'status'))
+UPLOAD_SIZE = REGISTRY.histogram(
+    'tk_upload_size_bytes', 'The size of submitted documents.',
+    buckets=SIZE_BUCKETS)
+JWT_DURATION = REGISTRY.histogram(
+    'tk_jwt_duration_seconds',
+    'The time spent granting and verifying access tokens.', ('operation',))
+UPSTREAM_DURATION = REGISTRY.histogram(
+    'tk_upstream_duration_seconds', 'The duration of Sourcebox requests.')
+UPSTREAM_RESPONSES = REGISTRY.counter(
+    'tk_upstream_responses_total',
+    'The number of Sourcebox responses, by status code, or "error" if there '
+    'was no response.', ('status',))
+
+
+def process_gauges(process):
+    """
+    Builds the gauges for a Process' current load.
+    :param process: The Process.
+    :return: A list of Gauge instances.
+    """
+    def _processes():
+        stats = process.stats()
+        return {
+            ('progress',): stats['progress'],
+            ('finished',): stats['finished'],
+            ('in_flight',): stats['in_flight'],
+            ('queued',): stats['scheduler']['queued'],
+            ('running',): stats['scheduler']['running'],
+        }
+    return [
+        Gauge('tk_processes', 'The number of processes, by state.',
+              _processes, ('state',)),
+        Gauge('tk_process_result_bytes',
+              'The total size of stored process results.',
+              lambda: process.stats()['bytes']),
+        Gauge('tk_upstream_target_outstanding',
+              'The number of outstanding Sourcebox requests, by target.',
+              lambda: {(name, ): target['outstanding'] for name, target in process.stats()['targets'].items()},
+              ('target',)),
+        Gauge('tk_upstream_target_healthy',
+              'Whether a Sourcebox target\'s circuit is not open.',
+              lambda: {(name, ): int('open' != target['circuit']['state']) for name, target in process.stats()['targets'].items()},
+              ('target',)),
+    ]
+
+
+def exposition(gauges=()):
+    """
+    Renders all shared metrics and the given gauges.
+    :param gauges: An iterable of Gauge instances.
+    :return: The metrics in the Prometheus text exposition format.
+    """
+    return REGISTRY.render() + ''.join(gauge.render() for gauge in gauges)
@@ -1,68 +1,484 @@
+import time
 import uuid
-from queue import Queue
-from threading import Thread
+from threading import Lock, Timer
+
+from tk.cache import LruCache
+from tk.metrics import UPSTREAM_DURATION, UPSTREAM_RESPONSES
+from tk.scheduler import Scheduler
+from tk.store import MemoryResultStore, ResultSpool, SpilledResult
+from tk.upload import CHUNK_SIZE, Document, MultipartEncoder
+from tk.upstream import RetryPolicy, UpstreamPool, UpstreamTarget
 
 
 class Process:
 
     PROGRESS = 'PROGRESS'
+    DONE = 'DONE'
     ERROR_INTERNAL = 'AN_INTERNAL_ERROR_OCCURRED_AND_WE_ARE_SORRY_FOR_THE_INCONVENIENCE'
     ERROR_UPSTREAM = 'AN_UPSTREAM_ERROR_OCCURRED_AND_THEIR_SERVER_SAID_THEY_ARE_SORRY'
+    UPSTREAM_PARAMS = {
+        'useHttpErrorCodes': 'true',
+        'useJsonErrorMsg': 'true',
+    }
 
-    def __init__(self, session, sourcebox_url, sourcebox_account_name, sourcebox_user_name, sourcebox_password):
-        # Values are 2-tuples (user_name: str, result: str).
-        self._processes = {}
-        self._process_queue = Queue()
+    def __init__(self, session, sourcebox_url, sourcebox_account_name, sourcebox_user_name, sourcebox_password,
+                 store=None, profile_cache_size=1024, profile_cache_ttl=3600, scheduler=None,
+                 circuit_breaker=None, retry_policy=None, callback_dispatcher=None,
+                 result_spool_size=1024 * 1024, result_spool_directory=None, upstream_targets=None):
+        """
+        :param store: The ResultStore to keep processes in. Defaults to a
+          MemoryResultStore.
+        :param profile_cache_size: The maximum number of profiles to remember
+          for documents that are submitted again, or 0 to disable this.
+        :param profile_cache_ttl: The number of seconds to remember profiles
+          for.
+        :param scheduler: The Scheduler to send documents to Sourcebox through.
+          Defaults to a Scheduler with default limits.
+        :param circuit_breaker: The CircuitBreaker guarding Sourcebox, if
+          there are no upstream targets. Defaults to a CircuitBreaker with
+          default limits.
+        :param retry_policy: The RetryPolicy for failed Sourcebox requests.
+          Defaults to a RetryPolicy with default limits.
+        :param callback_dispatcher: The CallbackDispatcher to push results to
+          callback URLs with, or None to not support callback URLs.
+        :param result_spool_size: The size in bytes above which to spill
+          Sourcebox responses to temporary files instead of keeping them in
+          memory.
+        :param result_spool_directory: The directory to spill Sourcebox
+          responses to, or None for the system default.
+        :param upstream_targets: A list of UpstreamTarget instances to spread
+          documents over, which must all produce the same profiles. Defaults
+          to a single target for the Sourcebox URL and credentials.
+        """
+        self._store = MemoryResultStore() if store is None else store
+        self._scheduler = Scheduler() if scheduler is None else scheduler
+        self._retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        self._callback_dispatcher = callback_dispatcher
+        self._result_spool_size = result_spool_size
+        self._result_spool_directory = result_spool_directory
+        # Keys are process IDs, values are the URLs to push their results to.
+        self._callback_urls = {}
+        # Keys are 2-tuples (upstream_key: tuple, document_digest: str), with
+        # the URLs and account names of all Sourcebox targets as the upstream
+        # key, values are profiles.
+        self._profiles = LruCache(profile_cache_size) if profile_cache_size else None
+        self._profile_cache_ttl = profile_cache_ttl
+        # Keys are the same as self._profiles', values are lists of the IDs of
+        # the processes waiting for the upstream request for that document.
+        self._in_flight = {}
+        # Keys are the IDs of processes waiting for upstream requests, values
+        # are the keys of the documents they are waiting for.
+        self._in_flight_process_documents = {}
+        self._in_flight_lock = Lock()
+        # Keys are document keys, values are the times their current upstream
+        # requests started.
+        self._upstream_start_times = {}
         self._session = session
-        self._sourcebox_url = sourcebox_url
-        self._sourcebox_account_name = sourcebox_account_name
-        self._sourcebox_user_name = sourcebox_user_name
-        self._sourcebox_password = sourcebox_password
-
-        worker = Thread(target=self._process_queue_worker,
-                        args=(self._process_queue,))
-        worker.setDaemon(True)
-        worker.start()
-
-    def _process_queue_worker(self, queue):
-        while True:
-            process_id, profile = queue.get()
-            self._processes[process_id] = (
-                self._processes[process_id][0], profile)
-            queue.task_done()
-
-    def submit(self, user_name, document):
+        if upstream_targets is None:
+            upstream_targets = [UpstreamTarget(
+                sourcebox_url, sourcebox_account_name, sourcebox_user_name,
+                sourcebox_password, circuit_breaker=circuit_breaker)]
+        self._upstream = UpstreamPool(upstream_targets)
+        # Profiles are reused across targets, so they are cached under all of
+        # them, in any order.
+        self._upstream_key = tuple(sorted(
+            (target.url, target.account_name or '') for target in upstream_targets))
+
+    def stats(self):
+        """
+        Gets statistics about the stored processes.
+        :return: See ResultStore.stats(), with the addition of 'in_flight',
+          the number of documents queued for or awaiting a Sourcebox response,
+          and 'scheduler', 'targets', and 'retries', which contain
+          Scheduler.stats(), UpstreamPool.stats(), and RetryPolicy.stats()
+          respectively.
+        """
+        stats = self._store.stats()
+        stats['in_flight'] = len(self._in_flight)
+        stats['scheduler'] = self._scheduler.stats()
+        stats['targets'] = self._upstream.stats()
+        stats['retries'] = self._retry_policy.stats()
+        return stats
+
+    def submit(self, user_name, document, callback_url=None):
+        """
+        Submits a document for processing.
+        :param user_name: The name of the user submitting the document.
+        :param document: The document as bytes or a Document. Documents are
+          closed once they have been uploaded.
+        :param callback_url: The URL to push the result to once the process
+          finishes, if any. This requires a callback dispatcher.
+        :return: The process ID.
+        :raises QueueFull: If too many documents are waiting to be sent to
+          Sourcebox already.
+        """
+        if isinstance(document, bytes):
+            document = Document.from_bytes(document)
         process_id = str(uuid.uuid4())
-        self._processes[process_id] = (user_name, self.PROGRESS)
-        self._session.post(self._sourcebox_url, data={
-            'account': self._sourcebox_account_name,
-            'username': self._sourcebox_user_name,
-            'password': self._sourcebox_password,
-        }, files={
-            'uploaded_file': document,
-        }, params={
-            'useHttpErrorCodes': 'true',
-            'useJsonErrorMsg': 'true',
-        }, background_callback=self._handle_submit_response(process_id))
+
+        # Identical documents produce identical profiles, so rather than
+        # submitting a document again, reuse its profile or attach to the
+        # upstream request that is already underway.
+        document_key = (self._upstream_key, document.digest)
+        with self._in_flight_lock:
+            profile = None if self._profiles is None else self._profiles.get(
+                document_key)
+            attach = profile is None and document_key in self._in_flight
+            if profile is None and not attach:
+                try:
+                    self._scheduler.admit()
+                except BaseException:
+                    document.close()
+                    raise
+                self._in_flight[document_key] = []
+            self._store.add(process_id, user_name)
+            if callback_url is not None:
+                self._callback_urls[process_id] = callback_url
+            if profile is None:
+                self._in_flight[document_key].append(process_id)
+                self._in_flight_process_documents[process_id] = document_key
+        if profile is not None:
+            document.close()
+            self._deliver(process_id, profile)
+            return process_id
+        if attach:
+            document.close()
+            return process_id
+
+        self._retry_policy.record_request()
+        self._scheduler.submit(user_name, document_key,
+                               lambda: self._attempt(document_key, document, 0))
         return process_id
 
-    def _handle_submit_response(self, process_id):
-        queue = self._process_queue
+    def queue_position(self, process_id):
+        """
+        Gets the position of a process waiting to be sent to Sourcebox.
+        :param process_id:
+        :return: See Scheduler.position(), or None if the process is not
+          queued.
+        """
+        document_key = self._in_flight_process_documents.get(process_id)
+        if document_key is None:
+            return None
+        return self._scheduler.position(document_key)
+
+    def _build_upstream_body(self, target, document):
+        """
+        Builds the body of a Sourcebox request.
+        :param target: The UpstreamTarget to submit the document to.
+        :param document: The Document to submit.
+        :return: MultipartEncoder
+        """
+        return MultipartEncoder({
+            'account': target.account_name,
+            'username': target.user_name,
+            'password': target.password,
+        }, 'uploaded_file', document)
 
-        def _handler(session, response):
-            if 400 <= response.status_code < 500:
-                result = self.ERROR_INTERNAL
-            elif 500 <= response.status_code < 600:
-                result = self.ERROR_UPSTREAM
-            else:
-                result = response.text
-            queue.put((process_id, result))
+    def _attempt(self, document_key, document, attempt):
+        """
+        Sends a document to the least busy healthy Sourcebox target, or fails
+        it if no target is healthy.
+        :param document_key: The document's key.
+        :param document: The Document to send.
+        :param attempt: The number of times the document has been sent before.
+        :return:
+        """
+        def _dispatch(target):
+            if target is None:
+                document.close()
+                self._abandon(document_key)
+                return
+            self._upstream_start_times[document_key] = time.monotonic()
+            self._send(target, document_key, document, attempt)
+        self._upstream.acquire(_dispatch)
+
+    def _send(self, target, document_key, document, attempt):
+        """
+        Sends a document to Sourcebox.
+
+        Once the upstream request finishes, self._handle_upstream_response()
+        must be called.
+        :param target: The UpstreamTarget to send the document to.
+        :param document_key: The document's key.
+        :param document: The Document to send.
+        :param attempt: The number of times the document has been sent before.
+        :return:
+        """
+        body = self._build_upstream_body(target, document)
+        # Stream the response, so large profiles are never held in memory at
+        # once.
+        future = self._session.post(target.url, data=body, headers={
+            'Content-Type': body.content_type,
+        }, params=self.UPSTREAM_PARAMS, stream=True)
+        future.add_done_callback(self._handle_submit_completion(
+            target, document_key, document, attempt))
+
+    def _handle_submit_completion(self, target, document_key, document, attempt):
+        def _handler(future):
+            status_code = body = None
+            if future.exception() is None:
+                response = future.result()
+                try:
+                    body = self._read_upstream_body(response)
+                    status_code = response.status_code
+                # requests' exceptions are OSErrors.
+                except OSError:
+                    pass
+                finally:
+                    response.close()
+            self._handle_upstream_response(target, document_key, document,
+                                           attempt, status_code, body)
         return _handler
 
+    def _spool_result(self, encoding):
+        """
+        Starts copying an upstream response body.
+        :param encoding: The body's character encoding.
+        :return: ResultSpool
+        """
+        return ResultSpool(encoding, self._result_spool_size,
+                           self._result_spool_directory)
+
+    def _read_upstream_body(self, response):
+        """
+        Reads a streamed upstream response body.
+        :param response: A requests.Response.
+        :return: The body as a str, or a SpilledResult.
+        """
+        spool = self._spool_result(response.encoding or 'utf-8')
+        try:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                spool.write(chunk)
+        except BaseException:
+            spool.discard()
+            raise
+        return spool.finish()
+
+    def _handle_upstream_response(self, target, document_key, document, attempt, status_code, body):
+        """
+        Handles the outcome of an upstream request, and retries it if needed.
+        :param target: The UpstreamTarget the document was sent to.
+        :param document_key: The document's key.
+        :param document: The Document that was sent.
+        :param attempt: The number of times the document had been sent before.
+        :param status_code: The upstream response's HTTP status code, or None
+          if there is no response.
+        :param body: The upstream response body as a str or a SpilledResult,
+          or None if there is no response.
+        :return:
+        """
+        UPSTREAM_DURATION.observe(
+            time.monotonic() - self._upstream_start_times.pop(document_key))
+        UPSTREAM_RESPONSES.inc('error' if status_code is None else str(status_code))
+        failed = status_code is None or 500 <= status_code < 600
+        self._upstream.release(target, not failed)
+        if failed and isinstance(body, SpilledResult):
+            body.delete()
+        if failed:
+            delay = self._retry_policy.retry(attempt)
+            if delay is not None:
+                self._call_later(delay, lambda: self._attempt(
+                    document_key, document, attempt + 1))
+                return
+        document.close()
+        if status_code is None:
+            self._abandon(document_key)
+        else:
+            self._finish(document_key, status_code, body)
+
+    def _call_later(self, delay, callback):
+        """
+        Calls a callback after a delay, without blocking.
+        :param delay: The number of seconds to wait for.
+        :param callback: A callable without arguments.
+        :return:
+        """
+        timer = Timer(delay, callback)
+        timer.daemon = True
+        timer.start()
+
+    def _finish(self, document_key, status_code, body):
+        """
+        Finishes the processes waiting for a document's upstream response.
+        :param document_key: The document's key.
+        :param status_code: The upstream response's HTTP status code.
+        :param body: The upstream response body as a str or a SpilledResult.
+        :return:
+        """
+        if 400 <= status_code < 500:
+            result = self.ERROR_INTERNAL
+        elif 500 <= status_code < 600:
+            result = self.ERROR_UPSTREAM
+        else:
+            result = body
+        if result is not body and isinstance(body, SpilledResult):
+            body.delete()
+        # Release the job while the document is still in flight, so it cannot
+        # be scheduled again under the same job ID before it is released.
+        self._scheduler.release(document_key)
+        with self._in_flight_lock:
+            # Spilled results are too large to cache in memory.
+            if self._profiles is not None and isinstance(result, str) and result not in (self.ERROR_INTERNAL, self.ERROR_UPSTREAM):
+                self._profiles.set(document_key, result,
+                                   time.time() + self._profile_cache_ttl)
+            process_ids = self._in_flight.pop(document_key)
+            for process_id in process_ids:
+                del self._in_flight_process_documents[process_id]
+        if isinstance(result, SpilledResult):
+            # Every process owns its spilled result, so link them all before
+            # any of them can be retrieved and deleted.
+            results = [result.link() for _ in process_ids[1:]]
+            if process_ids:
+                results.insert(0, result)
+            else:
+                result.delete()
+        else:
+            results = [result] * len(process_ids)
+        for process_id, process_result in zip(process_ids, results):
+            self._deliver(process_id, process_result)
+
+    def _abandon(self, document_key):
+        """
+        Fails the processes waiting for a document's upstream request, if the
+        request could not be sent or got no response.
+        :param document_key: The document's key.
+        :return:
+        """
+        # See self._finish().
+        self._scheduler.release(document_key)
+        with self._in_flight_lock:
+            process_ids = self._in_flight.pop(document_key, ())
+            for process_id in process_ids:
+                del self._in_flight_process_documents[process_id]
+        for process_id in process_ids:
+            self._deliver(process_id, self.ERROR_UPSTREAM)
+
+    def _deliver(self, process_id, result):
+        """
+        Stores a process' result, and pushes it to its callback URL, if any.
+        :param process_id:
+        :param result: The result as a str or a SpilledResult, which the store
+          takes ownership of.
+        :return:
+        """
+        callback_url = self._callback_urls.pop(process_id, None)
+        # The result may be retrieved and deleted before it is pushed, so the
+        # callback gets its own.
+        callback_result = result.link() if callback_url is not None and isinstance(result, SpilledResult) else result
+        self._store.complete(process_id, result)
+        if callback_url is not None:
+            content_type = 'text/plain' if result in (self.ERROR_INTERNAL, self.ERROR_UPSTREAM) else 'text/xml'
+            # Once the result has been pushed, there is no need to keep it
+            # around for /retrieve.
+            self._callback_dispatcher.deliver(
+                callback_url, process_id, callback_result, content_type,
+                lambda: self._discard(process_id))
+
+    def _discard(self, process_id):
+        """
+        Deletes a finished process.
+        :param process_id:
+        :return:
+        """
+        process = self._store.retrieve(process_id)
+        if process is not None and isinstance(process[1], SpilledResult):
+            process[1].delete()
+
+    def wait(self, process_id, timeout):
+        """
+        Blocks until a process has finished.
+        :param process_id:
+        :param timeout: The maximum number of seconds to wait for.
+        :return: Whether the process has finished, or does not exist.
+        """
+        return self._store.wait(process_id, timeout)
+
     def retrieve(self, process_id):
-        if process_id not in self._processes:
+        """
+        Retrieves a process, and deletes it if it has finished.
+
+        The caller takes ownership of spilled results, and must delete them.
+        :param process_id:
+        :return: A 2-tuple (user_name: str, result: Union[str,
+          SpilledResult]), or None if the process does not exist.
+        """
+        return self._result(self._store.retrieve(process_id))
+
+    def peek(self, process_id):
+        """
+        Retrieves a process without deleting it.
+
+        Spilled results may be deleted at any time, by whoever retrieves the
+        process.
+        :param process_id:
+        :return: A 2-tuple (user_name: str, result: Union[str,
+          SpilledResult]), or None if the process does not exist.
+        """
+        return self._result(self._store.peek(process_id))
+
+    def _result(self, process):
+        if process is None:
             return None
-        process = self._processes[process_id]
-        if self.PROGRESS != process[1]:
-            del self._processes[process_id]
-        return process
+        user_name, result = process
+        return user_name, self.PROGRESS if result is None else result
+
+    def _status(self, user_name, process_id):
+        """
+        Gets a process' status, without reading its profile.
+        :param user_name: The name of the user retrieving the process.
+        :param process_id:
+        :return: self.PROGRESS, self.DONE, an error, or None if the process
+          does not exist or is owned by another user.
+        """
+        status = self._store.status(process_id)
+        if status is None or user_name != status[0]:
+            return None
+        size = status[1]
+        if size is None:
+            return self.PROGRESS
+        # Errors are short, so only short results need to be read to tell
+        # them apart from profiles.
+        if size <= max(len(self.ERROR_INTERNAL), len(self.ERROR_UPSTREAM)):
+            process = self._store.peek(process_id)
+            if process is None:
+                return None
+            if process[1] in (self.ERROR_INTERNAL, self.ERROR_UPSTREAM):
+                return process[1]
+        return self.DONE
+
+    def retrieve_many(self, user_name, process_ids, delete=True):
+        """
+        Retrieves a user's processes.
+        :param user_name: The name of the user retrieving the processes.
+          Processes owned by other users are treated as if they do not exist.
+        :param process_ids: An iterable of process IDs.
+        :param delete: Whether to delete finished processes, as retrieve() does.
+          If not, profiles are not read, and yielded as self.DONE.
+        :return: An iterable of 2-tuples (process_id: str, result: str), with a
+          None result if the process does not exist. Spilled results are read
+          into memory one at a time.
+        """
+        for process_id in process_ids:
+            if not delete:
+                yield process_id, self._status(user_name, process_id)
+                continue
+            process = self._store.peek(process_id)
+            if process is not None and user_name != process[0]:
+                process = None
+            elif process is not None and process[1] is not None and delete:
+                # Another request may have retrieved the process since.
+                process = self._store.retrieve(process_id)
+            if process is not None and isinstance(process[1], SpilledResult):
+                spilled_result = process[1]
+                try:
+                    process = process[0], spilled_result.read()
+                except FileNotFoundError:
+                    # Another request retrieved the process since we peeked.
+                    process = None
+                if delete:
+                    spilled_result.delete()
+            if process is None:
+                yield process_id, None
+            else:
+                yield process_id, self.PROGRESS if process[1] is None else process[1]
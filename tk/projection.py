@@ -0,0 +1,268 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+from xml.etree.ElementTree import XMLPullParser
+
+from tk.cache import LruCache
+from tk.store import SpilledResult, result_size
+
+# The number of characters to feed the XML parser at once.
+_FEED_SIZE = 65536
+
+
+class InvalidFields(ValueError):
+    pass
+
+
+def parse_fields(fields):
+    """
+    Parses a ?fields= selector.
+    :param fields: A comma-separated list of paths of elements below the
+      profile's root element, with path segments separated by slashes, such as
+      'FirstName,Address/City'. None or an empty string selects all elements.
+    :return: A tuple of paths, each a tuple of element names, or None to select
+      all elements.
+    :raises InvalidFields: If the selector is malformed.
+    """
+    if not fields:
+        return None
+    paths = []
+    for field in fields.split(','):
+        path = tuple(field.strip().split('/'))
+        if not all(path):
+            raise InvalidFields('"%s" is not a valid field.' % field)
+        if path not in paths:
+            paths.append(path)
+    return tuple(paths)
+
+
+def _local_name(tag):
+    """
+    Strips the namespace from an element's tag.
+    """
+    return tag.rsplit('}', 1)[-1]
+
+
+class _Node:
+    __slots__ = ('attributes', 'children')
+
+    def __init__(self, attributes):
+        self.attributes = attributes
+        # A dictionary of lists of converted child elements, keyed by name.
+        self.children = {}
+
+    def value(self, text):
+        if not self.children and not self.attributes:
+            return text
+        value = {}
+        for name, attribute in self.attributes.items():
+            value['@' + _local_name(name)] = attribute
+        for name, children in self.children.items():
+            value[name] = children[0] if 1 == len(children) else children
+        if not self.children and text:
+            value['#text'] = text
+        return value
+
+
+def project(profile, fields=None):
+    """
+    Converts (part of) an XML profile to JSON.
+
+    The profile is parsed as a stream, and only the selected elements are
+    built. Elements with child elements or attributes become objects, with
+    attributes prefixed by '@', other elements become strings, and repeated
+    elements become arrays.
+    :param profile: The XML profile as a str or a SpilledResult.
+    :param fields: The selected paths, as parse_fields() returns them.
+    :return: The JSON as a str.
+    :raises xml.etree.ElementTree.ParseError: If the profile is malformed.
+    """
+    if isinstance(profile, SpilledResult):
+        with profile.open() as file:
+            return _project(iter(lambda: file.read(_FEED_SIZE), b''), fields)
+    return _project((profile[offset:offset + _FEED_SIZE]
+                     for offset in range(0, len(profile), _FEED_SIZE)), fields)
+
+
+def _project(chunks, fields):
+    """
+    Converts (part of) an XML profile to JSON.
+    :param chunks: An iterable of chunks of the profile, as str or bytes.
+    :param fields: The selected paths, as parse_fields() returns them.
+    :return: The JSON as a str.
+    """
+    prefixes = set()
+    if fields is not None:
+        for path in fields:
+            prefixes.update(path[:length] for length in range(1, len(path)))
+    parser = XMLPullParser(('start', 'end'))
+    # A list of 3-tuples (path: tuple, node: Optional[_Node], selected: bool)
+    # for the open elements.
+    stack = []
+    root = None
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if 'start' == event:
+                if not stack:
+                    root = _Node({})
+                    stack.append(((), root, fields is None))
+                    continue
+                parent_path, parent, parent_selected = stack[-1]
+                path = parent_path + (_local_name(element.tag),)
+                selected = parent_selected or path in fields
+                if parent is not None and (selected or path in prefixes):
+                    node = _Node(dict(element.attrib) if selected else {})
+                else:
+                    node = None
+                stack.append((path, node, selected))
+                continue
+            path, node, _ = stack.pop()
+            if stack and node is not None:
+                parent = stack[-1][1]
+                # Skip paths that lead to no selected elements.
+                if node.children or stack[-1][2] or path in fields:
+                    text = (element.text or '').strip()
+                    parent.children.setdefault(path[-1], []).append(
+                        node.value(text))
+            # Free the parsed element, because we built our own.
+            element.clear()
+    parser.close()
+    return json.dumps(root.value('') or {})
+
+
+class ProfileProjector:
+    """
+    Converts profiles to JSON off the request threads.
+
+    Large profiles are converted in a pool of worker processes, so the
+    conversion does not hold the GIL that request threads need. Converted
+    profiles are cached by their content, so profiles for duplicate documents
+    are converted only once per selector, for as long as their processes are
+    stored. Call forget() once a process is deleted.
+    """
+
+    def __init__(self, workers=None, min_pool_size=65536, cache_size=256):
+        """
+        :param workers: The number of worker processes, None for one per CPU,
+          or 0 to convert profiles on the calling thread.
+        :param min_pool_size: The size in characters below which to convert
+          profiles on the calling thread, because sending them to a worker
+          costs more than converting them.
+        :param cache_size: The maximum number of profiles to cache
+          conversions of, or 0 to disable caching.
+        """
+        self._workers = workers
+        self._min_pool_size = min_pool_size
+        self._cache = LruCache(cache_size) if cache_size else None
+        self._executor = None
+        self._executor_lock = Lock()
+
+    def _get_executor(self, profile):
+        """
+        Gets the worker pool to convert a profile in.
+        :return: A ProcessPoolExecutor, or None to convert the profile on the
+          calling thread.
+        """
+        if 0 == self._workers or result_size(profile) < self._min_pool_size:
+            return None
+        with self._executor_lock:
+            if self._executor is None:
+                # Forking a multithreaded server may copy locks that other
+                # threads hold, so start fresh interpreters instead.
+                self._executor = ProcessPoolExecutor(
+                    self._workers, multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _cache_key(self, profile):
+        if self._cache is None or isinstance(profile, SpilledResult):
+            return None
+        return hashlib.sha1(profile.encode('utf-8')).digest()
+
+    def _get_cached(self, key, fields):
+        if key is None:
+            return None
+        return self._cache.get(key, {}).get(fields)
+
+    def _set_cached(self, key, fields, projection):
+        if key is None:
+            return
+        # Values are dictionaries of projections keyed by selector, which are
+        # replaced rather than changed, so concurrent readers need no lock.
+        projections = dict(self._cache.get(key, {}))
+        projections[fields] = projection
+        self._cache.set(key, projections)
+
+    def forget(self, profile):
+        """
+        Removes a profile's cached conversions, because its process was
+        deleted.
+        :param profile: The XML profile as a str or a SpilledResult.
+        :return:
+        """
+        key = self._cache_key(profile)
+        if key is not None:
+            self._cache.delete(key)
+
+    def project(self, profile, fields=None):
+        """
+        Converts a profile to JSON.
+        :param profile: The XML profile as a str or a SpilledResult.
+        :param fields: The selected paths, as parse_fields() returns them.
+        :return: The JSON as a str.
+        :raises xml.etree.ElementTree.ParseError: If the profile is malformed.
+        """
+        key = self._cache_key(profile)
+        projection = self._get_cached(key, fields)
+        if projection is None:
+            executor = self._get_executor(profile)
+            if executor is None:
+                projection = project(profile, fields)
+            else:
+                projection = executor.submit(project, profile, fields).result()
+            self._set_cached(key, fields, projection)
+        return projection
+
+    async def project_async(self, profile, fields=None):
+        """
+        Converts a profile to JSON without blocking the event loop.
+        :param profile: The XML profile as a str or a SpilledResult.
+        :param fields: The selected paths, as parse_fields() returns them.
+        :return: The JSON as a str.
+        :raises xml.etree.ElementTree.ParseError: If the profile is malformed.
+        """
+        key = self._cache_key(profile)
+        projection = self._get_cached(key, fields)
+        if projection is None:
+            executor = self._get_executor(profile)
+            if executor is None:
+                projection = project(profile, fields)
+            else:
+                projection = await asyncio.wrap_future(
+                    executor.submit(project, profile, fields))
+            self._set_cached(key, fields, projection)
+        return projection
+
+    def close(self):
+        """
+        Stops the worker processes.
+        :return:
+        """
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+def build_profile_projector(config):
+    """
+    Builds the configured profile projector.
+    :param config: The application configuration.
+    :return: ProfileProjector
+    """
+    return ProfileProjector(config['PROJECTION_WORKERS'],
+                            config['PROJECTION_POOL_MIN_SIZE'],
+                            config['PROJECTION_CACHE_SIZE'])
@@ -0,0 +1,226 @@
+import math
+import time
+from collections import OrderedDict, deque
+from threading import Lock, local
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after):
+        """
+        :param retry_after: The estimated number of seconds until there is room
+          in the queue.
+        """
+        super().__init__()
+        self.retry_after = retry_after
+
+
+class Scheduler:
+    """
+    Limits the number of concurrent upstream requests.
+
+    Requests that cannot start immediately are queued per user, and the queues
+    are served using weighted round-robin, so no single user can hold up
+    everyone else.
+    """
+
+    def __init__(self, max_in_flight=32, max_queue_depth=10000, user_weights=None, clock=time.monotonic):
+        """
+        :param max_in_flight: The maximum number of requests to run at once.
+        :param max_queue_depth: The maximum number of requests to queue.
+        :param user_weights: A dictionary of the number of requests users may
+          start per round, keyed by user name. Users default to 1.
+        :param clock: A callable returning the current time in seconds.
+        """
+        self._max_in_flight = max_in_flight
+        self._max_queue_depth = max_queue_depth
+        self._user_weights = user_weights or {}
+        self._clock = clock
+        # Keys are user names, values are deques of 2-tuples (job_id, job). The
+        # first user is the one whose turn it is.
+        self._queues = OrderedDict()
+        # The number of jobs the current user may still start this round.
+        self._credits = 0
+        self._queue_depth = 0
+        # Keys are job IDs, values are the times the jobs started.
+        self._running = {}
+        # An exponentially weighted moving average of job durations in seconds.
+        self._average_duration = 1.0
+        self._lock = Lock()
+        # Per thread, the deque of jobs waiting to be run by the outermost
+        # _run() call, or None if the thread is not running jobs.
+        self._local = local()
+
+    def admit(self):
+        """
+        Checks there is room for another job.
+        :return:
+        :raises QueueFull: If the queue is full.
+        """
+        if len(self._running) >= self._max_in_flight and self._queue_depth >= self._max_queue_depth:
+            raise QueueFull(self._estimate_wait(self._queue_depth))
+
+    def submit(self, user_name, job_id, job):
+        """
+        Runs a job, or queues it if too many jobs are running already.
+
+        Once a job finishes, release() must be called.
+        :param user_name: The name of the user the job is for.
+        :param job_id: A unique, hashable job ID.
+        :param job: The job to run, as a callable without arguments.
+        :return:
+        """
+        with self._lock:
+            if len(self._running) >= self._max_in_flight:
+                self._queues.setdefault(user_name, deque()).append(
+                    (job_id, job))
+                self._queue_depth += 1
+                return
+            self._running[job_id] = self._clock()
+        self._run(job)
+
+    def release(self, job_id):
+        """
+        Marks a job as finished, and starts the next queued job, if any.
+        :param job_id:
+        :return:
+        """
+        with self._lock:
+            started = self._running.pop(job_id, None)
+            if started is not None:
+                self._average_duration = 0.9 * self._average_duration + 0.1 * (self._clock() - started)
+            if not self._queues or len(self._running) >= self._max_in_flight:
+                return
+            next_job_id, next_job = self._next()
+            self._running[next_job_id] = self._clock()
+        self._run(next_job)
+
+    def _run(self, job):
+        """
+        Runs a job.
+
+        Jobs that finish synchronously, such as those abandoned because every
+        upstream circuit is open, release their slots and start the next jobs
+        from within themselves. Such nested jobs are run by the outermost call
+        in a loop instead, so draining a long queue does not recurse.
+        :param job:
+        :return:
+        """
+        pending = getattr(self._local, 'pending', None)
+        if pending is not None:
+            pending.append(job)
+            return
+        pending = self._local.pending = deque([job])
+        error = None
+        try:
+            while pending:
+                try:
+                    pending.popleft()()
+                except Exception as e:
+                    # Keep running the remaining jobs, as they hold slots.
+                    error = error or e
+        finally:
+            self._local.pending = None
+        if error is not None:
+            raise error
+
+    def _next(self):
+        """
+        Takes the next job from the queues.
+
+        The lock must be held when calling this method.
+        :return: A 2-tuple (job_id, job).
+        """
+        user_name, queue = next(iter(self._queues.items()))
+        if not self._credits:
+            self._credits = self._user_weights.get(user_name, 1)
+        job = queue.popleft()
+        self._queue_depth -= 1
+        self._credits -= 1
+        if not queue:
+            del self._queues[user_name]
+            self._credits = 0
+        elif not self._credits:
+            self._queues.move_to_end(user_name)
+        return job
+
+    def position(self, job_id):
+        """
+        Gets a queued job's position.
+        :param job_id:
+        :return: A 2-tuple (position: int, estimated_wait: int) with the
+          estimated number of jobs that will start before it, and the estimated
+          number of seconds until it starts, or None if the job is not queued.
+        """
+        with self._lock:
+            for user_name, queue in self._queues.items():
+                for index, (queued_job_id, _) in enumerate(queue):
+                    if queued_job_id == job_id:
+                        return self._position(user_name, index)
+        return None
+
+    def _position(self, user_name, index):
+        """
+        Estimates the number of jobs that will start before a queued job.
+
+        The lock must be held when calling this method.
+        :param user_name: The name of the user the job is for.
+        :param index: The job's index in the user's queue.
+        :return: See position().
+        """
+        weight = self._user_weights.get(user_name, 1)
+        rounds = index // weight + 1
+        position = index
+        # Users ahead of this user in the rotation get one more turn.
+        other_rounds = rounds
+        for other_user_name, queue in self._queues.items():
+            if other_user_name == user_name:
+                other_rounds = rounds - 1
+                continue
+            position += min(len(queue), other_rounds * self._user_weights.get(other_user_name, 1))
+        return position, self._estimate_wait(position)
+
+    def _estimate_wait(self, position):
+        """
+        Estimates the number of seconds until a queued job starts.
+        :param position: The number of jobs that will start before it.
+        :return: int
+        """
+        return int(math.ceil((position + 1) * self._average_duration / self._max_in_flight))
+
+    def stats(self):
+        """
+        Gets the scheduler's current load.
+        :return: A dictionary with the number of jobs running and queued, and
+          the number of users with queued jobs.
+        """
+        with self._lock:
+            return {
+                'running': len(self._running),
+                'queued': self._queue_depth,
+                'queued_users': len(self._queues),
+            }
+
+
+def build_scheduler(config):
+    """
+    Builds the configured upstream request scheduler.
+    :param config: The application configuration.
+    :return: Scheduler
+    """
+    return Scheduler(config['UPSTREAM_MAX_IN_FLIGHT'],
+                     config['UPSTREAM_MAX_QUEUE_DEPTH'],
+                     config['UPSTREAM_USER_WEIGHTS'])
+
+
+def queue_position_headers(position):
+    """
+    Builds the HTTP response headers describing a queued process.
+    :param position: The return value of Process.queue_position().
+    :return: A dictionary of headers.
+    """
+    if position is None:
+        return {}
+    return {
+        'X-Queue-Position': str(position[0]),
+        'Retry-After': str(position[1]),
+    }
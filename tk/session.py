@@ -0,0 +1,78 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.adapters import HTTPAdapter
+from requests_futures.sessions import FuturesSession
+
+
+class UpstreamSession(FuturesSession):
+    """
+    An asynchronous HTTP session with a sized executor and connection pool.
+    """
+
+    def __init__(self, executor_workers=32, pool_connections=10,
+                 pool_maxsize=32, keep_alive=True, connect_timeout=5,
+                 read_timeout=120):
+        """
+        :param executor_workers: The number of threads to perform requests in.
+        :param pool_connections: The number of hosts to keep connection pools
+          for.
+        :param pool_maxsize: The maximum number of connections to keep per
+          host.
+        :param keep_alive: Whether to reuse connections across requests.
+        :param connect_timeout: The number of seconds to wait for a connection
+          to be established.
+        :param read_timeout: The number of seconds to wait for a response.
+        """
+        super().__init__(executor=ThreadPoolExecutor(
+            max_workers=executor_workers))
+        self._executor_workers = executor_workers
+        self._adapter = HTTPAdapter(pool_connections=pool_connections,
+                                    pool_maxsize=pool_maxsize)
+        self.mount('http://', self._adapter)
+        self.mount('https://', self._adapter)
+        if not keep_alive:
+            self.headers['Connection'] = 'close'
+        self._timeout = (connect_timeout, read_timeout)
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault('timeout', self._timeout)
+        return super().request(*args, **kwargs)
+
+    def close(self):
+        """
+        Closes the connection pool, and stops the executor once its pending
+        requests are done.
+        :return:
+        """
+        super().close()
+        self.executor.shutdown(wait=False)
+
+    def stats(self):
+        """
+        Gets the live executor and connection pool usage.
+        :return: A dictionary with the executor's worker count and queue depth,
+          and per-host connection pool usage keyed by origin.
+        """
+        pools = {}
+        pool_manager = self._adapter.poolmanager
+        for pool_key in pool_manager.pools.keys():
+            pool = pool_manager.pools.get(pool_key)
+            if pool is None or pool.pool is None:
+                continue
+            # Connection pool queues are pre-filled with None placeholders, so
+            # any missing item is a connection that is currently in use.
+            connections = list(pool.pool.queue)
+            origin = '%s://%s:%s' % (pool.scheme, pool.host, pool.port)
+            pools[origin] = {
+                'maxsize': pool.pool.maxsize,
+                'in_use': pool.pool.maxsize - len(connections),
+                'idle': sum(1 for connection in connections
+                            if connection is not None),
+                'connections_created': pool.num_connections,
+                'requests': pool.num_requests,
+            }
+        return {
+            'executor_workers': self._executor_workers,
+            'executor_queue_depth': self.executor._work_queue.qsize(),
+            'pools': pools,
+        }
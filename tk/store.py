@@ -0,0 +1,903 @@
+import codecs
+import os
+import shutil
+import sqlite3
+import sys
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile
+from threading import Event, Lock, Thread, local
+
+# The number of bytes to read from spilled results at once.
+CHUNK_SIZE = 64 * 1024
+
+
+class SpilledResult:
+    """
+    A result that is too large to keep in memory, in a file of UTF-8 encoded
+    XML.
+
+    Whoever holds a spilled result owns its file, and must delete() it once
+    it is no longer needed. Stores own the spilled results they complete
+    processes with, and hand ownership over when finished processes are
+    retrieved.
+    """
+
+    __slots__ = ('path', 'size')
+
+    def __init__(self, path, size):
+        """
+        :param path: The path to the file.
+        :param size: The file size in bytes.
+        """
+        self.path = path
+        self.size = size
+
+    def open(self):
+        """
+        Opens the result for reading.
+
+        The returned file remains readable after the result is deleted.
+        :return: A binary file.
+        :raises FileNotFoundError: If the result has been deleted.
+        """
+        return open(self.path, 'rb')
+
+    def read(self):
+        """
+        Reads the entire result into memory.
+        :return: str
+        :raises FileNotFoundError: If the result has been deleted.
+        """
+        with self.open() as file:
+            return file.read().decode('utf-8')
+
+    def link(self):
+        """
+        Shares the result with another owner, without copying it if possible.
+        :return: A SpilledResult with its own file.
+        """
+        path = '%s-%s' % (self.path, uuid.uuid4().hex[:8])
+        try:
+            os.link(self.path, path)
+        except OSError:
+            shutil.copyfile(self.path, path)
+        return SpilledResult(path, self.size)
+
+    def delete(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def result_size(result):
+    """
+    Gets the size of a result once it is encoded as UTF-8.
+    :param result: The result as a str or a SpilledResult.
+    :return: The size in bytes.
+    """
+    if isinstance(result, SpilledResult):
+        return result.size
+    return len(result.encode('utf-8'))
+
+
+class ResultSpool:
+    """
+    Copies an upstream response body in chunks, and spills it to a temporary
+    file once it becomes too large to keep in memory.
+    """
+
+    def __init__(self, encoding, spool_size, directory=None):
+        """
+        :param encoding: The body's character encoding.
+        :param spool_size: The size in bytes above which to spill the body to
+          a temporary file.
+        :param directory: The directory to create temporary files in, or None
+          for the system default.
+        """
+        try:
+            decoder = codecs.getincrementaldecoder(encoding)
+        except LookupError:
+            decoder = codecs.getincrementaldecoder('utf-8')
+        self._decoder = decoder('replace')
+        self._spool_size = spool_size
+        self._directory = directory
+        self._size = 0
+        # The decoded chunks, until the body is spilled.
+        self._chunks = []
+        self._file = None
+        self._file_size = 0
+
+    def write(self, chunk):
+        """
+        Appends a chunk to the body.
+        :param chunk: bytes
+        :return:
+        """
+        self._size += len(chunk)
+        self._write_text(self._decoder.decode(chunk))
+
+    @property
+    def size(self):
+        """
+        Gets the number of bytes written so far.
+        :return: int
+        """
+        return self._size
+
+    def _write_text(self, text):
+        if self._file is None:
+            self._chunks.append(text)
+            if self._size <= self._spool_size:
+                return
+            self._file = NamedTemporaryFile('wb', prefix='tk-result-',
+                                            suffix='.xml', dir=self._directory,
+                                            delete=False)
+            text = ''.join(self._chunks)
+            self._chunks = None
+        data = text.encode('utf-8')
+        self._file.write(data)
+        self._file_size += len(data)
+
+    def finish(self):
+        """
+        Finishes copying the body.
+        :return: The body as a str, or a SpilledResult if it was spilled.
+        """
+        self._write_text(self._decoder.decode(b'', True))
+        if self._file is None:
+            return ''.join(self._chunks)
+        self._file.close()
+        return SpilledResult(self._file.name, self._file_size)
+
+    def discard(self):
+        """
+        Discards the body, if copying it failed.
+        :return:
+        """
+        if self._file is not None:
+            self._file.close()
+            os.unlink(self._file.name)
+
+
+class ResultStore:
+    """
+    Stores process owners and results.
+
+    Processes are either in progress, in which case their result is None, or
+    finished. Finished processes are deleted once they are retrieved.
+    """
+
+    def add(self, process_id, user_name):
+        """
+        Adds a process that is in progress.
+        :param process_id:
+        :param user_name: The name of the user who owns the process.
+        :return:
+        """
+        raise NotImplementedError()
+
+    def complete(self, process_id, result):
+        """
+        Stores the result of a process in progress.
+        :param process_id:
+        :param result: The result as a str or a SpilledResult. The store takes
+          ownership of spilled results, and deletes them if they are not
+          stored.
+        :return: Whether the result was stored, which it is not if the process
+          no longer exists.
+        """
+        raise NotImplementedError()
+
+    def retrieve(self, process_id):
+        """
+        Retrieves a process, and deletes it if it has finished.
+
+        The caller takes ownership of spilled results.
+        :param process_id:
+        :return: A 2-tuple (user_name: str, result: Optional[Union[str,
+          SpilledResult]]), or None if the process does not exist.
+        """
+        raise NotImplementedError()
+
+    def peek(self, process_id):
+        """
+        Retrieves a process without deleting it.
+
+        The store keeps ownership of spilled results, so they may be deleted
+        at any time.
+        :param process_id:
+        :return: A 2-tuple (user_name: str, result: Optional[Union[str,
+          SpilledResult]]), or None if the process does not exist.
+        """
+        raise NotImplementedError()
+
+    def status(self, process_id):
+        """
+        Gets a process' status, without reading its result.
+        :param process_id:
+        :return: A 2-tuple (user_name: str, size: Optional[int]) with the
+          size of the UTF-8 encoded result in bytes, or None if the process is
+          in progress. Returns None if the process does not exist.
+        """
+        raise NotImplementedError()
+
+    def wait(self, process_id, timeout):
+        """
+        Blocks until a process has finished.
+        :param process_id:
+        :param timeout: The maximum number of seconds to wait for.
+        :return: Whether the process has finished, or does not exist.
+        """
+        raise NotImplementedError()
+
+    def stats(self):
+        """
+        Gets statistics about the stored processes.
+        :return: A dictionary with the number of processes in progress and
+          finished, the total size of the stored results in bytes, and the
+          number of evictions by reason.
+        """
+        raise NotImplementedError()
+
+
+class _MemoryProcess:
+    """
+    A process in a MemoryResultStore.
+    """
+
+    __slots__ = ('user_name', 'result', 'size')
+
+    def __init__(self, user_name):
+        self.user_name = user_name
+        # The zlib-compressed UTF-8 encoded result, a SpilledResult, or None
+        # if the process is in progress.
+        self.result = None
+        # The size of the UTF-8 encoded result in bytes.
+        self.size = None
+
+    def read(self):
+        if self.result is None or isinstance(self.result, SpilledResult):
+            return self.result
+        return zlib.decompress(self.result).decode('utf-8')
+
+
+def _memory_size(result):
+    """
+    Gets how much memory a stored result takes up.
+    :param result: The compressed result, or a SpilledResult.
+    :return: The size in bytes. Spilled results stay on disk, so they take up
+      none.
+    """
+    if isinstance(result, SpilledResult):
+        return 0
+    return sys.getsizeof(result)
+
+
+class _MemoryShard(ResultStore):
+    """
+    Stores a share of a MemoryResultStore's processes, behind a single lock.
+    """
+
+    def __init__(self, progress_ttl, result_ttl, max_entries, max_bytes, clock):
+        """
+        :param progress_ttl: The number of seconds after which to evict
+          processes that are still in progress.
+        :param result_ttl: The number of seconds after which to evict finished
+          processes that have not been retrieved.
+        :param max_entries: The maximum number of processes to keep.
+        :param max_bytes: The maximum total size of process results to keep.
+        :param clock: A callable returning the current time in seconds.
+        """
+        # Values are _MemoryProcess instances.
+        self._processes = {}
+        # Values are threading.Event instances, set once processes finish.
+        self._completions = {}
+        # Keys are process IDs, values are the times processes were submitted
+        # or finished. Entries are in chronological order, so the oldest
+        # process can be found and evicted in constant time.
+        self._progress_times = OrderedDict()
+        self._result_times = OrderedDict()
+        self._progress_ttl = progress_ttl
+        self._result_ttl = result_ttl
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._clock = clock
+        self._lock = Lock()
+        self._evictions = {
+            'progress_ttl': 0,
+            'result_ttl': 0,
+            'capacity': 0,
+        }
+
+    def add(self, process_id, user_name):
+        with self._lock:
+            self._completions[process_id] = Event()
+            self._processes[process_id] = _MemoryProcess(user_name)
+            self._progress_times[process_id] = self._clock()
+            self._evict()
+
+    def complete(self, process_id, result):
+        if isinstance(result, SpilledResult):
+            size = result.size
+        else:
+            # Compress outside the lock, as it is by far the slowest step.
+            result = result.encode('utf-8')
+            size = len(result)
+            result = zlib.compress(result)
+        with self._lock:
+            # The process may have been evicted while in progress.
+            if process_id not in self._progress_times:
+                if isinstance(result, SpilledResult):
+                    result.delete()
+                return False
+            del self._progress_times[process_id]
+            self._processes[process_id].result = result
+            self._processes[process_id].size = size
+            self._result_times[process_id] = self._clock()
+            self._bytes += _memory_size(result)
+            self._completions.pop(process_id).set()
+            self._evict()
+            return True
+
+    def retrieve(self, process_id):
+        with self._lock:
+            if process_id not in self._processes:
+                return None
+            process = self._processes[process_id]
+            if process_id in self._result_times:
+                self._delete(process_id)
+        return process.user_name, process.read()
+
+    def peek(self, process_id):
+        with self._lock:
+            process = self._processes.get(process_id)
+        if process is None:
+            return None
+        return process.user_name, process.read()
+
+    def status(self, process_id):
+        with self._lock:
+            process = self._processes.get(process_id)
+        if process is None:
+            return None
+        return process.user_name, process.size
+
+    def wait(self, process_id, timeout):
+        completion = self._completions.get(process_id)
+        if completion is None:
+            return True
+        return completion.wait(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'progress': len(self._progress_times),
+                'finished': len(self._result_times),
+                'bytes': self._bytes,
+                'evictions': dict(self._evictions),
+            }
+
+    def _evict(self):
+        """
+        Evicts expired processes, and the oldest processes if there are too
+        many or they are too large.
+
+        The lock must be held when calling this method.
+        :return:
+        """
+        now = self._clock()
+        for times, ttl, reason in ((self._progress_times, self._progress_ttl, 'progress_ttl'),
+                                   (self._result_times, self._result_ttl, 'result_ttl')):
+            while times and next(iter(times.values())) + ttl <= now:
+                self._evict_process(next(iter(times)))
+                self._evictions[reason] += 1
+        while len(self._processes) > self._max_entries or self._bytes > self._max_bytes:
+            # Prefer evicting results over processes that are still in
+            # progress, as these are more likely to be abandoned.
+            times = self._result_times if self._result_times else self._progress_times
+            self._evict_process(next(iter(times)))
+            self._evictions['capacity'] += 1
+
+    def _evict_process(self, process_id):
+        """
+        Deletes a process that nobody retrieved, and its spilled result.
+
+        The lock must be held when calling this method.
+        :param process_id:
+        :return:
+        """
+        result = self._delete(process_id).result
+        if isinstance(result, SpilledResult):
+            result.delete()
+
+    def _delete(self, process_id):
+        """
+        Deletes a process.
+
+        The lock must be held when calling this method.
+        :param process_id:
+        :return: The deleted _MemoryProcess.
+        """
+        process = self._processes.pop(process_id)
+        if process_id in self._progress_times:
+            del self._progress_times[process_id]
+            # Wake up anyone waiting for the process to finish.
+            self._completions.pop(process_id).set()
+        else:
+            del self._result_times[process_id]
+            self._bytes -= _memory_size(process.result)
+        return process
+
+
+class MemoryResultStore(ResultStore):
+    """
+    Stores processes in memory, for use by a single server process.
+
+    Processes can be spread over shards by process ID, each with its own lock,
+    so concurrent submissions, completions, and retrievals rarely wait for each
+    other. The locks are held so briefly that this only pays off without a
+    global interpreter lock. Limits apply per shard, so with many shards they
+    are approximate.
+
+    Results are kept compressed, and are only decompressed when retrieved.
+    Profiles are verbose XML, and decoded str objects take up to four bytes per
+    character, so this keeps many more unretrieved results within max_bytes.
+    Spilled results stay on disk, and do not count towards max_bytes.
+    """
+
+    def __init__(self, progress_ttl=3600, result_ttl=3600, max_entries=100000,
+                 max_bytes=512 * 1024 * 1024, clock=time.monotonic, shards=1):
+        """
+        :param progress_ttl: The number of seconds after which to evict
+          processes that are still in progress.
+        :param result_ttl: The number of seconds after which to evict finished
+          processes that have not been retrieved.
+        :param max_entries: The maximum number of processes to keep.
+        :param max_bytes: The maximum total size of process results to keep.
+        :param clock: A callable returning the current time in seconds.
+        :param shards: The number of shards to spread processes over.
+        """
+        self._shards = tuple(_MemoryShard(progress_ttl, result_ttl,
+                                          -(-max_entries // shards),
+                                          -(-max_bytes // shards), clock)
+                             for _ in range(shards))
+
+    def _shard(self, process_id):
+        return self._shards[hash(process_id) % len(self._shards)]
+
+    def add(self, process_id, user_name):
+        self._shard(process_id).add(process_id, user_name)
+
+    def complete(self, process_id, result):
+        return self._shard(process_id).complete(process_id, result)
+
+    def retrieve(self, process_id):
+        return self._shard(process_id).retrieve(process_id)
+
+    def peek(self, process_id):
+        return self._shard(process_id).peek(process_id)
+
+    def status(self, process_id):
+        return self._shard(process_id).status(process_id)
+
+    def wait(self, process_id, timeout):
+        return self._shard(process_id).wait(process_id, timeout)
+
+    def stats(self):
+        stats = {
+            'progress': 0,
+            'finished': 0,
+            'bytes': 0,
+            'evictions': {
+                'progress_ttl': 0,
+                'result_ttl': 0,
+                'capacity': 0,
+            },
+        }
+        for shard in self._shards:
+            shard_stats = shard.stats()
+            for name in ('progress', 'finished', 'bytes'):
+                stats[name] += shard_stats[name]
+            for reason, count in shard_stats['evictions'].items():
+                stats['evictions'][reason] += count
+        return stats
+
+
+class SqliteResultStore(ResultStore):
+    """
+    Stores processes in an SQLite database in WAL mode.
+
+    All server processes on a host that use the same database file share their
+    processes, so any of them can retrieve a process submitted through another.
+    Spilled results stay in their files, and only their paths are stored, so
+    all server processes must share RESULT_SPOOL_DIRECTORY. Like in
+    MemoryResultStore, spilled results do not count towards max_bytes.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS processes (
+            id TEXT PRIMARY KEY,
+            user_name TEXT NOT NULL,
+            result TEXT,
+            path TEXT,
+            size INTEGER NOT NULL DEFAULT 0,
+            time REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS processes_progress ON processes (time)
+            WHERE result IS NULL;
+        CREATE INDEX IF NOT EXISTS processes_finished ON processes (time)
+            WHERE result IS NOT NULL;
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO counters (name, value) VALUES
+            ('progress', 0), ('finished', 0), ('bytes', 0),
+            ('progress_ttl', 0), ('result_ttl', 0), ('capacity', 0);
+    """
+
+    def __init__(self, path, progress_ttl=3600, result_ttl=3600,
+                 max_entries=100000, max_bytes=512 * 1024 * 1024,
+                 poll_interval=0.05, clock=time.time):
+        """
+        :param path: The path to the database file.
+        :param progress_ttl: The number of seconds after which to evict
+          processes that are still in progress.
+        :param result_ttl: The number of seconds after which to evict finished
+          processes that have not been retrieved.
+        :param max_entries: The maximum number of processes to keep.
+        :param max_bytes: The maximum total size of process results to keep.
+        :param poll_interval: The number of seconds between checks for changes
+          by other server processes, while anyone waits for a process.
+        :param clock: A callable returning the current time in seconds. It must
+          agree across server processes.
+        """
+        self._path = path
+        self._progress_ttl = progress_ttl
+        self._result_ttl = result_ttl
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._poll_interval = poll_interval
+        self._clock = clock
+        # Connections cannot be shared across threads.
+        self._local = local()
+        # Values are 2-tuples (threading.Event, time) for processes submitted
+        # through this server process, with Events set once processes finish.
+        # Entries are in chronological order, so those of processes that other
+        # server processes evicted can be pruned in constant time.
+        self._completions = {}
+        # Keys are the IDs of processes being waited for, values are 2-tuples
+        # (threading.Event, number of waiters).
+        self._watches = {}
+        # The thread that watches the database for changes, while there are
+        # watches.
+        self._watcher = None
+        self._completions_lock = Lock()
+        connection = self._connection()
+        connection.executescript(self._SCHEMA)
+        try:
+            # Upgrade databases created before spilled results were stored.
+            connection.execute('ALTER TABLE processes ADD COLUMN path TEXT')
+        except sqlite3.OperationalError:
+            # The column exists already.
+            pass
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=30,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _transaction(self, callback):
+        """
+        Runs a callback in a write transaction.
+        :param callback: A callable that takes the connection as its argument.
+        :return: The callback's return value.
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            result = callback(connection)
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return result
+
+    @staticmethod
+    def _count(connection, **increments):
+        for name, increment in increments.items():
+            connection.execute(
+                'UPDATE counters SET value = value + ? WHERE name = ?',
+                (increment, name))
+
+    @staticmethod
+    def _result(result, path, size):
+        """
+        Builds a result from a database row.
+        :return: The result as a str or a SpilledResult, or None if the
+          process is in progress.
+        """
+        if path is not None:
+            return SpilledResult(path, size)
+        return result
+
+    def _set_completion(self, process_id):
+        """
+        Wakes up anyone waiting for a process to finish.
+        :param process_id:
+        :return:
+        """
+        with self._completions_lock:
+            completion = self._completions.pop(process_id, None)
+        if completion is not None:
+            completion[0].set()
+
+    def add(self, process_id, user_name):
+        now = self._clock()
+        with self._completions_lock:
+            # By now, processes that were not completed here have been evicted
+            # by another server process.
+            while self._completions:
+                expired_process_id = next(iter(self._completions))
+                completion, completion_time = self._completions[expired_process_id]
+                if completion_time + self._progress_ttl > now:
+                    break
+                del self._completions[expired_process_id]
+                completion.set()
+            self._completions[process_id] = Event(), now
+
+        def _add(connection):
+            connection.execute(
+                'INSERT INTO processes (id, user_name, time) VALUES (?, ?, ?)',
+                (process_id, user_name, self._clock()))
+            self._count(connection, progress=1)
+            self._evict(connection)
+        self._transaction(_add)
+
+    def complete(self, process_id, result):
+        if isinstance(result, SpilledResult):
+            path, size = result.path, result.size
+            stored_result, stored_bytes = '', 0
+        else:
+            path, size = None, len(result.encode('utf-8'))
+            stored_result, stored_bytes = result, size
+
+        def _complete(connection):
+            cursor = connection.execute(
+                'UPDATE processes SET result = ?, path = ?, size = ?, time = ? WHERE id = ? AND result IS NULL',
+                (stored_result, path, size, self._clock(), process_id))
+            if not cursor.rowcount:
+                return False
+            self._count(connection, progress=-1, finished=1,
+                        bytes=stored_bytes)
+            self._evict(connection)
+            return True
+        completed = self._transaction(_complete)
+        if not completed and path is not None:
+            result.delete()
+        self._set_completion(process_id)
+        return completed
+
+    def retrieve(self, process_id):
+        def _retrieve(connection):
+            row = connection.execute(
+                'SELECT user_name, result, path, size FROM processes WHERE id = ?',
+                (process_id,)).fetchone()
+            if row is None:
+                return None
+            user_name, result, path, size = row
+            if result is None:
+                return user_name, None
+            connection.execute('DELETE FROM processes WHERE id = ?',
+                               (process_id,))
+            self._count(connection, finished=-1,
+                        bytes=0 if path is not None else -size)
+            # The caller takes ownership of the spilled result's file.
+            return user_name, self._result(result, path, size)
+        return self._transaction(_retrieve)
+
+    def peek(self, process_id):
+        row = self._connection().execute(
+            'SELECT user_name, result, path, size FROM processes WHERE id = ?',
+            (process_id,)).fetchone()
+        if row is None:
+            return None
+        return row[0], self._result(*row[1:])
+
+    def status(self, process_id):
+        row = self._connection().execute(
+            'SELECT user_name, CASE WHEN result IS NULL THEN NULL ELSE size END FROM processes WHERE id = ?',
+            (process_id,)).fetchone()
+        return None if row is None else tuple(row)
+
+    def wait(self, process_id, timeout):
+        deadline = time.monotonic() + timeout
+        completion = self._watch(process_id)
+        try:
+            row = self._connection().execute(
+                'SELECT result IS NOT NULL FROM processes WHERE id = ?',
+                (process_id,)).fetchone()
+            if row is None or row[0] or completion.wait(max(0, deadline - time.monotonic())):
+                # Another server process may have finished or evicted the
+                # process, so wake up this server process' other waiters.
+                self._set_completion(process_id)
+                return True
+            return False
+        finally:
+            self._unwatch(process_id)
+
+    def _watch(self, process_id):
+        """
+        Starts watching a process for changes by other server processes.
+        :param process_id:
+        :return: A threading.Event that is set once the process finishes or
+          no longer exists.
+        """
+        with self._completions_lock:
+            completion, waiters = self._watches.get(process_id, (None, 0))
+            if completion is None:
+                # Processes submitted through this server process are also
+                # completed through their own Events.
+                local_completion = self._completions.get(process_id)
+                completion = Event() if local_completion is None else local_completion[0]
+            self._watches[process_id] = completion, waiters + 1
+            if self._watcher is None:
+                self._watcher = Thread(target=self._watch_changes, daemon=True)
+                self._watcher.start()
+        return completion
+
+    def _unwatch(self, process_id):
+        with self._completions_lock:
+            completion, waiters = self._watches[process_id]
+            if 1 == waiters:
+                del self._watches[process_id]
+            else:
+                self._watches[process_id] = completion, waiters - 1
+
+    def _watch_changes(self):
+        """
+        Sets the Events of watched processes that other server processes
+        finished or evicted.
+
+        SQLite cannot notify other connections of changes, so this polls the
+        database's data version, which only changes when other connections
+        commit. All waiters in this server process share the one query.
+        :return:
+        """
+        connection = sqlite3.connect(self._path, timeout=30,
+                                     isolation_level=None)
+        try:
+            data_version = None
+            while True:
+                # Read the data version before the watches, so changes are
+                # never missed by processes that are watched in between.
+                current_data_version = connection.execute(
+                    'PRAGMA data_version').fetchone()[0]
+                with self._completions_lock:
+                    if not self._watches:
+                        self._watcher = None
+                        return
+                    process_ids = list(self._watches)
+                if current_data_version != data_version:
+                    data_version = current_data_version
+                    in_progress = set()
+                    # Stay well within SQLite's limit of query parameters.
+                    for offset in range(0, len(process_ids), 500):
+                        batch = process_ids[offset:offset + 500]
+                        in_progress.update(process_id for process_id, in connection.execute(
+                            'SELECT id FROM processes WHERE result IS NULL AND id IN (%s)' % ', '.join('?' * len(batch)),
+                            batch))
+                    with self._completions_lock:
+                        for process_id in process_ids:
+                            watch = self._watches.get(process_id)
+                            if watch is not None and process_id not in in_progress:
+                                watch[0].set()
+                time.sleep(self._poll_interval)
+        finally:
+            connection.close()
+
+    def stats(self):
+        counters = dict(self._connection().execute(
+            'SELECT name, value FROM counters'))
+        return {
+            'progress': counters['progress'],
+            'finished': counters['finished'],
+            'bytes': counters['bytes'],
+            'evictions': {
+                'progress_ttl': counters['progress_ttl'],
+                'result_ttl': counters['result_ttl'],
+                'capacity': counters['capacity'],
+            },
+        }
+
+    def _evict(self, connection):
+        """
+        Evicts expired processes, and the oldest processes if there are too
+        many or they are too large.
+
+        This must be called within a transaction.
+        :param connection:
+        :return:
+        """
+        now = self._clock()
+        for process_id, in connection.execute(
+                'SELECT id FROM processes WHERE result IS NULL AND time <= ?',
+                (now - self._progress_ttl,)).fetchall():
+            self._delete(connection, process_id)
+            self._count(connection, progress_ttl=1)
+        for process_id, in connection.execute(
+                'SELECT id FROM processes WHERE result IS NOT NULL AND time <= ?',
+                (now - self._result_ttl,)).fetchall():
+            self._delete(connection, process_id)
+            self._count(connection, result_ttl=1)
+        while True:
+            counters = dict(connection.execute(
+                "SELECT name, value FROM counters WHERE name IN ('progress', 'finished', 'bytes')"))
+            if counters['progress'] + counters['finished'] <= self._max_entries and counters['bytes'] <= self._max_bytes:
+                return
+            # Prefer evicting results over processes that are still in
+            # progress, as these are more likely to be abandoned.
+            row = connection.execute(
+                'SELECT id FROM processes WHERE result IS NOT NULL ORDER BY time LIMIT 1').fetchone()
+            if row is None:
+                row = connection.execute(
+                    'SELECT id FROM processes WHERE result IS NULL ORDER BY time LIMIT 1').fetchone()
+            if row is None:
+                # The counters disagree with the processes, so there is
+                # nothing left to evict.
+                return
+            self._delete(connection, row[0])
+            self._count(connection, capacity=1)
+
+    def _delete(self, connection, process_id):
+        """
+        Deletes a process that nobody retrieved, and its spilled result.
+
+        This must be called within a transaction.
+        :param connection:
+        :param process_id:
+        :return:
+        """
+        row = connection.execute(
+            'SELECT result IS NULL, path, size FROM processes WHERE id = ?',
+            (process_id,)).fetchone()
+        if row is None:
+            return
+        result_is_null, path, size = row
+        connection.execute('DELETE FROM processes WHERE id = ?', (process_id,))
+        if result_is_null:
+            self._count(connection, progress=-1)
+            self._set_completion(process_id)
+        elif path is not None:
+            self._count(connection, finished=-1)
+            SpilledResult(path, size).delete()
+        else:
+            self._count(connection, finished=-1, bytes=-size)
+
+
+def build_result_store(config):
+    """
+    Builds the configured process result store.
+    :param config: The application configuration.
+    :return: ResultStore
+    """
+    limits = (config['PROCESS_PROGRESS_TTL'],
+              config['PROCESS_RESULT_TTL'],
+              config['PROCESS_MAX_ENTRIES'],
+              config['PROCESS_MAX_BYTES'])
+    if 'memory' == config['PROCESS_STORE']:
+        return MemoryResultStore(*limits, shards=config['PROCESS_STORE_SHARDS'])
+    if 'sqlite' == config['PROCESS_STORE']:
+        return SqliteResultStore(config['PROCESS_STORE_PATH'], *limits,
+                                 poll_interval=config['PROCESS_STORE_POLL_INTERVAL'])
+    raise ValueError('Unknown process store "%s".' % config['PROCESS_STORE'])
@@ -85,3 +85,4 @@ class IntegrationTestCase(TestCase):
 
     def tearDown(self):
         self._flask_app_context.pop()
+        self._flask_app.close()
@@ -0,0 +1,267 @@
+import base64
+import gzip
+import json
+import os
+import re
+import tempfile
+
+from aiohttp import web
+from aiohttp.test_utils import AioHTTPTestCase, TestServer
+
+from tk.aiohttp.app import App
+from tk.store import SqliteResultStore
+
+PROFILE = '<?xml version="1.0" encoding="UTF-8" ?><Profile />'
+
+
+class AsyncAppTestCase(AioHTTPTestCase):
+    """
+    Runs the asyncio server against a fake Sourcebox.
+    """
+
+    async def get_application(self):
+        self.upstream_status_code = 200
+        upstream = web.Application()
+        upstream.router.add_post('/', self._handle_upstream_request)
+        self._upstream = TestServer(upstream)
+        await self._upstream.start_server()
+        self._app = App({
+            'SOURCEBOX_URL': str(self._upstream.make_url('/')),
+        })
+        return self._app.web
+
+    async def tearDownAsync(self):
+        await super().tearDownAsync()
+        await self._upstream.close()
+
+    async def _handle_upstream_request(self, request):
+        if request.content_length is None:
+            return web.Response(status=411)
+        form = await request.post()
+        if b'I am an excellent CV' not in form['uploaded_file'].file.read():
+            return web.Response(status=400)
+        return web.Response(text=PROFILE, status=self.upstream_status_code)
+
+    async def testAccessTokenWithMissingAuthorizationShould401(self):
+        response = await self.client.get('/accesstoken', headers={
+            'Accept': 'text/plain',
+        })
+        self.assertEqual(401, response.status)
+        self.assertIn('WWW-Authenticate', response.headers)
+
+    async def testAccessToken(self):
+        self._app.add_user('User Foo', 'foo')
+        response = await self.client.get('/accesstoken', headers={
+            'Accept': 'text/plain',
+            'Authorization': 'Basic %s' % base64.b64encode(b'User Foo:foo').decode('ascii'),
+        })
+        self.assertEqual(200, response.status)
+        self.assertEqual('User Foo', self._app.auth.verify_access_token(
+            await response.text()))
+
+    async def testSubmitWithUnsupportedMediaTypeShould415(self):
+        response = await self.client.post('/submit', params={
+            'access_token': self._app.auth.grant_access_token('User Foo'),
+        }, headers={
+            'Accept': 'text/plain',
+            'Content-Type': 'text/plain',
+        }, data=b'I am an excellent CV, mind you.')
+        self.assertEqual(415, response.status)
+
+    async def testSubmitWithForbiddenShould403(self):
+        response = await self.client.post('/submit', params={
+            'access_token': 'foo.bar.baz',
+        })
+        self.assertEqual(403, response.status)
+
+    async def testSubmitWithTooLargeDocumentShould413(self):
+        self._app.config['MAX_DOCUMENT_SIZE'] = 9
+        response = await self._submit()
+        self.assertEqual(413, response.status)
+
+    async def testSubmitWithUnsupportedContentEncodingShould415(self):
+        response = await self._submit({
+            'Content-Encoding': 'compress',
+        })
+        self.assertEqual(415, response.status)
+
+    async def testSubmitWithServerTiming(self):
+        self._app.config['SERVER_TIMING_ENABLED'] = True
+        response = await self._submit()
+        self.assertEqual(200, response.status)
+        self.assertEqual(['auth', 'body', 'schedule', 'total'], [
+            metric.split(';')[0] for metric in response.headers['Server-Timing'].split(', ')])
+
+    async def testSubmitWithGzipContentEncoding(self):
+        response = await self._submit({
+            'Content-Encoding': 'gzip',
+        }, gzip.compress(b'I am an excellent CV, mind you.'))
+        self.assertEqual(200, response.status)
+        response = await self._retrieve(await response.text(), wait=9)
+        self.assertEqual(PROFILE, await response.text())
+
+    async def testMetrics(self):
+        await self._submit()
+        response = await self.client.get('/metrics')
+        self.assertEqual(200, response.status)
+        text = await response.text()
+        self.assertIn('tk_requests_total{route="submit",status="200"}', text)
+        self.assertIn('tk_processes{state="progress"}', text)
+
+    async def testRetrieveWithUnknownProcessIdShould404(self):
+        response = await self._retrieve('foo')
+        self.assertEqual(404, response.status)
+
+    async def testSubmitAndRetrieve(self):
+        response = await self._submit()
+        self.assertEqual(200, response.status)
+        process_id = await response.text()
+        self.assertRegex(process_id, re.compile('^[a-f0-9-]{36}$'))
+        response = await self._retrieve(process_id, wait=9)
+        self.assertEqual(200, response.status)
+        self.assertEqual(PROFILE, await response.text())
+        response = await self._retrieve(process_id)
+        self.assertEqual(404, response.status)
+
+    async def testSubmitAndRetrieveWithSqliteStore(self):
+        # Stores that do I/O are used outside the event loop.
+        with tempfile.TemporaryDirectory() as directory:
+            self._app.process._store = SqliteResultStore(
+                os.path.join(directory, 'processes.sqlite'))
+            process_id = await (await self._submit()).text()
+            response = await self._retrieve(process_id, wait=9)
+            self.assertEqual(200, response.status)
+            self.assertEqual(PROFILE, await response.text())
+            response = await self._retrieve(process_id)
+            self.assertEqual(404, response.status)
+
+    async def testSubmitAndRetrieveWithRange(self):
+        process_id = await (await self._submit()).text()
+        response = await self._retrieve(process_id, {
+            'Range': 'bytes=0-9',
+        }, wait=9)
+        self.assertEqual(206, response.status)
+        self.assertEqual('bytes 0-9/%d' % len(PROFILE), response.headers['Content-Range'])
+        first_part = await response.text()
+        # The process is kept until its last part is retrieved.
+        response = await self._retrieve(process_id, {
+            'Range': 'bytes=10-',
+            'If-Range': response.headers['ETag'],
+        })
+        self.assertEqual(206, response.status)
+        self.assertEqual(PROFILE, first_part + await response.text())
+        response = await self._retrieve(process_id)
+        self.assertEqual(404, response.status)
+
+    async def testSubmitAndRetrieveSpilledProfile(self):
+        self._app.process._result_spool_size = 16
+        process_id = await (await self._submit()).text()
+        response = await self._retrieve(process_id, {
+            'Range': 'bytes=0-9',
+        }, wait=9)
+        self.assertEqual(206, response.status)
+        self.assertEqual(PROFILE[:10], await response.text())
+        response = await self._retrieve(process_id, {
+            'Accept-Encoding': 'gzip',
+        })
+        self.assertEqual(200, response.status)
+        self.assertEqual('bytes', response.headers['Accept-Ranges'])
+        self.assertEqual(PROFILE, await response.text())
+        response = await self._retrieve(process_id)
+        self.assertEqual(404, response.status)
+
+    async def testRetrieveWithMatchingIfNoneMatchShould304AndKeepProfile(self):
+        process_id = await (await self._submit()).text()
+        await self._app.process.wait_async(process_id, 9)
+        response = await self._retrieve(process_id, {
+            'If-None-Match': '"%s"' % process_id,
+        })
+        self.assertEqual(304, response.status)
+        self.assertEqual('"%s"' % process_id, response.headers['ETag'])
+        response = await self._retrieve(process_id)
+        self.assertEqual(200, response.status)
+        self.assertEqual(PROFILE, await response.text())
+
+    async def testRetrieveProgressWithRangeShould200WithoutEtag(self):
+        process_id = 'foo'
+        self._app.process._store.add(process_id, 'User Foo')
+        response = await self._retrieve(process_id, {
+            'Range': 'bytes=0-3',
+            'If-None-Match': '"%s"' % process_id,
+        })
+        self.assertEqual(200, response.status)
+        self.assertEqual('PROGRESS', await response.text())
+        self.assertNotIn('ETag', response.headers)
+        self.assertNotIn('Accept-Ranges', response.headers)
+
+    async def testRetrieveWithUnsatisfiableRangeShould416(self):
+        process_id = await (await self._submit()).text()
+        await self._app.process.wait_async(process_id, 9)
+        response = await self._retrieve(process_id, {
+            'Range': 'bytes=9999-',
+        })
+        self.assertEqual(416, response.status)
+
+    async def testSubmitAndRetrieveJson(self):
+        process_id = await (await self._submit()).text()
+        params = {
+            'access_token': self._app.auth.grant_access_token('User Foo'),
+            'wait': 9,
+        }
+        response = await self.client.get('/retrieve/%s' % process_id, params=params, headers={
+            'Accept': 'application/json',
+        })
+        self.assertEqual(200, response.status)
+        self.assertEqual('application/json', response.content_type)
+        self.assertEqual({}, await response.json())
+
+    async def testSubmitAndRetrieveWithUpstream5xxResponse(self):
+        self.upstream_status_code = 503
+        process_id = await (await self._submit()).text()
+        response = await self._retrieve(process_id, wait=9)
+        self.assertEqual(502, response.status)
+
+    async def testRetrieveSomeoneElsesDocumentShould403(self):
+        process_id = self._app.process.submit('User Bar', b'I am an excellent CV, mind you.')
+        response = await self._retrieve(process_id)
+        self.assertEqual(403, response.status)
+
+    async def testRetrieveSomeoneElsesProfileShouldKeepProfile(self):
+        process_id = self._app.process.submit('User Bar', b'I am an excellent CV, mind you.')
+        self._app.process._deliver(process_id, 'Profile')
+        response = await self._retrieve(process_id)
+        self.assertEqual(403, response.status)
+        self.assertEqual(('User Bar', 'Profile'),
+                         self._app.process.peek(process_id))
+
+    async def testRetrieveBatch(self):
+        process_id = await (await self._submit()).text()
+        await self._app.process.wait_async(process_id, 9)
+        response = await self.client.post('/retrieve/batch', params={
+            'access_token': self._app.auth.grant_access_token('User Foo'),
+            'profiles': 'true',
+        }, headers={
+            'Accept': 'application/x-ndjson',
+            'Content-Type': 'application/json',
+        }, data=json.dumps([process_id, 'foo']))
+        self.assertEqual(200, response.status)
+        self.assertEqual([
+            {'process_id': process_id, 'status': 'done', 'profile': PROFILE},
+            {'process_id': 'foo', 'status': 'unknown'},
+        ], [json.loads(line) for line in (await response.text()).splitlines()])
+        response = await self._retrieve(process_id)
+        self.assertEqual(404, response.status)
+
+    async def _submit(self, headers=None, data=b'I am an excellent CV, mind you.'):
+        return await self.client.post('/submit', params={
+            'access_token': self._app.auth.grant_access_token('User Foo'),
+        }, headers=dict({
+            'Accept': 'text/plain',
+            'Content-Type': 'application/octet-stream',
+        }, **(headers or {})), data=data)
+
+    async def _retrieve(self, process_id, headers=None, **params):
+        params['access_token'] = self._app.auth.grant_access_token('User Foo')
+        return await self.client.get('/retrieve/%s' % process_id, params=params, headers=dict({
+            'Accept': 'text/xml',
+        }, **(headers or {})))
@@ -1,7 +1,8 @@
-from time import sleep
+import base64
+from time import sleep, time
 from unittest import TestCase
 
-from tk.auth import Auth
+from tk.auth import Auth, CompactCodec, JwtCodec, build_auth
 
 
 class AuthTest(TestCase):
@@ -30,3 +31,110 @@ class AuthTest(TestCase):
         user_name = 'User Foo'
         self.assertIsNone(auth_b.verify_access_token(
             auth_a.grant_access_token(user_name)))
+
+    def testVerificationShouldBeCached(self):
+        auth = Auth('foo', 9)
+        token = auth.grant_access_token('User Foo')
+        auth.verify_access_token(token)
+        auth.verify_access_token(token)
+        self.assertEqual(1, auth.cache_misses)
+        self.assertEqual(1, auth.cache_hits)
+
+    def testVerifyCachedExpiredToken(self):
+        auth = Auth('foo', 1)
+        user_name = 'User Foo'
+        token = auth.grant_access_token(user_name)
+        self.assertEqual(auth.verify_access_token(token), user_name)
+        sleep(2)
+        self.assertIsNone(auth.verify_access_token(token))
+
+    def testVerificationWithCompactCodec(self):
+        auth = Auth('foo', 9, codec=CompactCodec(['foo']))
+        self.assertEqual('User Foo', auth.verify_access_token(
+            auth.grant_access_token('User Foo')))
+
+    def testBuildAuthWithRotatedSecretKey(self):
+        config = {
+            'SECRET_KEY': 'foo',
+            'ACCESS_TOKEN_TTL': 9,
+            'ACCESS_TOKEN_CACHE_SIZE': 9,
+            'ACCESS_TOKEN_REJECTION_TTL': 9,
+            'ACCESS_TOKEN_REJECTION_CACHE_SIZE': 9,
+            'ACCESS_TOKEN_CODEC': 'compact',
+            'ACCESS_TOKEN_PREVIOUS_SECRET_KEYS': [],
+        }
+        access_token = build_auth(config).grant_access_token('User Foo')
+        config['SECRET_KEY'] = 'bar'
+        config['ACCESS_TOKEN_PREVIOUS_SECRET_KEYS'] = ['foo']
+        self.assertEqual('User Foo', build_auth(config).verify_access_token(access_token))
+
+    def testRejectionShouldBeCached(self):
+        auth = Auth('foo', 9)
+        self.assertIsNone(auth.verify_access_token('foo.bar.baz'))
+        self.assertIsNone(auth.verify_access_token('foo.bar.baz'))
+        self.assertEqual(1, auth.cache_hits)
+
+    def testRejectionShouldNotEvictVerifiedTokens(self):
+        auth = Auth('foo', 9, cache_size=1, rejection_cache_size=1)
+        token = auth.grant_access_token('User Foo')
+        auth.verify_access_token(token)
+        for index in range(9):
+            self.assertIsNone(auth.verify_access_token('foo.bar.%d' % index))
+        self.assertEqual('User Foo', auth.verify_access_token(token))
+        self.assertEqual(1, auth._verified_access_tokens.hits)
+
+
+class TokenCodecTestMixin:
+    def _build_codec(self, secret_keys):
+        raise NotImplementedError()
+
+    def testDecode(self):
+        codec = self._build_codec(['foo'])
+        expires = int(time()) + 9
+        self.assertEqual(('User Fôo', expires),
+                         codec.decode(codec.encode('User Fôo', expires)))
+
+    def testDecodeExpiredToken(self):
+        codec = self._build_codec(['foo'])
+        self.assertIsNone(codec.decode(codec.encode('User Foo', int(time()) - 1)))
+
+    def testDecodeInvalidSignature(self):
+        codec_a = self._build_codec(['foo'])
+        codec_b = self._build_codec(['bar'])
+        self.assertIsNone(codec_b.decode(codec_a.encode('User Foo', int(time()) + 9)))
+
+    def testDecodeMalformedToken(self):
+        codec = self._build_codec(['foo'])
+        for access_token in ('', 'foo', 'foo.bar.baz', '!!!!', 'Zm9v' * 20):
+            self.assertIsNone(codec.decode(access_token))
+
+    def testDecodeWithRotatedKey(self):
+        old_codec = self._build_codec(['foo'])
+        codec = self._build_codec(['bar', 'foo'])
+        expires = int(time()) + 9
+        self.assertEqual(('User Foo', expires),
+                         codec.decode(old_codec.encode('User Foo', expires)))
+        self.assertIsNone(old_codec.decode(codec.encode('User Foo', expires)))
+
+
+class JwtCodecTest(TokenCodecTestMixin, TestCase):
+    def _build_codec(self, secret_keys):
+        return JwtCodec(secret_keys)
+
+
+class CompactCodecTest(TokenCodecTestMixin, TestCase):
+    def _build_codec(self, secret_keys):
+        return CompactCodec(secret_keys)
+
+    def testEncodeShouldBeUrlSafe(self):
+        codec = self._build_codec(['foo'])
+        self.assertRegex(codec.encode('User Foo', int(time()) + 9),
+                         '^[A-Za-z0-9_-]+$')
+
+    def testDecodeTamperedToken(self):
+        codec = self._build_codec(['foo'])
+        token = bytearray(base64.urlsafe_b64decode(
+            codec.encode('User Foo', int(time()) + 9) + '=='))
+        token[10] ^= 1
+        self.assertIsNone(codec.decode(
+            base64.urlsafe_b64encode(bytes(token)).decode('ascii').rstrip('=')))
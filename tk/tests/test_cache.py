@@ -0,0 +1,39 @@
+from unittest import TestCase
+
+from tk.cache import LruCache
+
+
+class LruCacheTest(TestCase):
+    def setUp(self):
+        self._now = 0
+        self._cache = LruCache(2, clock=lambda: self._now)
+
+    def testGetWithMissingKey(self):
+        self.assertIsNone(self._cache.get('foo'))
+        self.assertEqual('bar', self._cache.get('foo', 'bar'))
+        self.assertEqual(2, self._cache.misses)
+
+    def testGetWithExistingKey(self):
+        self._cache.set('foo', 'bar')
+        self.assertEqual('bar', self._cache.get('foo'))
+        self.assertEqual(1, self._cache.hits)
+
+    def testGetWithExpiredKey(self):
+        self._cache.set('foo', 'bar', 9)
+        self._now = 9
+        self.assertIsNone(self._cache.get('foo'))
+        self.assertEqual(0, len(self._cache))
+
+    def testSetShouldEvictLeastRecentlyUsed(self):
+        self._cache.set('foo', 'Foo')
+        self._cache.set('bar', 'Bar')
+        self._cache.get('foo')
+        self._cache.set('baz', 'Baz')
+        self.assertEqual('Foo', self._cache.get('foo'))
+        self.assertIsNone(self._cache.get('bar'))
+        self.assertEqual('Baz', self._cache.get('baz'))
+
+    def testDelete(self):
+        self._cache.set('foo', 'bar')
+        self._cache.delete('foo')
+        self.assertIsNone(self._cache.get('foo'))
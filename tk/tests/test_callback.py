@@ -0,0 +1,137 @@
+import os
+import shutil
+import tempfile
+import time
+from threading import Event, Thread
+from unittest import TestCase
+
+import requests_mock
+
+from tk.callback import CallbackDispatcher, callback_url_allowed, \
+    sign_callback
+from tk.store import ResultSpool
+from tk.upstream import RetryPolicy
+
+
+class CallbackUrlAllowedTest(TestCase):
+    ALLOWED_URLS = ('https://example.com/hooks/',)
+
+    def testWithAllowedUrl(self):
+        self.assertTrue(callback_url_allowed('https://EXAMPLE.com/hooks/foo',
+                                             self.ALLOWED_URLS))
+
+    def testWithOtherPath(self):
+        self.assertFalse(callback_url_allowed('https://example.com/foo',
+                                              self.ALLOWED_URLS))
+
+    def testWithPathSharingPrefix(self):
+        self.assertFalse(callback_url_allowed('https://example.com/hooksevil',
+                                              ('https://example.com/hooks',)))
+
+    def testWithAllowedPathWithoutTrailingSlash(self):
+        for url in ('https://example.com/hooks', 'https://example.com/hooks/foo'):
+            self.assertTrue(callback_url_allowed(url,
+                                                 ('https://example.com/hooks',)))
+
+    def testWithOtherHost(self):
+        self.assertFalse(callback_url_allowed(
+            'https://example.com.example.net/hooks/foo', self.ALLOWED_URLS))
+
+    def testWithOtherScheme(self):
+        self.assertFalse(callback_url_allowed('http://example.com/hooks/foo',
+                                              self.ALLOWED_URLS))
+
+
+class CallbackDispatcherTest(TestCase):
+    URL = 'https://example.com/hooks/foo'
+
+    def _deliver(self, responses, retries=0, result='<Profile />'):
+        delivered = Event()
+        with requests_mock.mock() as m:
+            m.post(self.URL, responses)
+            dispatcher = CallbackDispatcher(
+                'I am not so secret', retry_policy=RetryPolicy(retries, 0, 0))
+            dispatcher.deliver(self.URL, 'foo', result, 'text/xml',
+                               delivered.set)
+            delivered.wait(9)
+            # Wait for failed deliveries to be counted.
+            deadline = time.monotonic() + 9
+            while sum(dispatcher.stats().values()) < 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            return dispatcher, m.request_history
+
+    def testDeliver(self):
+        dispatcher, requests = self._deliver([{'status_code': 204}])
+        self.assertEqual({'delivered': 1, 'failed': 0}, dispatcher.stats())
+        request = requests[0]
+        self.assertEqual(b'<Profile />', request.body)
+        self.assertEqual('foo', request.headers['X-Tk-Process-Id'])
+        self.assertEqual(sign_callback('I am not so secret',
+                                       request.headers['X-Tk-Timestamp'],
+                                       request.body),
+                         request.headers['X-Tk-Signature'])
+
+    def testDeliverSpilledResult(self):
+        directory = tempfile.mkdtemp()
+        try:
+            spool = ResultSpool('utf-8', 0, directory)
+            spool.write(b'<Profile />')
+            dispatcher, requests = self._deliver([{'status_code': 204}],
+                                                 result=spool.finish())
+            request = requests[0]
+            # The file is streamed, rather than read into memory.
+            self.assertEqual('11', request.headers['Content-Length'])
+            self.assertEqual(sign_callback('I am not so secret',
+                                           request.headers['X-Tk-Timestamp'],
+                                           b'<Profile />'),
+                             request.headers['X-Tk-Signature'])
+            # The dispatcher deletes its spilled results once delivered.
+            self.assertEqual([], os.listdir(directory))
+        finally:
+            shutil.rmtree(directory)
+
+    def testDeliverShouldRetry(self):
+        dispatcher, requests = self._deliver([{'status_code': 503},
+                                              {'status_code': 204}], 1)
+        self.assertEqual({'delivered': 1, 'failed': 0}, dispatcher.stats())
+        self.assertEqual(2, len(requests))
+
+    def testDeliverShouldNotRetryClientErrors(self):
+        dispatcher, requests = self._deliver([{'status_code': 404}], 1)
+        self.assertEqual({'delivered': 0, 'failed': 1}, dispatcher.stats())
+        self.assertEqual(1, len(requests))
+
+    def testCloseShouldDiscardQueuedDeliveries(self):
+        directory = tempfile.mkdtemp()
+        started = Event()
+        release = Event()
+
+        def _respond(request, context):
+            started.set()
+            release.wait(9)
+            context.status_code = 204
+            return ''
+        try:
+            with requests_mock.mock() as m:
+                m.post(self.URL, text=_respond)
+                dispatcher = CallbackDispatcher('I am not so secret',
+                                                max_concurrency=1)
+                dispatcher.deliver(self.URL, 'foo', '<Profile />', 'text/xml',
+                                   lambda: None)
+                started.wait(9)
+                spool = ResultSpool('utf-8', 0, directory)
+                spool.write(b'<Profile />')
+                dispatcher.deliver(self.URL, 'bar', spool.finish(), 'text/xml',
+                                   lambda: None)
+                closer = Thread(target=dispatcher.close)
+                closer.start()
+                deadline = time.monotonic() + 9
+                while os.listdir(directory) and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                release.set()
+                closer.join(9)
+                self.assertEqual(1, len(m.request_history))
+            self.assertEqual([], os.listdir(directory))
+        finally:
+            release.set()
+            shutil.rmtree(directory)
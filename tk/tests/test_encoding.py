@@ -0,0 +1,63 @@
+import gzip
+import io
+import zlib
+from unittest import TestCase
+
+from werkzeug.datastructures import Accept
+
+from tk.encoding import DECODING_ERRORS, ResponseCompressor, \
+    UnsupportedEncoding, decompressing_stream
+
+
+class DecompressingStreamTest(TestCase):
+    def testIdentity(self):
+        stream = io.BytesIO(b'Foo')
+        self.assertIs(stream, decompressing_stream(stream, None))
+
+    def testGzip(self):
+        stream = decompressing_stream(io.BytesIO(gzip.compress(b'Foo')),
+                                      'gzip')
+        self.assertEqual(b'Foo', stream.read())
+
+    def testDeflate(self):
+        stream = decompressing_stream(io.BytesIO(zlib.compress(b'Foo' * 9)),
+                                      'deflate')
+        self.assertEqual(b'Foo', stream.read(3))
+        self.assertEqual(b'Foo' * 8, stream.read())
+        self.assertEqual(b'', stream.read())
+
+    def testTruncatedGzip(self):
+        stream = decompressing_stream(io.BytesIO(gzip.compress(b'Foo' * 9)[:-8]),
+                                      'gzip')
+        with self.assertRaises(DECODING_ERRORS):
+            stream.read()
+
+    def testTruncatedDeflate(self):
+        stream = decompressing_stream(io.BytesIO(zlib.compress(b'Foo' * 9)[:-4]),
+                                      'deflate')
+        with self.assertRaises(DECODING_ERRORS):
+            while stream.read():
+                pass
+
+    def testUnsupportedEncoding(self):
+        with self.assertRaises(UnsupportedEncoding):
+            decompressing_stream(io.BytesIO(b'Foo'), 'compress')
+
+
+class ResponseCompressorTest(TestCase):
+    def testCompress(self):
+        compressor = ResponseCompressor(min_size=3)
+        body, encoding = compressor.compress(b'Foo', Accept([('gzip', 1)]))
+        self.assertEqual('gzip', encoding)
+        self.assertEqual(b'Foo', gzip.decompress(body))
+        self.assertIs(body, compressor.compress(b'Foo', Accept([('gzip', 1)]))[0])
+
+    def testCompressWithSmallBody(self):
+        compressor = ResponseCompressor(min_size=9)
+        self.assertEqual((b'Foo', None),
+                         compressor.compress(b'Foo', Accept([('gzip', 1)])))
+
+    def testCompressWithoutAcceptedEncoding(self):
+        compressor = ResponseCompressor(min_size=0)
+        self.assertEqual((b'Foo', None),
+                         compressor.compress(b'Foo', Accept([('compress', 1)])))
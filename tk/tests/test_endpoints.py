@@ -1,5 +1,13 @@
 import base64
+import gzip
+import io
+import json
+import os
+import tarfile
+import zipfile
+import zlib
 from time import sleep
+from unittest import skipUnless
 
 import requests_mock
 
@@ -53,6 +61,27 @@ def provide_disallowed_access_token_methods():
     return expand_data(('POST', 'PUT', 'PATCH', 'DELETE'))
 
 
+def provide_truncated_bodies():
+    """
+    Returns content encodings with documents truncated before the end of
+    their compressed streams.
+    See data_provider().
+    """
+    document = b'I am an excellent CV, mind you.'
+    return {
+        'gzip': ('gzip', gzip.compress(document)[:-8]),
+        'deflate': ('deflate', zlib.compress(document)[:-4]),
+    }
+
+
+def provide_batch_archive_content_types():
+    """
+    Returns the archive content types accepted by the /submit/batch endpoint.
+    See data_provider().
+    """
+    return expand_data(('application/x-tar', 'application/zip'))
+
+
 def provide_4xx_codes():
     """
     Returns the HTTP 4xx codes.
@@ -158,6 +187,116 @@ class SubmitTest(IntegrationTestCase):
         })
         self.assertEquals(400, response.status_code)
 
+    def testWithTooLargeDocumentShould413(self):
+        self._flask_app.config['MAX_DOCUMENT_SIZE'] = 9
+        response = self._flask_app_client.post('/submit', headers={
+            'Accept': 'text/plain',
+            'Content-Type': 'application/octet-stream'
+        }, data=b'I am an excellent CV, mind you.', query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+        })
+        self.assertEquals(413, response.status_code)
+
+    def testWithUnsupportedContentEncodingShould415(self):
+        response = self._flask_app_client.post('/submit', headers={
+            'Accept': 'text/plain',
+            'Content-Type': 'application/octet-stream',
+            'Content-Encoding': 'compress',
+        }, data=b'I am an excellent CV, mind you.', query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+        })
+        self.assertEquals(415, response.status_code)
+
+    def testWithMalformedContentEncodingShould400(self):
+        response = self._flask_app_client.post('/submit', headers={
+            'Accept': 'text/plain',
+            'Content-Type': 'application/octet-stream',
+            'Content-Encoding': 'gzip',
+        }, data=b'I am an excellent CV, mind you.', query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+        })
+        self.assertEquals(400, response.status_code)
+
+    @data_provider(provide_truncated_bodies)
+    def testWithTruncatedContentEncodingShould400(self, content_encoding, body):
+        response = self._flask_app_client.post('/submit', headers={
+            'Accept': 'text/plain',
+            'Content-Type': 'application/octet-stream',
+            'Content-Encoding': content_encoding,
+        }, data=body, query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+        })
+        self.assertEquals(400, response.status_code)
+
+    @requests_mock.mock()
+    def testSuccessWithGzipContentEncoding(self, m):
+        uploads = []
+
+        def _profile(request, _):
+            uploads.append(request.body.read())
+            return PROFILE
+        m.post(self._flask_app.config['SOURCEBOX_URL'], text=_profile)
+        response = self._flask_app_client.post('/submit', headers={
+            'Accept': 'text/plain',
+            'Content-Type': 'application/octet-stream',
+            'Content-Encoding': 'gzip',
+        }, data=gzip.compress(b'I am an excellent CV, mind you.'), query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+        })
+        self.assertEquals(200, response.status_code)
+        self._flask_app.process.wait(response.get_data(as_text=True), 9)
+        self.assertIn(b'I am an excellent CV, mind you.', uploads[0])
+
+    @requests_mock.mock()
+    def testSuccessWithServerTiming(self, m):
+        self._flask_app.config['SERVER_TIMING_ENABLED'] = True
+        m.post(self._flask_app.config['SOURCEBOX_URL'], text=PROFILE)
+        response = self._flask_app_client.post('/submit', headers={
+            'Accept': 'text/plain',
+            'Content-Type': 'application/octet-stream'
+        }, data=b'I am an excellent CV, mind you.', query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+        })
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(['auth', 'body', 'schedule', 'total'], [
+            metric.split(';')[0] for metric in response.headers['Server-Timing'].split(', ')])
+
+    def testWithDisallowedCallbackUrlShould400(self):
+        response = self._flask_app_client.post('/submit', headers={
+            'Accept': 'text/plain',
+            'Content-Type': 'application/octet-stream'
+        }, data=b'I am an excellent CV, mind you.', query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+            'callback_url': 'https://example.com/hooks/foo',
+        })
+        self.assertEquals(400, response.status_code)
+
+    @requests_mock.mock()
+    def testSuccessWithCallbackUrl(self, m):
+        callback_url = 'https://example.com/hooks/foo'
+        self._flask_app.config['CALLBACK_URLS'] = {
+            'User Foo': ['https://example.com/hooks/'],
+        }
+        m.post(self._flask_app.config['SOURCEBOX_URL'], text=PROFILE)
+        m.post(callback_url, status_code=204)
+        response = self._flask_app_client.post('/submit', headers={
+            'Accept': 'text/plain',
+            'Content-Type': 'application/octet-stream'
+        }, data=b'I am an excellent CV, mind you.', query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+            'callback_url': callback_url,
+        })
+        self.assertEquals(200, response.status_code)
+        process_id = response.get_data(as_text=True)
+        for _ in range(90):
+            if self._flask_app.process.retrieve(process_id) is None:
+                break
+            sleep(0.1)
+        callbacks = [request for request in m.request_history if request.url == callback_url]
+        self.assertEquals(1, len(callbacks))
+        self.assertEquals(PROFILE, callbacks[0].text)
+        self.assertEquals(process_id, callbacks[0].headers['X-Tk-Process-Id'])
+
     def testWithMissingAuthorizationShould401(self):
         response = self._flask_app_client.post('/submit', headers={
             'Accept': 'text/plain',
@@ -190,6 +329,141 @@ class SubmitTest(IntegrationTestCase):
             '[a-f0-9]{8}-?[a-f0-9]{4}-?4[a-f0-9]{3}-?[89ab][a-f0-9]{3}-?[a-f0-9]{12}')
 
 
+class MetricsTest(IntegrationTestCase):
+    def testMetrics(self):
+        self._flask_app_client.get('/retrieve/foo', headers={
+            'Accept': 'text/xml',
+        }, query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+        })
+        response = self._flask_app_client.get('/metrics')
+        self.assertEquals(200, response.status_code)
+        text = response.get_data(as_text=True)
+        self.assertIn('tk_requests_total{route="retrieve",status="404"}', text)
+        self.assertIn('tk_jwt_duration_seconds_count{operation="verify"}', text)
+        self.assertIn('tk_upstream_executor_queue_depth 0', text)
+
+
+class SubmitBatchTest(IntegrationTestCase):
+    def _post(self, data, content_type):
+        return self._flask_app_client.post('/submit/batch', headers={
+            'Accept': 'application/json',
+            'Content-Type': content_type,
+        }, data=data, query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+        })
+
+    def testWithUnsupportedMediaTypeShould415(self):
+        response = self._post(b'', 'application/octet-stream')
+        self.assertEquals(415, response.status_code)
+
+    def testWithMalformedArchiveShould400(self):
+        response = self._post(b'I am not an archive.', 'application/zip')
+        self.assertEquals(400, response.status_code)
+
+    @requests_mock.mock()
+    def testSuccessWithMultipart(self, m):
+        m.post(self._flask_app.config['SOURCEBOX_URL'], text=PROFILE)
+        response = self._flask_app_client.post('/submit/batch', headers={
+            'Accept': 'application/json',
+        }, data={
+            'foo': (io.BytesIO(b'I am an excellent CV, mind you.'), 'foo.txt'),
+            'bar': (io.BytesIO(b''), 'bar.txt'),
+        }, query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+        })
+        self.assertEquals(200, response.status_code)
+        items = sorted(json.loads(response.get_data(as_text=True)),
+                       key=lambda item: item['name'])
+        self.assertEquals('bar.txt', items[0]['name'])
+        self.assertIn('error', items[0])
+        self.assertEquals('foo.txt', items[1]['name'])
+        self.assertIn('process_id', items[1])
+
+    @requests_mock.mock()
+    def testSuccessWithTar(self, m):
+        m.post(self._flask_app.config['SOURCEBOX_URL'], text=PROFILE)
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w:gz') as archive:
+            for name, document in (('foo.txt', b'I am an excellent CV, mind you.'), ('bar.txt', b'I am an excellent CV too, mind you.')):
+                info = tarfile.TarInfo(name)
+                info.size = len(document)
+                archive.addfile(info, io.BytesIO(document))
+        response = self._post(data.getvalue(), 'application/x-tar')
+        self.assertEquals(200, response.status_code)
+        items = json.loads(response.get_data(as_text=True))
+        self.assertEquals(['foo.txt', 'bar.txt'], [item['name'] for item in items])
+        self.assertNotEqual(items[0]['process_id'], items[1]['process_id'])
+
+    @requests_mock.mock()
+    def testSuccessWithZip(self, m):
+        m.post(self._flask_app.config['SOURCEBOX_URL'], text=PROFILE)
+        self._flask_app.config['MAX_DOCUMENT_SIZE'] = 40
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, mode='w') as archive:
+            archive.writestr('foo.txt', b'I am an excellent CV, mind you.')
+            archive.writestr('bar.txt', b'I am an excellent CV, but I am too long for you.')
+        response = self._post(data.getvalue(), 'application/zip')
+        self.assertEquals(200, response.status_code)
+        items = json.loads(response.get_data(as_text=True))
+        self.assertEquals(['foo.txt', 'bar.txt'], [item['name'] for item in items])
+        self.assertIn('process_id', items[0])
+        self.assertIn('error', items[1])
+
+    def _tar(self, *documents):
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w') as archive:
+            for name, document in documents:
+                info = tarfile.TarInfo(name)
+                info.size = len(document)
+                archive.addfile(info, io.BytesIO(document))
+        return data.getvalue()
+
+    @requests_mock.mock()
+    def testWithTooManyDocumentsShouldStop(self, m):
+        m.post(self._flask_app.config['SOURCEBOX_URL'], text=PROFILE)
+        self._flask_app.config['MAX_BATCH_DOCUMENTS'] = 1
+        response = self._post(self._tar(*[('%d.txt' % index, b'I am an excellent CV, mind you.') for index in range(3)]),
+                              'application/x-tar')
+        self.assertEquals(200, response.status_code)
+        items = json.loads(response.get_data(as_text=True))
+        self.assertEquals(['0.txt', '1.txt'], [item['name'] for item in items])
+        self.assertIn('process_id', items[0])
+        self.assertIn('error', items[1])
+
+    @data_provider(provide_batch_archive_content_types)
+    def testWithTooLargeChunkedBodyShould413(self, content_type):
+        self._flask_app.config['MAX_BATCH_SIZE'] = 1024
+        data = self._tar(('foo.txt', b'I am an excellent CV, mind you.' * 99))
+        response = self._flask_app_client.post('/submit/batch', headers={
+            'Accept': 'application/json',
+            'Content-Type': content_type,
+            'Transfer-Encoding': 'chunked',
+        }, input_stream=io.BytesIO(data), environ_overrides={
+            'wsgi.input_terminated': True,
+        }, query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+        })
+        self.assertEquals(413, response.status_code)
+
+    def testWithTooLargeChunkedMultipartBodyShould413(self):
+        self._flask_app.config['MAX_BATCH_SIZE'] = 1024
+        data = b''.join((
+            b'--boundary\r\nContent-Disposition: form-data; name="foo"; filename="foo.txt"\r\n\r\n',
+            b'I am an excellent CV, mind you.' * 99,
+            b'\r\n--boundary--\r\n'))
+        response = self._flask_app_client.post('/submit/batch', headers={
+            'Accept': 'application/json',
+            'Content-Type': 'multipart/form-data; boundary=boundary',
+            'Transfer-Encoding': 'chunked',
+        }, input_stream=io.BytesIO(data), environ_overrides={
+            'wsgi.input_terminated': True,
+        }, query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+        })
+        self.assertEquals(413, response.status_code)
+
+
 class RetrieveTest(IntegrationTestCase):
     @data_provider(provide_disallowed_retrieve_methods)
     def testWithDisallowedMethodShould405(self, method):
@@ -274,6 +548,234 @@ class RetrieveTest(IntegrationTestCase):
         response = self._flask_app_client.get('/retrieve/%s' % process_id, headers=headers, query_string=query)
         self.assertEquals(response.status_code, 404)
 
+    @requests_mock.mock()
+    def testSuccessWithGzipAcceptEncoding(self, m):
+        user_name = 'User Foo'
+        profile = PROFILE * 9
+        m.post(self._flask_app.config['SOURCEBOX_URL'], text=profile)
+        process_id = self._flask_app.process.submit(
+            user_name, b'I am an excellent CV, mind you.')
+        response = self._flask_app_client.get('/retrieve/%s' % process_id,
+                                              headers={
+                                                  'Accept': 'text/xml',
+                                                  'Accept-Encoding': 'gzip',
+                                              }, query_string={
+                                                  'access_token': self._flask_app.auth.grant_access_token(user_name),
+                                                  'wait': 9,
+                                              })
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals('gzip', response.headers['Content-Encoding'])
+        self.assertEquals(profile, gzip.decompress(response.get_data()).decode('utf-8'))
+
+    @requests_mock.mock()
+    def testSuccessWithRange(self, m):
+        user_name = 'User Foo'
+        m.post(self._flask_app.config['SOURCEBOX_URL'], text=PROFILE)
+        process_id = self._flask_app.process.submit(
+            user_name, b'I am an excellent CV, mind you.')
+        query = {
+            'access_token': self._flask_app.auth.grant_access_token(user_name),
+            'wait': 9,
+        }
+        response = self._flask_app_client.get('/retrieve/%s' % process_id, headers={
+            'Accept': 'text/xml',
+            'Range': 'bytes=0-99',
+        }, query_string=query)
+        self.assertEquals(206, response.status_code)
+        self.assertEquals('bytes', response.headers['Accept-Ranges'])
+        self.assertEquals('bytes 0-99/%d' % len(PROFILE), response.headers['Content-Range'])
+        first_part = response.get_data(as_text=True)
+        # The process is kept until its last part is retrieved.
+        response = self._flask_app_client.get('/retrieve/%s' % process_id, headers={
+            'Accept': 'text/xml',
+            'Range': 'bytes=100-',
+            'If-Range': response.headers['ETag'],
+        }, query_string=query)
+        self.assertEquals(206, response.status_code)
+        self.assertEquals(PROFILE, first_part + response.get_data(as_text=True))
+        response = self._flask_app_client.get('/retrieve/%s' % process_id, headers={
+            'Accept': 'text/xml',
+        }, query_string=query)
+        self.assertEquals(404, response.status_code)
+
+    @requests_mock.mock()
+    def testSuccessWithSpilledProfile(self, m):
+        self._flask_app.config['RESULT_SPOOL_SIZE'] = 64
+        user_name = 'User Foo'
+        profile = PROFILE * 9
+        m.post(self._flask_app.config['SOURCEBOX_URL'], text=profile)
+        process_id = self._flask_app.process.submit(
+            user_name, b'I am an excellent CV, mind you.')
+        query = {
+            'access_token': self._flask_app.auth.grant_access_token(user_name),
+            'wait': 9,
+        }
+        response = self._flask_app_client.get('/retrieve/%s' % process_id, headers={
+            'Accept': 'text/xml',
+            'Accept-Encoding': 'gzip',
+            'Range': 'bytes=0-9',
+        }, query_string=query)
+        self.assertEquals(206, response.status_code)
+        self.assertEquals(profile[:10], response.get_data(as_text=True))
+        response = self._flask_app_client.get('/retrieve/%s' % process_id, headers={
+            'Accept': 'text/xml',
+            'Range': 'bytes=10-19',
+        }, query_string=query)
+        self.assertEquals(206, response.status_code)
+        self.assertEquals('bytes 10-19/%d' % len(profile), response.headers['Content-Range'])
+        self.assertEquals(profile[10:20], response.get_data(as_text=True))
+        response = self._flask_app_client.get('/retrieve/%s' % process_id, headers={
+            'Accept': 'text/xml',
+            'Accept-Encoding': 'gzip',
+        }, query_string=query)
+        self.assertEquals(200, response.status_code)
+        # Spilled profiles are streamed from disk, uncompressed.
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEquals(profile, response.get_data(as_text=True))
+        response = self._flask_app_client.get('/retrieve/%s' % process_id, headers={
+            'Accept': 'text/xml',
+        }, query_string=query)
+        self.assertEquals(404, response.status_code)
+
+    def testWithMatchingIfNoneMatchShould304AndKeepProfile(self):
+        process_id = self._flask_app.process.submit('User Foo', b'Foo')
+        self._flask_app.process._deliver(process_id, PROFILE)
+        query = {
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+        }
+        response = self._flask_app_client.get('/retrieve/%s' % process_id, headers={
+            'Accept': 'text/xml',
+            'If-None-Match': '"%s"' % process_id,
+        }, query_string=query)
+        self.assertEquals(304, response.status_code)
+        self.assertEquals('"%s"' % process_id, response.headers['ETag'])
+        response = self._flask_app_client.get('/retrieve/%s' % process_id, headers={
+            'Accept': 'text/xml',
+        }, query_string=query)
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(PROFILE, response.get_data(as_text=True))
+
+    def testProgressWithRangeShould200WithoutEtag(self):
+        process_id = 'foo'
+        self._flask_app.process._store.add(process_id, 'User Foo')
+        response = self._flask_app_client.get('/retrieve/%s' % process_id, headers={
+            'Accept': 'text/xml',
+            'Range': 'bytes=0-3',
+            'If-None-Match': '"%s"' % process_id,
+        }, query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+        })
+        self.assertEquals(200, response.status_code)
+        self.assertEquals('PROGRESS', response.get_data(as_text=True))
+        self.assertNotIn('ETag', response.headers)
+        self.assertNotIn('Accept-Ranges', response.headers)
+
+    def testWithMismatchingIfRangeShould200AndDeleteProfile(self):
+        process_id = self._flask_app.process.submit('User Foo', b'Foo')
+        self._flask_app.process._deliver(process_id, PROFILE)
+        query = {
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+        }
+        response = self._flask_app_client.get('/retrieve/%s' % process_id, headers={
+            'Accept': 'text/xml',
+            'Range': 'bytes=0-9',
+            'If-Range': '"bar"',
+        }, query_string=query)
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(PROFILE, response.get_data(as_text=True))
+        response = self._flask_app_client.get('/retrieve/%s' % process_id, headers={
+            'Accept': 'text/xml',
+        }, query_string=query)
+        self.assertEquals(404, response.status_code)
+
+    def testWithUnsatisfiableRangeShould416(self):
+        process_id = self._flask_app.process.submit('User Foo', b'Foo')
+        self._flask_app.process._deliver(process_id, PROFILE)
+        response = self._flask_app_client.get('/retrieve/%s' % process_id, headers={
+            'Accept': 'text/xml',
+            'Range': 'bytes=9999-',
+        }, query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+        })
+        self.assertEquals(416, response.status_code)
+        self.assertEquals('bytes */%d' % len(PROFILE), response.headers['Content-Range'])
+
+    @requests_mock.mock()
+    def testSuccessWithJson(self, m):
+        user_name = 'User Foo'
+        m.post(self._flask_app.config['SOURCEBOX_URL'], text=PROFILE.strip())
+        process_id = self._flask_app.process.submit(
+            user_name, b'I am an excellent CV, mind you.')
+        response = self._flask_app_client.get('/retrieve/%s' % process_id,
+                                              headers={
+                                                  'Accept': 'application/json',
+                                              }, query_string={
+                                                  'access_token': self._flask_app.auth.grant_access_token(user_name),
+                                                  'wait': 9,
+                                                  'fields': 'LastName,Address/City',
+                                              })
+        self.assertEquals(200, response.status_code)
+        self.assertEquals('application/json', response.mimetype)
+        self.assertEquals({
+            'LastName': 'van de Petra Paula Maria',
+            'Address': {
+                'City': 'EDE',
+            },
+        }, json.loads(response.get_data(as_text=True)))
+        # The conversion is not kept after the process is deleted.
+        self.assertEqual(0, len(self._flask_app._projector._cache))
+
+    def testWithInvalidFieldsShould400(self):
+        response = self._flask_app_client.get('/retrieve/foo', headers={
+            'Accept': 'application/json',
+        }, query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+            'fields': 'Address//City',
+        })
+        self.assertEquals(400, response.status_code)
+
+    def testWithInvalidWaitShould400(self):
+        response = self._flask_app_client.get('/retrieve/foo', headers={
+            'Accept': 'text/xml',
+        }, query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+            'wait': 'foo',
+        })
+        self.assertEquals(400, response.status_code)
+
+    @requests_mock.mock()
+    def testSuccessWithWaitForProcessedDocument(self, m):
+        user_name = 'User Foo'
+        m.post(self._flask_app.config['SOURCEBOX_URL'], text=delayed_profile)
+        process_id = self._flask_app.process.submit(
+            user_name, b'I am an excellent CV, mind you.')
+        response = self._flask_app_client.get('/retrieve/%s' % process_id,
+                                              headers={
+                                                  'Accept': 'text/xml',
+                                              }, query_string={
+                                                  'access_token': self._flask_app.auth.grant_access_token(user_name),
+                                                  'wait': 9,
+                                              })
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.get_data(as_text=True), PROFILE)
+
+    @requests_mock.mock()
+    def testSuccessWithWaitForUnprocessedDocument(self, m):
+        user_name = 'User Foo'
+        self._flask_app.config['RETRIEVE_MAX_WAIT'] = 1
+        m.post(self._flask_app.config['SOURCEBOX_URL'], text=delayed_profile)
+        process_id = self._flask_app.process.submit(
+            user_name, b'I am an excellent CV, mind you.')
+        response = self._flask_app_client.get('/retrieve/%s' % process_id,
+                                              headers={
+                                                  'Accept': 'text/xml',
+                                              }, query_string={
+                                                  'access_token': self._flask_app.auth.grant_access_token(user_name),
+                                                  'wait': 9,
+                                              })
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.get_data(as_text=True), 'PROGRESS')
+
     @requests_mock.mock()
     def testSuccessWithSomeoneElsesDocument(self, m):
         my_user_name = 'User Foo'
@@ -289,6 +791,23 @@ class RetrieveTest(IntegrationTestCase):
                                               })
         self.assertEquals(response.status_code, 403)
 
+    def testWithSomeoneElsesProfileShouldKeepProfile(self):
+        process_id = self._flask_app.process.submit('User Bar', b'Foo')
+        self._flask_app.process._deliver(process_id, PROFILE)
+        response = self._flask_app_client.get('/retrieve/%s' % process_id, headers={
+            'Accept': 'text/xml',
+        }, query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Foo'),
+        })
+        self.assertEquals(403, response.status_code)
+        response = self._flask_app_client.get('/retrieve/%s' % process_id, headers={
+            'Accept': 'text/xml',
+        }, query_string={
+            'access_token': self._flask_app.auth.grant_access_token('User Bar'),
+        })
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(PROFILE, response.get_data(as_text=True))
+
     @requests_mock.mock()
     @data_provider(provide_4xx_codes)
     def testWithUpstream4xxResponse(self, m, upstream_status_code):
@@ -338,3 +857,109 @@ class RetrieveTest(IntegrationTestCase):
         response = self._flask_app_client.get('/retrieve/%s' % process_id,
                                               headers=headers, query_string=query)
         self.assertEquals(response.status_code, 404)
+
+
+class RetrieveBatchTest(IntegrationTestCase):
+    def _retrieve_batch(self, process_ids, accept='application/x-ndjson', **query):
+        query['access_token'] = self._flask_app.auth.grant_access_token('User Foo')
+        return self._flask_app_client.post('/retrieve/batch', headers={
+            'Accept': accept,
+            'Content-Type': 'application/json',
+        }, data=json.dumps(process_ids), query_string=query)
+
+    def testWithNotAcceptableShould406(self):
+        response = self._retrieve_batch([], 'text/xml')
+        self.assertEquals(406, response.status_code)
+
+    def testWithMalformedBodyShould400(self):
+        response = self._retrieve_batch({'foo': 'bar'})
+        self.assertEquals(400, response.status_code)
+
+    def testWithTooManyProcessIdsShould400(self):
+        self._flask_app.config['MAX_BATCH_RETRIEVE_PROCESSES'] = 1
+        response = self._retrieve_batch(['foo', 'bar'])
+        self.assertEquals(400, response.status_code)
+
+    def testWithMissingAuthorizationShould401(self):
+        response = self._flask_app_client.post('/retrieve/batch', headers={
+            'Accept': 'application/x-ndjson',
+            'Content-Type': 'application/json',
+        }, data='[]')
+        self.assertEquals(401, response.status_code)
+
+    @requests_mock.mock()
+    def testSuccess(self, m):
+        m.post(self._flask_app.config['SOURCEBOX_URL'], text=PROFILE)
+        process_id = self._flask_app.process.submit(
+            'User Foo', b'I am an excellent CV, mind you.')
+        someone_elses_process_id = self._flask_app.process.submit(
+            'User Bar', b'I am an excellent CV too, mind you.')
+        self._flask_app.process.wait(process_id, 9)
+        self._flask_app.process.wait(someone_elses_process_id, 9)
+        process_ids = [process_id, someone_elses_process_id, 'foo']
+
+        response = self._retrieve_batch(process_ids)
+        self.assertEquals(200, response.status_code)
+        self.assertEquals('application/x-ndjson', response.mimetype)
+        self.assertEquals([
+            {'process_id': process_id, 'status': 'done'},
+            {'process_id': someone_elses_process_id, 'status': 'unknown'},
+            {'process_id': 'foo', 'status': 'unknown'},
+        ], [json.loads(line) for line in response.get_data(as_text=True).splitlines()])
+
+        response = self._retrieve_batch(process_ids, profiles='true')
+        self.assertEquals(200, response.status_code)
+        items = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEquals({'process_id': process_id, 'status': 'done',
+                           'profile': PROFILE}, items[0])
+
+        # Confirm retrieved profiles are deleted, like with /retrieve.
+        response = self._retrieve_batch(process_ids)
+        items = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEquals('unknown', items[0]['status'])
+        self.assertIsNotNone(self._flask_app.process.retrieve(someone_elses_process_id))
+
+    @requests_mock.mock()
+    def testSuccessWithMultipart(self, m):
+        m.post(self._flask_app.config['SOURCEBOX_URL'], status_code=503)
+        process_id = self._flask_app.process.submit(
+            'User Foo', b'I am an excellent CV, mind you.')
+        self._flask_app.process.wait(process_id, 9)
+        response = self._retrieve_batch([process_id, 'foo'],
+                                        'multipart/mixed', profiles='1')
+        self.assertEquals(200, response.status_code)
+        self.assertEquals('multipart/mixed', response.mimetype)
+        boundary = response.mimetype_params['boundary']
+        parts = response.get_data(as_text=True).split('--%s' % boundary)
+        self.assertEquals(4, len(parts))
+        self.assertIn('X-Tk-Process-Id: %s\r\nX-Tk-Status: error\r\nX-Tk-Error: upstream' % process_id, parts[1])
+        self.assertIn('X-Tk-Process-Id: foo\r\nX-Tk-Status: unknown', parts[2])
+        self.assertEquals('--\r\n', parts[3])
+
+
+class AppTest(IntegrationTestCase):
+    def testStartShouldBeLazy(self):
+        self.assertIsNone(self._flask_app._process)
+        self.assertIsNotNone(self._flask_app.process)
+
+    def testClose(self):
+        closed = []
+        process = self._flask_app.process
+        self._flask_app.add_close_hook(lambda: closed.append(True))
+        self._flask_app.close()
+        self.assertEqual([True], closed)
+        self.assertIsNone(self._flask_app._process)
+        self.assertIsNot(process, self._flask_app.process)
+
+    @skipUnless(hasattr(os, 'register_at_fork'), 'Python 3.7+ is required to reset apps after forking.')
+    def testForkShouldRestart(self):
+        self._flask_app.start()
+        pid = os.fork()
+        if 0 == pid:
+            # Exit the child without running the test runner's cleanup.
+            started = self._flask_app._process is not None
+            os._exit(1 if started or self._flask_app.process is None else 0)
+        _, status = os.waitpid(pid, 0)
+        self.assertTrue(os.WIFEXITED(status))
+        self.assertEqual(0, os.WEXITSTATUS(status))
+        self.assertIsNotNone(self._flask_app._process)
@@ -0,0 +1,71 @@
+from threading import Thread
+from unittest import TestCase
+
+from tk.metrics import Counter, Gauge, Histogram
+
+
+class CounterTest(TestCase):
+    def testInc(self):
+        counter = Counter('tk_foo_total', 'Foo.', ('bar',))
+        counter.inc('Bar')
+        counter.inc('Bar', amount=2)
+        counter.inc('Baz')
+        self.assertEqual('''# HELP tk_foo_total Foo.
+# TYPE tk_foo_total counter
+tk_foo_total{bar="Bar"} 3
+tk_foo_total{bar="Baz"} 1
+''', counter.render())
+
+    def testIncFromThreads(self):
+        counter = Counter('tk_foo_total', 'Foo.')
+
+        def _inc():
+            for _ in range(1000):
+                counter.inc()
+        threads = [Thread(target=_inc) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc()
+        self.assertIn('tk_foo_total 4001\n', counter.render())
+        # Cells of finished threads are retired, but still counted.
+        self.assertEqual(1, len(counter._cells))
+        self.assertIn('tk_foo_total 4001\n', counter.render())
+
+    def testIncFromThreadsWithoutCollecting(self):
+        counter = Counter('tk_foo_total', 'Foo.')
+        for _ in range(16):
+            thread = Thread(target=counter.inc)
+            thread.start()
+            thread.join()
+        # Cells of finished threads are retired as new threads register.
+        self.assertEqual(1, len(counter._cells))
+        self.assertIn('tk_foo_total 16\n', counter.render())
+
+
+class HistogramTest(TestCase):
+    def testObserve(self):
+        histogram = Histogram('tk_foo_seconds', 'Foo.', buckets=(1, 2))
+        histogram.observe(0.5)
+        histogram.observe(2)
+        histogram.observe(3)
+        self.assertEqual('''# HELP tk_foo_seconds Foo.
+# TYPE tk_foo_seconds histogram
+tk_foo_seconds_bucket{le="1"} 1
+tk_foo_seconds_bucket{le="2"} 2
+tk_foo_seconds_bucket{le="+Inf"} 3
+tk_foo_seconds_sum 5.5
+tk_foo_seconds_count 3
+''', histogram.render())
+
+
+class GaugeTest(TestCase):
+    def testRender(self):
+        gauge = Gauge('tk_foo', 'Foo.', lambda: {
+            ('Bar',): 1,
+        }, ('bar',))
+        self.assertEqual('''# HELP tk_foo Foo.
+# TYPE tk_foo gauge
+tk_foo{bar="Bar"} 1
+''', gauge.render())
@@ -0,0 +1,313 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import Future
+from unittest import TestCase
+
+from tk.process import Process
+from tk.scheduler import QueueFull, Scheduler
+from tk.store import SpilledResult
+from tk.upstream import CircuitBreaker, RetryPolicy, UpstreamTarget
+
+
+class FakeResponse:
+    encoding = 'utf-8'
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def iter_content(self, chunk_size):
+        body = self.text.encode('utf-8')
+        for offset in range(0, len(body), chunk_size):
+            yield body[offset:offset + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    """
+    Records upstream requests, so tests can respond to them at will.
+    """
+
+    def __init__(self):
+        self.futures = []
+        self.urls = []
+
+    def post(self, url, *args, **kwargs):
+        future = Future()
+        self.futures.append(future)
+        self.urls.append(url)
+        return future
+
+
+class FakeCallbackDispatcher:
+    """
+    Records deliveries, and reports them as successful.
+    """
+
+    def __init__(self):
+        self.deliveries = []
+
+    def deliver(self, url, process_id, result, content_type, on_success):
+        self.deliveries.append((url, process_id, result, content_type))
+        on_success()
+
+
+class ImmediateRetryProcess(Process):
+    """
+    Retries upstream requests without waiting.
+    """
+
+    def _call_later(self, delay, callback):
+        callback()
+
+
+class ProcessTest(TestCase):
+    def setUp(self):
+        self._session = FakeSession()
+        self._spool_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._spool_directory)
+
+    def _build_process(self, scheduler=None, circuit_breaker=None, retry_policy=None, callback_dispatcher=None, result_spool_size=1024 * 1024, upstream_targets=None):
+        return ImmediateRetryProcess(
+            self._session, 'https://example.com', None, None, None,
+            scheduler=scheduler, circuit_breaker=circuit_breaker,
+            retry_policy=retry_policy or RetryPolicy(max_retries=0),
+            callback_dispatcher=callback_dispatcher,
+            result_spool_size=result_spool_size,
+            result_spool_directory=self._spool_directory,
+            upstream_targets=upstream_targets)
+
+    def _respond(self, process, index, text, status_code=200):
+        self._session.futures[index].set_result(
+            FakeResponse(status_code, text))
+
+    def _fail(self, process, index):
+        self._session.futures[index].set_exception(ConnectionError())
+
+    def testRetrieve(self):
+        process = self._build_process()
+        process_id = process.submit('User Foo', b'Foo')
+        self.assertEqual(('User Foo', Process.PROGRESS),
+                         process.retrieve(process_id))
+        self._respond(process, 0, 'Profile')
+        self.assertEqual(('User Foo', 'Profile'), process.retrieve(process_id))
+        self.assertIsNone(process.retrieve(process_id))
+
+    def testRetrieveSpilledResult(self):
+        process = self._build_process(result_spool_size=4)
+        process_id_a = process.submit('User Foo', b'Foo')
+        process_id_b = process.submit('User Bar', b'Foo')
+        self._respond(process, 0, 'Profile')
+        user_name, result_a = process.retrieve(process_id_a)
+        self.assertIsInstance(result_a, SpilledResult)
+        result_a.delete()
+        # Every process owns its spilled result.
+        user_name, result_b = process.retrieve(process_id_b)
+        self.assertEqual('User Bar', user_name)
+        self.assertEqual('Profile', result_b.read())
+        result_b.delete()
+        self.assertEqual([], os.listdir(self._spool_directory))
+
+    def testSubmitShouldDeleteSpilledErrors(self):
+        process = self._build_process(result_spool_size=4)
+        process_id = process.submit('User Foo', b'Foo')
+        self._respond(process, 0, 'Bad request', 400)
+        self.assertEqual(('User Foo', Process.ERROR_INTERNAL),
+                         process.retrieve(process_id))
+        self.assertEqual([], os.listdir(self._spool_directory))
+
+    def testStats(self):
+        process = self._build_process()
+        process.submit('User Foo', b'Foo')
+        process.submit('User Foo', b'Bar')
+        self._respond(process, 1, 'Profile')
+        stats = process.stats()
+        self.assertEqual(1, stats['progress'])
+        self.assertEqual(1, stats['finished'])
+        self.assertLess(0, stats['bytes'])
+
+    def testSubmitDuplicateDocumentInFlight(self):
+        process = self._build_process()
+        process_id_a = process.submit('User Foo', b'Foo')
+        process_id_b = process.submit('User Bar', b'Foo')
+        self.assertNotEqual(process_id_a, process_id_b)
+        self.assertEqual(1, len(self._session.futures))
+        self._respond(process, 0, 'Profile')
+        self.assertEqual(('User Foo', 'Profile'), process.retrieve(process_id_a))
+        self.assertEqual(('User Bar', 'Profile'), process.retrieve(process_id_b))
+
+    def testSubmitDuplicateDocumentFinished(self):
+        process = self._build_process()
+        process.submit('User Foo', b'Foo')
+        self._respond(process, 0, 'Profile')
+        process_id = process.submit('User Bar', b'Foo')
+        self.assertEqual(1, len(self._session.futures))
+        self.assertEqual(('User Bar', 'Profile'), process.retrieve(process_id))
+
+    def testSubmitDuplicateDocumentFailed(self):
+        process = self._build_process()
+        process.submit('User Foo', b'Foo')
+        self._respond(process, 0, '', 503)
+        process.submit('User Bar', b'Foo')
+        self.assertEqual(2, len(self._session.futures))
+
+    def testSubmitShouldQueueOverLimit(self):
+        process = self._build_process(Scheduler(max_in_flight=1))
+        process.submit('User Foo', b'Foo')
+        process_id = process.submit('User Foo', b'Bar')
+        self.assertEqual(1, len(self._session.futures))
+        self.assertEqual(0, process.queue_position(process_id)[0])
+        self._respond(process, 0, 'Profile')
+        self.assertEqual(2, len(self._session.futures))
+        self.assertIsNone(process.queue_position(process_id))
+
+    def testJobsShouldBeReleasedWhileInFlight(self):
+        released_in_flight = []
+
+        class _Scheduler(Scheduler):
+            def release(self, job_id):
+                released_in_flight.append(job_id in process._in_flight)
+                super().release(job_id)
+        process = self._build_process(_Scheduler())
+        process.submit('User Foo', b'Foo')
+        process.submit('User Foo', b'Bar')
+        self._respond(process, 0, 'Profile')
+        self._fail(process, 1)
+        # Resubmissions attach to the document until its job is released, so
+        # they cannot start a job under the same ID.
+        self.assertEqual([True, True], released_in_flight)
+
+    def testSubmitWithFullQueue(self):
+        process = self._build_process(Scheduler(max_in_flight=1,
+                                                max_queue_depth=0))
+        process.submit('User Foo', b'Foo')
+        with self.assertRaises(QueueFull):
+            process.submit('User Foo', b'Bar')
+        # Duplicate documents do not need to be queued.
+        process.submit('User Bar', b'Foo')
+
+    def testSubmitWithConnectionError(self):
+        process = self._build_process()
+        process_id = process.submit('User Foo', b'Foo')
+        self._fail(process, 0)
+        self.assertEqual(('User Foo', Process.ERROR_UPSTREAM),
+                         process.retrieve(process_id))
+
+    def testSubmitShouldRetry(self):
+        process = self._build_process(retry_policy=RetryPolicy(max_retries=2))
+        process_id = process.submit('User Foo', b'Foo')
+        self._fail(process, 0)
+        self._respond(process, 1, '', 503)
+        self.assertEqual(('User Foo', Process.PROGRESS),
+                         process.retrieve(process_id))
+        self._respond(process, 2, 'Profile')
+        self.assertEqual(('User Foo', 'Profile'), process.retrieve(process_id))
+        self.assertEqual(2, process.stats()['retries']['retries'])
+
+    def testSubmitShouldNotRetryMoreThanMaxRetries(self):
+        process = self._build_process(retry_policy=RetryPolicy(max_retries=1))
+        process_id = process.submit('User Foo', b'Foo')
+        self._fail(process, 0)
+        self._fail(process, 1)
+        self.assertEqual(2, len(self._session.futures))
+        self.assertEqual(('User Foo', Process.ERROR_UPSTREAM),
+                         process.retrieve(process_id))
+
+    def testSubmitWithOpenCircuit(self):
+        process = self._build_process(
+            circuit_breaker=CircuitBreaker(failure_threshold=1))
+        process.submit('User Foo', b'Foo')
+        self._fail(process, 0)
+        process_id = process.submit('User Foo', b'Bar')
+        self.assertEqual(1, len(self._session.futures))
+        self.assertEqual(('User Foo', Process.ERROR_UPSTREAM),
+                         process.retrieve(process_id))
+
+    def testSubmitWithOpenCircuitShouldDrainLargeQueue(self):
+        scheduler = Scheduler(max_in_flight=1)
+        process = self._build_process(
+            scheduler, circuit_breaker=CircuitBreaker(failure_threshold=1))
+        process.submit('User Foo', b'Foo')
+        process_ids = [process.submit('User Foo', str(index).encode('utf-8'))
+                       for index in range(5000)]
+        self._fail(process, 0)
+        self.assertEqual(1, len(self._session.futures))
+        for process_id in process_ids:
+            self.assertEqual(('User Foo', Process.ERROR_UPSTREAM),
+                             process.retrieve(process_id))
+        self.assertEqual({
+            'running': 0,
+            'queued': 0,
+            'queued_users': 0,
+        }, scheduler.stats())
+
+    def testSubmitShouldSpreadDocumentsOverTargets(self):
+        targets = [UpstreamTarget('https://%s.example.com' % name, name, None,
+                                  None, circuit_breaker=CircuitBreaker(failure_threshold=1),
+                                  name=name)
+                   for name in ('foo', 'bar')]
+        process = self._build_process(
+            retry_policy=RetryPolicy(max_retries=1, backoff=0),
+            upstream_targets=targets)
+        process.submit('User Foo', b'Foo')
+        process_id = process.submit('User Foo', b'Bar')
+        self.assertEqual(['https://foo.example.com', 'https://bar.example.com'],
+                         self._session.urls)
+        # The retry goes to the target that is still healthy.
+        self._respond(process, 1, 'Upstream error', 503)
+        self.assertEqual('https://foo.example.com', self._session.urls[2])
+        self._respond(process, 2, 'Profile')
+        self.assertEqual(('User Foo', 'Profile'), process.retrieve(process_id))
+        stats = process.stats()['targets']
+        self.assertEqual(1, stats['foo']['outstanding'])
+        self.assertEqual(1, stats['bar']['failures'])
+        self.assertEqual(CircuitBreaker.OPEN, stats['bar']['circuit']['state'])
+
+    def testProfilesShouldBeCachedUnderAllTargets(self):
+        def _targets(*names):
+            return [UpstreamTarget('https://%s.example.com' % name, name, None, None)
+                    for name in names]
+        upstream_key = self._build_process(
+            upstream_targets=_targets('foo', 'bar'))._upstream_key
+        self.assertNotEqual(upstream_key, self._build_process(
+            upstream_targets=_targets('foo', 'baz'))._upstream_key)
+        self.assertEqual(upstream_key, self._build_process(
+            upstream_targets=_targets('bar', 'foo'))._upstream_key)
+
+    def testSubmitWithCallbackUrl(self):
+        dispatcher = FakeCallbackDispatcher()
+        process = self._build_process(callback_dispatcher=dispatcher)
+        process_id = process.submit('User Foo', b'Foo',
+                                    'https://example.com/hooks/foo')
+        self._respond(process, 0, 'Profile')
+        self.assertEqual([('https://example.com/hooks/foo', process_id,
+                           'Profile', 'text/xml')], dispatcher.deliveries)
+        # Delivered results are not kept for /retrieve.
+        self.assertIsNone(process.retrieve(process_id))
+
+    def testRetrieveMany(self):
+        process = self._build_process()
+        finished_process_id = process.submit('User Foo', b'Foo')
+        progress_process_id = process.submit('User Foo', b'Bar')
+        someone_elses_process_id = process.submit('User Bar', b'Baz')
+        self._respond(process, 0, 'Profile')
+        self._respond(process, 2, 'Someone else\'s profile')
+        process_ids = [finished_process_id, progress_process_id,
+                       someone_elses_process_id, 'qux']
+        expected = [(finished_process_id, 'Profile'),
+                    (progress_process_id, Process.PROGRESS),
+                    (someone_elses_process_id, None),
+                    ('qux', None)]
+        # Status-only retrievals do not read profiles.
+        self.assertEqual([(finished_process_id, Process.DONE)] + expected[1:],
+                         list(process.retrieve_many('User Foo', process_ids,
+                                                    False)))
+        self.assertEqual(expected, list(process.retrieve_many(
+            'User Foo', process_ids)))
+        self.assertIsNone(process.retrieve(finished_process_id))
+        self.assertIsNotNone(process.retrieve(someone_elses_process_id))
@@ -0,0 +1,98 @@
+import asyncio
+import json
+from unittest import TestCase
+from xml.etree.ElementTree import ParseError
+
+from tk.projection import InvalidFields, ProfileProjector, parse_fields, \
+    project
+
+PROFILE = """<?xml version="1.0" encoding="UTF-8" ?>
+<Profile xmlns="urn:example">
+  <FirstName>Taalbeheersing</FirstName>
+  <Address type="home">
+    <StreetName>Hoofdstraat</StreetName>
+    <City>EDE</City>
+  </Address>
+  <Skill>Dutch</Skill>
+  <Skill>English</Skill>
+  <Note lang="nl">Ja</Note>
+</Profile>
+"""
+
+
+class ParseFieldsTest(TestCase):
+    def testWithoutFields(self):
+        self.assertIsNone(parse_fields(None))
+        self.assertIsNone(parse_fields(''))
+
+    def testWithFields(self):
+        self.assertEqual((('FirstName',), ('Address', 'City')),
+                         parse_fields('FirstName, Address/City,FirstName'))
+
+    def testWithEmptyPathSegment(self):
+        with self.assertRaises(InvalidFields):
+            parse_fields('Address//City')
+
+
+class ProjectTest(TestCase):
+    def testWithoutFields(self):
+        self.assertEqual({
+            'FirstName': 'Taalbeheersing',
+            'Address': {
+                '@type': 'home',
+                'StreetName': 'Hoofdstraat',
+                'City': 'EDE',
+            },
+            'Skill': ['Dutch', 'English'],
+            'Note': {
+                '@lang': 'nl',
+                '#text': 'Ja',
+            },
+        }, json.loads(project(PROFILE)))
+
+    def testWithFields(self):
+        self.assertEqual({
+            'Address': {
+                'City': 'EDE',
+            },
+            'Skill': ['Dutch', 'English'],
+        }, json.loads(project(PROFILE, parse_fields('Address/City,Skill,Foo/Bar'))))
+
+    def testWithUnknownFields(self):
+        self.assertEqual({}, json.loads(project(PROFILE, parse_fields('Foo'))))
+
+    def testWithMalformedProfile(self):
+        with self.assertRaises(ParseError):
+            project('<Profile><FirstName></Profile>')
+
+
+class ProfileProjectorTest(TestCase):
+    def testProjectInline(self):
+        projector = ProfileProjector(0)
+        fields = parse_fields('FirstName')
+        self.assertEqual('{"FirstName": "Taalbeheersing"}',
+                         projector.project(PROFILE, fields))
+        self.assertEqual('{"FirstName": "Taalbeheersing"}',
+                         projector.project(PROFILE, fields))
+        self.assertEqual(1, projector._cache.hits)
+
+    def testForget(self):
+        projector = ProfileProjector(0)
+        projector.project(PROFILE, parse_fields('FirstName'))
+        projector.project(PROFILE, parse_fields('Skill'))
+        projector.forget(PROFILE)
+        self.assertEqual(0, len(projector._cache))
+
+    def testProjectInWorkerProcess(self):
+        projector = ProfileProjector(1, 0)
+        try:
+            self.assertEqual('{"FirstName": "Taalbeheersing"}',
+                             projector.project(PROFILE, parse_fields('FirstName')))
+            loop = asyncio.new_event_loop()
+            try:
+                self.assertEqual('{"Skill": ["Dutch", "English"]}', loop.run_until_complete(
+                    projector.project_async(PROFILE, parse_fields('Skill'))))
+            finally:
+                loop.close()
+        finally:
+            projector.close()
@@ -0,0 +1,85 @@
+from unittest import TestCase
+
+from tk.scheduler import QueueFull, Scheduler, queue_position_headers
+
+
+class SchedulerTest(TestCase):
+    def setUp(self):
+        self._started = []
+
+    def _job(self, job_id):
+        return lambda: self._started.append(job_id)
+
+    def testSubmitShouldRunJobsUpToLimit(self):
+        scheduler = Scheduler(max_in_flight=2)
+        for job_id in ('foo', 'bar', 'baz'):
+            scheduler.submit('User Foo', job_id, self._job(job_id))
+        self.assertEqual(['foo', 'bar'], self._started)
+        scheduler.release('foo')
+        self.assertEqual(['foo', 'bar', 'baz'], self._started)
+
+    def testAdmitWithFullQueue(self):
+        scheduler = Scheduler(max_in_flight=1, max_queue_depth=1)
+        scheduler.admit()
+        scheduler.submit('User Foo', 'foo', self._job('foo'))
+        scheduler.admit()
+        scheduler.submit('User Foo', 'bar', self._job('bar'))
+        with self.assertRaises(QueueFull) as context:
+            scheduler.admit()
+        self.assertLess(0, context.exception.retry_after)
+
+    def testReleaseShouldServeUsersRoundRobin(self):
+        scheduler = Scheduler(max_in_flight=1)
+        scheduler.submit('User Foo', 'running', self._job('running'))
+        for job_id in ('foo1', 'foo2', 'foo3'):
+            scheduler.submit('User Foo', job_id, self._job(job_id))
+        scheduler.submit('User Bar', 'bar1', self._job('bar1'))
+        for job_id in ('running', 'foo1', 'bar1', 'foo2'):
+            scheduler.release(job_id)
+        self.assertEqual(['running', 'foo1', 'bar1', 'foo2', 'foo3'],
+                         self._started)
+
+    def testReleaseShouldApplyUserWeights(self):
+        scheduler = Scheduler(max_in_flight=1, user_weights={
+            'User Foo': 2,
+        })
+        scheduler.submit('User Foo', 'running', self._job('running'))
+        for job_id in ('foo1', 'foo2', 'foo3'):
+            scheduler.submit('User Foo', job_id, self._job(job_id))
+        scheduler.submit('User Bar', 'bar1', self._job('bar1'))
+        for job_id in ('running', 'foo1', 'foo2', 'bar1'):
+            scheduler.release(job_id)
+        self.assertEqual(['running', 'foo1', 'foo2', 'bar1', 'foo3'],
+                         self._started)
+
+    def testPosition(self):
+        scheduler = Scheduler(max_in_flight=1)
+        scheduler.submit('User Foo', 'running', self._job('running'))
+        for job_id in ('foo1', 'foo2', 'foo3'):
+            scheduler.submit('User Foo', job_id, self._job(job_id))
+        scheduler.submit('User Bar', 'bar1', self._job('bar1'))
+        self.assertIsNone(scheduler.position('running'))
+        self.assertEqual(0, scheduler.position('foo1')[0])
+        self.assertEqual(1, scheduler.position('bar1')[0])
+        self.assertEqual(3, scheduler.position('foo3')[0])
+
+    def testStats(self):
+        scheduler = Scheduler(max_in_flight=1)
+        scheduler.submit('User Foo', 'foo', self._job('foo'))
+        scheduler.submit('User Bar', 'bar', self._job('bar'))
+        self.assertEqual({
+            'running': 1,
+            'queued': 1,
+            'queued_users': 1,
+        }, scheduler.stats())
+
+
+class QueuePositionHeadersTest(TestCase):
+    def testWithoutPosition(self):
+        self.assertEqual({}, queue_position_headers(None))
+
+    def testWithPosition(self):
+        self.assertEqual({
+            'X-Queue-Position': '3',
+            'Retry-After': '9',
+        }, queue_position_headers((3, 9)))
@@ -0,0 +1,28 @@
+from unittest import TestCase
+
+import requests_mock
+
+from tk.session import UpstreamSession
+
+
+class UpstreamSessionTest(TestCase):
+    def testStatsWithoutRequests(self):
+        session = UpstreamSession(executor_workers=3)
+        stats = session.stats()
+        self.assertEqual(3, stats['executor_workers'])
+        self.assertEqual(0, stats['executor_queue_depth'])
+        self.assertEqual({}, stats['pools'])
+
+    @requests_mock.mock()
+    def testRequestShouldApplyTimeout(self, m):
+        m.get('https://example.com')
+        session = UpstreamSession(connect_timeout=3, read_timeout=9)
+        session.get('https://example.com').result()
+        self.assertEqual((3, 9), m.last_request.timeout)
+
+    @requests_mock.mock()
+    def testWithoutKeepAlive(self, m):
+        m.get('https://example.com')
+        session = UpstreamSession(keep_alive=False)
+        session.get('https://example.com').result()
+        self.assertEqual('close', m.last_request.headers['Connection'])
@@ -0,0 +1,335 @@
+import base64
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Thread
+from unittest import TestCase
+
+from tk.store import MemoryResultStore, ResultSpool, SpilledResult, \
+    SqliteResultStore
+
+
+def _spill(directory, result):
+    """
+    Spills a result to a file.
+    :return: SpilledResult
+    """
+    spool = ResultSpool('utf-8', 0, directory)
+    spool.write(result.encode('utf-8'))
+    return spool.finish()
+
+
+class ResultSpoolTest(TestCase):
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def testFinishInMemory(self):
+        spool = ResultSpool('utf-8', 1024, self._directory)
+        spool.write('Profiel voor J'.encode('utf-8'))
+        # Split a multibyte character across chunks.
+        spool.write('ü'.encode('utf-8')[:1])
+        spool.write('ü'.encode('utf-8')[1:] + b'rgen')
+        self.assertEqual('Profiel voor Jürgen', spool.finish())
+        self.assertEqual([], os.listdir(self._directory))
+
+    def testFinishSpilled(self):
+        spool = ResultSpool('iso-8859-1', 8, self._directory)
+        spool.write('Profiel voor '.encode('iso-8859-1'))
+        spool.write('Jürgen'.encode('iso-8859-1'))
+        result = spool.finish()
+        self.assertIsInstance(result, SpilledResult)
+        self.assertEqual(len('Profiel voor Jürgen'.encode('utf-8')), result.size)
+        self.assertEqual('Profiel voor Jürgen', result.read())
+        result.delete()
+        self.assertEqual([], os.listdir(self._directory))
+
+    def testDiscard(self):
+        spool = ResultSpool('utf-8', 0, self._directory)
+        spool.write(b'Profile')
+        spool.discard()
+        self.assertEqual([], os.listdir(self._directory))
+
+    def testLink(self):
+        result = _spill(self._directory, 'Profile')
+        link = result.link()
+        result.delete()
+        self.assertEqual('Profile', link.read())
+        link.delete()
+        self.assertEqual([], os.listdir(self._directory))
+
+
+class ResultStoreTestMixin:
+    def _build_store(self, **kwargs):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self._now = 0
+        self._spool_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._spool_directory)
+
+    def testRetrieve(self):
+        store = self._build_store()
+        store.add('foo', 'User Foo')
+        self.assertEqual(('User Foo', None), store.retrieve('foo'))
+        self.assertTrue(store.complete('foo', 'Profile'))
+        self.assertEqual(('User Foo', 'Profile'), store.retrieve('foo'))
+        self.assertIsNone(store.retrieve('foo'))
+
+    def testPeek(self):
+        store = self._build_store()
+        self.assertIsNone(store.peek('foo'))
+        store.add('foo', 'User Foo')
+        self.assertEqual(('User Foo', None), store.peek('foo'))
+        store.complete('foo', 'Profile')
+        self.assertEqual(('User Foo', 'Profile'), store.peek('foo'))
+        self.assertEqual(('User Foo', 'Profile'), store.retrieve('foo'))
+
+    def testStatus(self):
+        store = self._build_store()
+        self.assertIsNone(store.status('foo'))
+        store.add('foo', 'User Foo')
+        self.assertEqual(('User Foo', None), store.status('foo'))
+        store.complete('foo', 'Profiel voor Jürgen')
+        self.assertEqual(('User Foo', 20), store.status('foo'))
+        store.add('bar', 'User Foo')
+        store.complete('bar', _spill(self._spool_directory, 'Profile'))
+        self.assertEqual(('User Foo', 7), store.status('bar'))
+        result = store.retrieve('bar')[1]
+        if isinstance(result, SpilledResult):
+            result.delete()
+
+    def testCompleteWithUnknownProcess(self):
+        store = self._build_store()
+        self.assertFalse(store.complete('foo', 'Profile'))
+
+    def testWait(self):
+        store = self._build_store()
+        store.add('foo', 'User Foo')
+        self.assertFalse(store.wait('foo', 0.01))
+        store.complete('foo', 'Profile')
+        self.assertTrue(store.wait('foo', 0.01))
+
+    def testEvictExpiredProgress(self):
+        store = self._build_store(progress_ttl=9)
+        store.add('foo', 'User Foo')
+        self._now = 9
+        store.add('bar', 'User Foo')
+        self.assertIsNone(store.retrieve('foo'))
+        self.assertTrue(store.wait('foo', 0))
+        self.assertEqual(1, store.stats()['evictions']['progress_ttl'])
+        # A late result for an evicted process must be ignored.
+        self.assertFalse(store.complete('foo', 'Profile'))
+        self.assertIsNone(store.retrieve('foo'))
+
+    def testEvictExpiredResult(self):
+        store = self._build_store(result_ttl=9)
+        store.add('foo', 'User Foo')
+        store.complete('foo', 'Profile')
+        self._now = 9
+        store.add('bar', 'User Foo')
+        self.assertIsNone(store.retrieve('foo'))
+        self.assertEqual(1, store.stats()['evictions']['result_ttl'])
+
+    def testRetrieveSpilledResult(self):
+        store = self._build_store()
+        store.add('foo', 'User Foo')
+        self.assertTrue(store.complete('foo', _spill(self._spool_directory, 'Profile')))
+        user_name, result = store.retrieve('foo')
+        self.assertEqual('User Foo', user_name)
+        if isinstance(result, SpilledResult):
+            result = result.read()
+        self.assertEqual('Profile', result)
+
+    def testEvictSpilledResult(self):
+        store = self._build_store(result_ttl=9)
+        store.add('foo', 'User Foo')
+        store.complete('foo', _spill(self._spool_directory, 'Profile'))
+        self._now = 9
+        store.add('bar', 'User Foo')
+        self.assertIsNone(store.retrieve('foo'))
+        self.assertEqual([], os.listdir(self._spool_directory))
+
+    def testCompleteWithUnknownProcessShouldDeleteSpilledResult(self):
+        store = self._build_store()
+        self.assertFalse(store.complete('foo', _spill(self._spool_directory, 'Profile')))
+        self.assertEqual([], os.listdir(self._spool_directory))
+
+    def testEvictOverCapacityShouldPreferResults(self):
+        store = self._build_store(max_entries=2)
+        store.add('foo', 'User Foo')
+        store.add('bar', 'User Foo')
+        store.complete('bar', 'Profile')
+        store.add('baz', 'User Foo')
+        self.assertIsNone(store.retrieve('bar'))
+        self.assertIsNotNone(store.retrieve('foo'))
+        self.assertEqual(1, store.stats()['evictions']['capacity'])
+
+    def testEvictOverByteCapacity(self):
+        store = self._build_store(max_bytes=1024)
+        store.add('foo', 'User Foo')
+        # Use a result that does not compress well.
+        store.complete('foo', base64.b64encode(os.urandom(2048)).decode('ascii'))
+        self.assertIsNone(store.retrieve('foo'))
+        self.assertEqual(0, store.stats()['bytes'])
+
+    def testStats(self):
+        store = self._build_store()
+        store.add('foo', 'User Foo')
+        store.add('bar', 'User Foo')
+        store.complete('bar', 'Profile')
+        stats = store.stats()
+        self.assertEqual(1, stats['progress'])
+        self.assertEqual(1, stats['finished'])
+        self.assertLess(0, stats['bytes'])
+
+
+class MemoryResultStoreTest(ResultStoreTestMixin, TestCase):
+    def testCompleteShouldCompressResults(self):
+        store = self._build_store()
+        store.add('foo', 'User Foo')
+        store.complete('foo', 'Profiel voor Jürgen' * 1024)
+        self.assertGreater(1024, store.stats()['bytes'])
+        self.assertEqual(('User Foo', 'Profiel voor Jürgen' * 1024),
+                         store.retrieve('foo'))
+
+    def _build_store(self, **kwargs):
+        # Use a single shard, so limits are exact.
+        return MemoryResultStore(clock=lambda: self._now, shards=1, **kwargs)
+
+    def testShards(self):
+        store = MemoryResultStore(shards=4)
+        process_ids = [str(index) for index in range(100)]
+        for process_id in process_ids:
+            store.add(process_id, 'User Foo')
+        for process_id in process_ids[::2]:
+            store.complete(process_id, 'Profile')
+        stats = store.stats()
+        self.assertEqual(50, stats['progress'])
+        self.assertEqual(50, stats['finished'])
+        for process_id in process_ids[::2]:
+            self.assertEqual(('User Foo', 'Profile'), store.retrieve(process_id))
+            self.assertIsNone(store.retrieve(process_id))
+
+    def testRetrieveShouldHandOverSpilledResults(self):
+        store = self._build_store()
+        store.add('foo', 'User Foo')
+        result = _spill(self._spool_directory, 'Profile')
+        store.complete('foo', result)
+        self.assertEqual(('User Foo', result), store.peek('foo'))
+        self.assertEqual(('User Foo', result), store.retrieve('foo'))
+        # Retrieving the process must not delete the file.
+        self.assertEqual('Profile', result.read())
+        result.delete()
+
+    def testSpilledResultsShouldNotCountTowardsBytes(self):
+        store = self._build_store(max_bytes=1)
+        store.add('foo', 'User Foo')
+        store.complete('foo', _spill(self._spool_directory, 'Profile'))
+        self.assertEqual(0, store.stats()['bytes'])
+        self.assertEqual(0, store.stats()['evictions']['capacity'])
+        result = store.retrieve('foo')[1]
+        self.assertEqual(0, store.stats()['bytes'])
+        result.delete()
+
+    def testConcurrentRetrieveShouldDeleteOnce(self):
+        store = MemoryResultStore(shards=4)
+        process_ids = [str(index) for index in range(1000)]
+        for process_id in process_ids:
+            store.add(process_id, 'User Foo')
+            store.complete(process_id, 'Profile')
+        retrieved = []
+
+        def _retrieve():
+            for process_id in process_ids:
+                if store.retrieve(process_id) is not None:
+                    retrieved.append(process_id)
+        threads = [Thread(target=_retrieve) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(process_ids), sorted(retrieved))
+
+
+class SqliteResultStoreTest(ResultStoreTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self._directory = tempfile.mkdtemp()
+        self._path = os.path.join(self._directory, 'processes.sqlite')
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self._directory)
+
+    def testCompleteShouldKeepSpilledResultsOnDisk(self):
+        store = self._build_store(max_bytes=1)
+        store.add('foo', 'User Foo')
+        result = _spill(self._spool_directory, 'Profile')
+        store.complete('foo', result)
+        self.assertEqual(0, store.stats()['bytes'])
+        self.assertEqual(result.path, store.peek('foo')[1].path)
+        self.assertEqual(result.path, store.retrieve('foo')[1].path)
+        self.assertEqual('Profile', result.read())
+        result.delete()
+
+    def testWaitForProcessEvictedByOtherServerProcess(self):
+        store_a = self._build_store()
+        store_b = self._build_store(max_entries=1)
+        store_a.add('foo', 'User Foo')
+        store_b.add('bar', 'User Foo')
+        self.assertTrue(store_a.wait('foo', 9))
+        self.assertNotIn('foo', store_a._completions)
+
+    def testWaitForProcessCompletedByOtherServerProcess(self):
+        store = self._build_store()
+        store.add('foo', 'User Foo')
+        # Complete the process from another OS process, once we are waiting.
+        completer = subprocess.Popen([sys.executable, '-c', 'import sys, time; time.sleep(0.2); from tk.store import SqliteResultStore; SqliteResultStore(sys.argv[1]).complete("foo", "Profile")', self._path],
+                                     cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+        try:
+            self.assertTrue(self._build_store().wait('foo', 9))
+        finally:
+            completer.wait()
+        self.assertEqual(('User Foo', 'Profile'), store.retrieve('foo'))
+
+    def testWaitShouldStopWatchingChanges(self):
+        store = self._build_store()
+        store.add('foo', 'User Foo')
+        self.assertFalse(store.wait('foo', 0.02))
+        self.assertEqual({}, store._watches)
+        deadline = time.monotonic() + 9
+        while store._watcher is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIsNone(store._watcher)
+
+    def testAddShouldPruneExpiredCompletions(self):
+        store_a = self._build_store(progress_ttl=9)
+        store_b = self._build_store(progress_ttl=9)
+        store_a.add('foo', 'User Foo')
+        self._now = 9
+        # Another server process evicts the process.
+        store_b.add('bar', 'User Foo')
+        store_a.add('baz', 'User Foo')
+        self.assertNotIn('foo', store_a._completions)
+
+    def _build_store(self, **kwargs):
+        return SqliteResultStore(self._path, clock=lambda: self._now,
+                                 poll_interval=0.01, **kwargs)
+
+    def testRetrieveFromOtherServerProcess(self):
+        store_a = self._build_store()
+        store_b = self._build_store()
+        store_a.add('foo', 'User Foo')
+        self.assertFalse(store_b.wait('foo', 0.02))
+        store_a.complete('foo', 'Profile')
+        self.assertTrue(store_b.wait('foo', 0.02))
+        self.assertEqual(('User Foo', 'Profile'), store_b.retrieve('foo'))
+        self.assertIsNone(store_a.retrieve('foo'))
@@ -0,0 +1,51 @@
+import os
+import re
+import time
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from tk.timing import SamplingProfiler, ServerTiming, phase
+
+
+def _busy(duration):
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        pass
+
+
+class ServerTimingTest(TestCase):
+    def testHeader(self):
+        timing = ServerTiming()
+        with timing.phase('auth'):
+            pass
+        with timing.phase('body'):
+            pass
+        with timing.phase('auth'):
+            pass
+        self.assertRegex(timing.header(), re.compile(
+            r'^auth;dur=\d+\.\d{3}, body;dur=\d+\.\d{3}, total;dur=\d+\.\d{3}$'))
+
+    def testPhaseWithoutTiming(self):
+        with phase(None, 'auth'):
+            pass
+
+
+class SamplingProfilerTest(TestCase):
+    def testProfile(self):
+        with TemporaryDirectory() as output_directory:
+            profiler = SamplingProfiler(output_directory, 1, 0.001)
+            profile = profiler.start()
+            _busy(0.1)
+            path = profiler.stop(profile, 'submit')
+            self.assertEqual(output_directory, os.path.dirname(path))
+            self.assertTrue(os.path.basename(path).endswith('.folded'))
+            with open(path) as f:
+                lines = f.read().splitlines()
+            self.assertTrue(lines)
+            for line in lines:
+                self.assertRegex(line, re.compile(r'^\S.* \d+$'))
+            self.assertTrue(any('_busy (' in line for line in lines))
+
+    def testProfileShouldSample(self):
+        profiler = SamplingProfiler('/dev/null', 0)
+        self.assertIsNone(profiler.start())
@@ -0,0 +1,36 @@
+import io
+from unittest import TestCase
+
+from werkzeug.formparser import parse_form_data
+
+from tk.upload import Document, DocumentTooLarge, MultipartEncoder, \
+    spool_document
+
+
+class SpoolDocumentTest(TestCase):
+    def testSpoolDocument(self):
+        document = spool_document(io.BytesIO(b'Foo'), 9, 1)
+        self.assertEqual(3, document.size)
+        self.assertEqual(b'Foo', document.open().read())
+
+    def testSpoolDocumentTooLarge(self):
+        with self.assertRaises(DocumentTooLarge):
+            spool_document(io.BytesIO(b'Foo'), 2, 1)
+
+
+class MultipartEncoderTest(TestCase):
+    def testRead(self):
+        body = MultipartEncoder({
+            'foo': 'Foo',
+            'bar': None,
+        }, 'baz', Document.from_bytes(b'Baz'))
+        data = b''.join(body)
+        self.assertEqual(len(body), len(data))
+        stream, form, files = parse_form_data({
+            'wsgi.input': io.BytesIO(data),
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': body.content_type,
+            'CONTENT_LENGTH': str(len(data)),
+        })
+        self.assertEqual({'foo': 'Foo'}, form.to_dict())
+        self.assertEqual(b'Baz', files['baz'].read())
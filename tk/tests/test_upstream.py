@@ -0,0 +1,145 @@
+from unittest import TestCase
+
+from tk.upstream import CircuitBreaker, RetryPolicy, UpstreamPool, \
+    UpstreamTarget
+
+
+class FakeClock:
+    def __init__(self):
+        self.time = 0
+
+    def __call__(self):
+        return self.time
+
+
+class CircuitBreakerTest(TestCase):
+    def setUp(self):
+        self._clock = FakeClock()
+        self._circuit_breaker = CircuitBreaker(failure_threshold=2,
+                                               reset_timeout=10, probes=1,
+                                               clock=self._clock)
+
+    def testRecordShouldOpenAfterConsecutiveFailures(self):
+        self._circuit_breaker.record(False)
+        self._circuit_breaker.record(True)
+        self._circuit_breaker.record(False)
+        self.assertTrue(self._circuit_breaker.allow())
+        self._circuit_breaker.record(False)
+        self.assertEqual(CircuitBreaker.OPEN, self._circuit_breaker.state)
+        self.assertFalse(self._circuit_breaker.allow())
+        self.assertEqual(1, self._circuit_breaker.stats()['rejections'])
+
+    def testAllowShouldProbeAfterResetTimeout(self):
+        self._circuit_breaker.record(False)
+        self._circuit_breaker.record(False)
+        self._clock.time = 10
+        self.assertEqual(CircuitBreaker.HALF_OPEN, self._circuit_breaker.state)
+        self.assertTrue(self._circuit_breaker.allow())
+        self.assertFalse(self._circuit_breaker.allow())
+
+    def testRecordWithSuccessfulProbeShouldClose(self):
+        self._circuit_breaker.record(False)
+        self._circuit_breaker.record(False)
+        self._clock.time = 10
+        self._circuit_breaker.allow()
+        self._circuit_breaker.record(True)
+        self.assertEqual(CircuitBreaker.CLOSED, self._circuit_breaker.state)
+
+    def testRecordWithFailedProbeShouldReopen(self):
+        self._circuit_breaker.record(False)
+        self._circuit_breaker.record(False)
+        self._clock.time = 10
+        self._circuit_breaker.allow()
+        self._circuit_breaker.record(False)
+        self.assertEqual(CircuitBreaker.OPEN, self._circuit_breaker.state)
+        self._clock.time = 19
+        self.assertFalse(self._circuit_breaker.allow())
+
+
+class RetryPolicyTest(TestCase):
+    def testRetryShouldBackOff(self):
+        retry_policy = RetryPolicy(max_retries=3, backoff=1, max_backoff=3)
+        for attempt, max_delay in enumerate((1, 2, 3)):
+            delay = retry_policy.retry(attempt)
+            self.assertLessEqual(0, delay)
+            self.assertGreaterEqual(max_delay, delay)
+        self.assertIsNone(retry_policy.retry(3))
+
+    def testRetryShouldSpendBudget(self):
+        retry_policy = RetryPolicy(budget_ratio=0.5, budget_size=1)
+        self.assertIsNotNone(retry_policy.retry(0))
+        self.assertIsNone(retry_policy.retry(0))
+        retry_policy.record_request()
+        self.assertIsNone(retry_policy.retry(0))
+        retry_policy.record_request()
+        self.assertIsNotNone(retry_policy.retry(0))
+
+
+class UpstreamPoolTest(TestCase):
+    def _build_target(self, name, max_outstanding=None):
+        return UpstreamTarget('https://%s.example.com' % name, name, None,
+                              None, max_outstanding,
+                              CircuitBreaker(failure_threshold=1), name)
+
+    def _acquire(self, pool):
+        picked = []
+        pool.acquire(picked.append)
+        return picked
+
+    def testUnnamedTargetsShouldBeNamedByPosition(self):
+        targets = [UpstreamTarget('https://%s.example.com' % name, name, None, None)
+                   for name in ('foo', 'bar')]
+        pool = UpstreamPool(targets)
+        self.assertEqual(['target-0', 'target-1'], sorted(pool.stats()))
+        # Statistics must not reveal URLs or accounts.
+        self.assertNotIn('example.com', repr(pool.stats()))
+
+    def testAcquireShouldPickLeastOutstanding(self):
+        foo, bar = self._build_target('foo'), self._build_target('bar')
+        pool = UpstreamPool([foo, bar])
+        self.assertEqual([foo], self._acquire(pool))
+        self.assertEqual([bar], self._acquire(pool))
+        self.assertEqual([foo], self._acquire(pool))
+        pool.release(bar, True)
+        self.assertEqual([bar], self._acquire(pool))
+
+    def testAcquireShouldSkipUnhealthyTargets(self):
+        foo, bar = self._build_target('foo'), self._build_target('bar')
+        pool = UpstreamPool([foo, bar])
+        self._acquire(pool)
+        pool.release(foo, False)
+        self.assertEqual([bar], self._acquire(pool))
+        self.assertEqual([bar], self._acquire(pool))
+        pool.release(bar, False)
+        pool.release(bar, False)
+        self.assertEqual([None], self._acquire(pool))
+
+    def testAcquireShouldWaitForTargetsAtTheirLimit(self):
+        foo = self._build_target('foo', 1)
+        pool = UpstreamPool([foo])
+        self.assertEqual([foo], self._acquire(pool))
+        waiting = self._acquire(pool)
+        self.assertEqual([], waiting)
+        pool.release(foo, True)
+        self.assertEqual([foo], waiting)
+
+    def testAcquireShouldFailWaitingRequestsOnceNoTargetIsHealthy(self):
+        foo = self._build_target('foo', 1)
+        pool = UpstreamPool([foo])
+        self._acquire(pool)
+        waiting = self._acquire(pool)
+        pool.release(foo, False)
+        self.assertEqual([None], waiting)
+
+    def testStats(self):
+        foo, bar = self._build_target('foo', 2), self._build_target('bar')
+        pool = UpstreamPool([foo, bar])
+        self._acquire(pool)
+        self._acquire(pool)
+        pool.release(bar, False)
+        stats = pool.stats()
+        self.assertEqual(1, stats['foo']['outstanding'])
+        self.assertEqual(2, stats['foo']['max_outstanding'])
+        self.assertEqual(1, stats['bar']['requests'])
+        self.assertEqual(1, stats['bar']['failures'])
+        self.assertEqual(CircuitBreaker.OPEN, stats['bar']['circuit']['state'])
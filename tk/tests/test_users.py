@@ -0,0 +1,66 @@
+from unittest import TestCase
+
+from tk.users import UserStore, hash_password, is_password_hash, \
+    verify_password
+
+
+class PasswordHashTest(TestCase):
+    def testHashPassword(self):
+        password_hash = hash_password('foo', 9)
+        self.assertTrue(is_password_hash(password_hash))
+        self.assertNotIn('foo', password_hash)
+
+    def testHashPasswordShouldBeSalted(self):
+        self.assertNotEqual(hash_password('foo', 9), hash_password('foo', 9))
+
+    def testVerifyPassword(self):
+        password_hash = hash_password('foo', 9)
+        self.assertTrue(verify_password('foo', password_hash))
+        self.assertFalse(verify_password('bar', password_hash))
+
+    def testVerifyPasswordWithMalformedHash(self):
+        for password_hash in ('pbkdf2_sha256$foo$Zm9v$Zm9v',
+                              'pbkdf2_sha256$9$!$Zm9v',
+                              'pbkdf2_sha256$9$Zm9v',
+                              'md5$9$Zm9v$Zm9v'):
+            self.assertFalse(verify_password('foo', password_hash))
+
+
+class UserStoreTest(TestCase):
+    def setUp(self):
+        self._users = UserStore(9)
+
+    def testVerifyWithUnknownUser(self):
+        self.assertFalse(self._users.verify('User Foo', 'foo'))
+        # Unknown users' passwords are hashed too, so they take as long to
+        # reject as known users'.
+        self.assertIsNotNone(self._users._dummy_password_hash)
+
+    def testAddShouldHashPlainTextPasswordsLazily(self):
+        self._users.add('User Foo', 'foo')
+        self.assertEqual('foo', self._users._users['User Foo'])
+        self.assertTrue(self._users.verify('User Foo', 'foo'))
+        self.assertTrue(is_password_hash(self._users._users['User Foo']))
+
+    def testVerifyWithPlainTextPassword(self):
+        self._users.add('User Foo', 'foo')
+        self.assertTrue(self._users.verify('User Foo', 'foo'))
+        self.assertFalse(self._users.verify('User Foo', 'bar'))
+
+    def testVerifyWithPasswordHash(self):
+        self._users.add('User Foo', hash_password('foo', 9))
+        self.assertTrue(self._users.verify('User Foo', 'foo'))
+        self.assertFalse(self._users.verify('User Foo', 'bar'))
+
+    def testVerifyShouldBeCached(self):
+        self._users.add('User Foo', 'foo')
+        self._users.verify('User Foo', 'foo')
+        self._users.verify('User Foo', 'foo')
+        self.assertEqual(1, self._users._verified_credentials.hits)
+
+    def testVerifyAfterPasswordChange(self):
+        self._users.add('User Foo', 'foo')
+        self.assertTrue(self._users.verify('User Foo', 'foo'))
+        self._users.add('User Foo', 'bar')
+        self.assertFalse(self._users.verify('User Foo', 'foo'))
+        self.assertTrue(self._users.verify('User Foo', 'bar'))
@@ -0,0 +1,181 @@
+import os
+import random
+import sys
+import time
+import uuid
+from collections import Counter, OrderedDict
+from threading import Lock, Thread, get_ident
+
+
+class ServerTiming:
+    """
+    Times the phases of handling a request, for a Server-Timing header.
+    """
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        # Keys are phase names, values are their total durations in seconds,
+        # in the order the phases started.
+        self._phases = OrderedDict()
+
+    def phase(self, name):
+        """
+        Times a phase. Phases with the same name are added up.
+        :param name: The phase's name, which must be an HTTP token.
+        :return: A context manager.
+        """
+        return _Phase(self, name)
+
+    def header(self):
+        """
+        Renders the timed phases, and the total time since the request
+        started.
+        :return: The Server-Timing header value.
+        """
+        phases = list(self._phases.items())
+        phases.append(('total', time.perf_counter() - self._start))
+        return ', '.join('%s;dur=%.3f' % (name, duration * 1000)
+                         for name, duration in phases)
+
+
+class _Phase:
+    def __init__(self, timing, name):
+        self._timing = timing
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, *_):
+        phases = self._timing._phases
+        phases[self._name] = phases.get(self._name, 0) + (
+            time.perf_counter() - self._start)
+
+
+class _NoPhase:
+    """
+    Times nothing, for requests that are not being timed.
+    """
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *_):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+
+
+def phase(timing, name):
+    """
+    Times a phase, if the request is being timed.
+    :param timing: The request's ServerTiming, or None.
+    :param name: The phase's name.
+    :return: A context manager.
+    """
+    return _NO_PHASE if timing is None else timing.phase(name)
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno)
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of the threads handling a fraction of all requests.
+
+    A single background thread runs while requests are being profiled. Every
+    profile is written to its own file, in the collapsed stack format that
+    flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, output_directory, sample_rate, interval=0.005):
+        """
+        :param output_directory: The directory to write profiles to.
+        :param sample_rate: The fraction of requests to profile, from 0 to 1.
+        :param interval: The number of seconds between samples.
+        """
+        self._output_directory = output_directory
+        self._sample_rate = sample_rate
+        self._interval = interval
+        # Keys are thread IDs, values are Counters of collapsed stacks.
+        self._profiles = {}
+        self._thread = None
+        self._lock = Lock()
+
+    def start(self):
+        """
+        Starts profiling the current thread, if the request is sampled.
+        :return: The profile to pass to stop(), or None if the request is not
+          sampled.
+        """
+        if random.random() >= self._sample_rate:
+            return None
+        profile = Counter()
+        with self._lock:
+            self._profiles[get_ident()] = profile
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return profile
+
+    def stop(self, profile, name):
+        """
+        Stops profiling the current thread, and writes the profile.
+        :param profile: The profile start() returned.
+        :param name: A name to include in the file name, such as the route.
+        :return: The path to the written file, or None if no stacks were
+          sampled.
+        """
+        with self._lock:
+            self._profiles.pop(get_ident(), None)
+        if not profile:
+            return None
+        os.makedirs(self._output_directory, exist_ok=True)
+        path = os.path.join(self._output_directory, '%d-%s-%s.folded' % (
+            time.time() * 1000, name, uuid.uuid4().hex[:8]))
+        with open(path, 'w') as output:
+            for stack, count in profile.most_common():
+                output.write('%s %d\n' % (stack, count))
+        return path
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._profiles:
+                    self._thread = None
+                    return
+                profiles = list(self._profiles.items())
+            frames = sys._current_frames()
+            stacks = []
+            for thread_id, profile in profiles:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame).replace(';', ':'))
+                    frame = frame.f_back
+                if stack:
+                    stacks.append((thread_id, ';'.join(reversed(stack))))
+            del frames
+            with self._lock:
+                # Skip profiles that were stopped while we sampled them.
+                for thread_id, stack in stacks:
+                    profile = self._profiles.get(thread_id)
+                    if profile is not None:
+                        profile[stack] += 1
+            time.sleep(self._interval)
+
+
+def build_sampling_profiler(config):
+    """
+    Builds the configured sampling profiler.
+    :param config: The application configuration.
+    :return: SamplingProfiler, or None if profiling is disabled.
+    """
+    if not config['PROFILER_SAMPLE_RATE'] or not config['PROFILER_OUTPUT_DIRECTORY']:
+        return None
+    return SamplingProfiler(config['PROFILER_OUTPUT_DIRECTORY'],
+                            config['PROFILER_SAMPLE_RATE'],
+                            config['PROFILER_INTERVAL'])
@@ -0,0 +1,232 @@
+import hashlib
+import io
+import tarfile
+import uuid
+import zipfile
+from tempfile import SpooledTemporaryFile
+
+CHUNK_SIZE = 64 * 1024
+
+
+class DocumentTooLarge(Exception):
+    pass
+
+
+class StreamTooLarge(Exception):
+    pass
+
+
+class LimitedStream:
+    """
+    Reads from a binary stream, up to a maximum number of bytes.
+
+    Unlike a Content-Length check, this also limits chunked request bodies.
+    """
+
+    def __init__(self, stream, max_size):
+        """
+        :param stream: The binary stream to read from.
+        :param max_size: The maximum number of bytes to read.
+        """
+        self._stream = stream
+        self._max_size = max_size
+        self._size = 0
+
+    def _count(self, chunk):
+        self._size += len(chunk)
+        if self._size > self._max_size:
+            raise StreamTooLarge()
+        return chunk
+
+    def _limit(self, size):
+        # Read at most one byte too many, to detect oversized streams without
+        # reading them entirely.
+        remaining = self._max_size - self._size + 1
+        return remaining if size is None or size < 0 else min(size, remaining)
+
+    def read(self, size=-1):
+        """
+        :raises StreamTooLarge: If the stream exceeds the maximum size.
+        """
+        return self._count(self._stream.read(self._limit(size)))
+
+    def readline(self, size=-1):
+        """
+        :raises StreamTooLarge: If the stream exceeds the maximum size.
+        """
+        return self._count(self._stream.readline(self._limit(size)))
+
+    def readable(self):
+        return True
+
+
+class Document:
+    """
+    A document to submit to Sourcebox, backed by a (spooled) file.
+    """
+
+    def __init__(self, file, size, digest):
+        """
+        :param file: A seekable binary file containing the document.
+        :param size: The document size in bytes.
+        :param digest: The hexadecimal SHA-256 digest of the document.
+        """
+        self._file = file
+        self.size = size
+        self.digest = digest
+
+    @classmethod
+    def from_bytes(cls, document):
+        return cls(io.BytesIO(document), len(document),
+                   hashlib.sha256(document).hexdigest())
+
+    def open(self):
+        """
+        Opens the document for reading from the start.
+        :return: A binary file.
+        """
+        self._file.seek(0)
+        return self._file
+
+    def close(self):
+        self._file.close()
+
+
+class DocumentSpool:
+    """
+    Copies a document in chunks, without reading it into memory at once.
+    """
+
+    def __init__(self, max_size, spool_size):
+        """
+        :param max_size: The maximum document size in bytes.
+        :param spool_size: The size in bytes above which to spool the document
+          to a temporary file instead of keeping it in memory.
+        """
+        self._file = SpooledTemporaryFile(max_size=spool_size)
+        self._max_size = max_size
+        self._size = 0
+        self._digest = hashlib.sha256()
+
+    def write(self, chunk):
+        """
+        Appends a chunk to the document.
+        :param chunk: bytes
+        :return:
+        :raises DocumentTooLarge: If the document exceeds the maximum size.
+        """
+        self._size += len(chunk)
+        if self._size > self._max_size:
+            self._file.close()
+            raise DocumentTooLarge()
+        self._digest.update(chunk)
+        self._file.write(chunk)
+
+    def finish(self):
+        """
+        Finishes copying the document.
+        :return: Document
+        """
+        return Document(self._file, self._size, self._digest.hexdigest())
+
+
+def spool_document(stream, max_size, spool_size):
+    """
+    Copies a document from a stream, without reading it into memory at once.
+    :param stream: A binary stream to read the document from.
+    :param max_size: The maximum document size in bytes.
+    :param spool_size: The size in bytes above which to spool the document to
+      a temporary file instead of keeping it in memory.
+    :return: Document
+    :raises DocumentTooLarge: If the document exceeds the maximum size.
+    """
+    spool = DocumentSpool(max_size, spool_size)
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            return spool.finish()
+        spool.write(chunk)
+
+
+def iter_tar_files(stream):
+    """
+    Iterates over the files in a (compressed) tar archive, without seeking.
+    :param stream: A binary stream to read the archive from.
+    :return: An iterable of 2-tuples (name: str, file: binary file).
+    :raises tarfile.TarError: If the archive is malformed.
+    """
+    with tarfile.open(fileobj=stream, mode='r|*') as archive:
+        for member in archive:
+            if member.isfile():
+                yield member.name, archive.extractfile(member)
+
+
+def iter_zip_files(file):
+    """
+    Iterates over the files in a zip archive.
+    :param file: A seekable binary file to read the archive from.
+    :return: An iterable of 2-tuples (name: str, file: binary file).
+    :raises zipfile.BadZipFile: If the archive is malformed.
+    """
+    with zipfile.ZipFile(file) as archive:
+        for info in archive.infolist():
+            if info.filename.endswith('/'):
+                continue
+            with archive.open(info) as member:
+                yield info.filename, member
+
+
+class MultipartEncoder:
+    """
+    Streams a multipart/form-data request body with a single file.
+
+    Instances are file-like and have a length, so requests sends them with a
+    Content-Length header and reads them in blocks, rather than building the
+    entire body in memory.
+    """
+
+    def __init__(self, fields, file_field_name, document):
+        """
+        :param fields: A dictionary of form field values, keyed by field name.
+          Fields with None values are omitted.
+        :param file_field_name: The name of the file field.
+        :param document: The Document to upload.
+        """
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % boundary
+        preamble = b''
+        for name, value in fields.items():
+            if value is None:
+                continue
+            preamble += ('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (
+                boundary, name, value)).encode('utf-8')
+        preamble += ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n\r\n' % (
+            boundary, file_field_name, file_field_name)).encode('utf-8')
+        epilogue = ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+        self._parts = (io.BytesIO(preamble), document.open(),
+                       io.BytesIO(epilogue))
+        self._part_index = 0
+        self._length = len(preamble) + document.size + len(epilogue)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length
+        chunks = []
+        while size > 0 and self._part_index < len(self._parts):
+            chunk = self._parts[self._part_index].read(size)
+            if not chunk:
+                self._part_index += 1
+                continue
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
@@ -0,0 +1,358 @@
+import random
+import time
+from collections import deque
+from threading import Lock
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to an upstream that keeps failing.
+
+    After a number of consecutive failures the circuit opens, and requests
+    fail fast. Once the reset timeout has passed, a few probe requests are let
+    through: the circuit closes again if one succeeds, and reopens if one
+    fails.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, probes=1, clock=time.monotonic):
+        """
+        :param failure_threshold: The number of consecutive failures after
+          which to open the circuit, or 0 to never open it.
+        :param reset_timeout: The number of seconds to keep the circuit open
+          for, before sending probe requests.
+        :param probes: The number of probe requests to send while half open.
+        :param clock: A callable returning the current time in seconds.
+        """
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._probes = probes
+        self._clock = clock
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened = None
+        self._probes_sent = 0
+        self._rejections = 0
+        self._lock = Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            self._update()
+            return self._state
+
+    def _update(self):
+        """
+        Half opens the circuit if it has been open long enough.
+
+        The lock must be held when calling this method.
+        :return:
+        """
+        if self._state == self.OPEN and self._clock() - self._opened >= self._reset_timeout:
+            self._state = self.HALF_OPEN
+            self._probes_sent = 0
+
+    def allow(self):
+        """
+        Checks whether a request may be sent.
+
+        Every allowed request must be followed by a call to record().
+        :return: bool
+        """
+        with self._lock:
+            self._update()
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and self._probes_sent < self._probes:
+                self._probes_sent += 1
+                return True
+            self._rejections += 1
+            return False
+
+    def record(self, success):
+        """
+        Records the outcome of a request.
+        :param success: Whether the upstream handled the request.
+        :return:
+        """
+        with self._lock:
+            if success:
+                self._state = self.CLOSED
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failure_threshold and self._failures >= self._failure_threshold:
+                self._state = self.OPEN
+                self._opened = self._clock()
+
+    def stats(self):
+        """
+        Gets the circuit's state.
+        :return: A dictionary with the 'state', the number of consecutive
+          'failures', and the number of requests rejected while the circuit was
+          not closed.
+        """
+        with self._lock:
+            self._update()
+            return {
+                'state': self._state,
+                'failures': self._failures,
+                'rejections': self._rejections,
+            }
+
+
+class RetryPolicy:
+    """
+    Decides whether and when to retry failed upstream requests.
+
+    Retries back off exponentially, with full jitter so retries from many
+    requests do not arrive at once. A retry budget limits retries to a
+    fraction of the number of requests, so an upstream outage does not
+    multiply the load on it.
+    """
+
+    def __init__(self, max_retries=2, backoff=0.25, max_backoff=5, budget_ratio=0.2, budget_size=10):
+        """
+        :param max_retries: The maximum number of times to retry a request.
+        :param backoff: The maximum number of seconds to wait before the first
+          retry. Every following retry doubles this.
+        :param max_backoff: The maximum number of seconds to wait before any
+          retry.
+        :param budget_ratio: The number of retries every request adds to the
+          budget.
+        :param budget_size: The maximum number of retries in the budget.
+        """
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._budget_ratio = budget_ratio
+        self._budget_size = budget_size
+        self._budget = budget_size
+        self._retries = 0
+        self._random = random.Random()
+        self._lock = Lock()
+
+    def record_request(self):
+        """
+        Records a new (not retried) request, which adds to the retry budget.
+        :return:
+        """
+        with self._lock:
+            self._budget = min(self._budget_size,
+                               self._budget + self._budget_ratio)
+
+    def retry(self, attempt):
+        """
+        Checks whether to retry a failed request, and spends the budget if so.
+        :param attempt: The number of times the request has been retried.
+        :return: The number of seconds to wait before retrying, or None to not
+          retry.
+        """
+        if attempt >= self._max_retries:
+            return None
+        with self._lock:
+            if self._budget < 1:
+                return None
+            self._budget -= 1
+            self._retries += 1
+            return self._random.uniform(
+                0, min(self._max_backoff, self._backoff * 2 ** attempt))
+
+    def stats(self):
+        """
+        Gets the retry statistics.
+        :return: A dictionary with the total number of 'retries', and the
+          remaining 'budget'.
+        """
+        with self._lock:
+            return {
+                'retries': self._retries,
+                'budget': self._budget,
+            }
+
+
+class UpstreamTarget:
+    """
+    A Sourcebox endpoint, and the account to send documents to it with.
+    """
+
+    def __init__(self, url, account_name, user_name, password, max_outstanding=None, circuit_breaker=None, name=None):
+        """
+        :param url: The Sourcebox URL.
+        :param account_name: The Sourcebox account name.
+        :param user_name: The Sourcebox user name.
+        :param password: The Sourcebox password.
+        :param max_outstanding: The maximum number of concurrent requests to
+          send to this target, or None for no limit other than the
+          Scheduler's.
+        :param circuit_breaker: The CircuitBreaker tracking this target's
+          health. Defaults to a CircuitBreaker with default limits.
+        :param name: The name to identify the target by in statistics.
+          Defaults to "target-N", with N the target's position in its
+          UpstreamPool, so statistics do not reveal URLs or accounts.
+        """
+        self.url = url
+        self.account_name = account_name
+        self.user_name = user_name
+        self.password = password
+        self.max_outstanding = max_outstanding
+        self.circuit_breaker = CircuitBreaker() if circuit_breaker is None else circuit_breaker
+        self.name = name
+        # These are guarded by the UpstreamPool's lock.
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+
+
+class UpstreamPool:
+    """
+    Routes upstream requests to the healthy target with the fewest outstanding
+    requests.
+
+    Health is tracked passively: every request's outcome is recorded in its
+    target's CircuitBreaker, and targets with open circuits are skipped.
+    Requests wait while all healthy targets are at their limits, and fail once
+    no target is healthy.
+    """
+
+    def __init__(self, targets):
+        """
+        :param targets: A non-empty list of UpstreamTarget instances. Ties are
+          broken in this order.
+        """
+        assert targets
+        self.targets = targets
+        for index, target in enumerate(targets):
+            if target.name is None:
+                target.name = 'target-%d' % index
+        # Callables waiting for a target with room for another request.
+        self._waiters = deque()
+        self._lock = Lock()
+
+    def acquire(self, callback):
+        """
+        Picks a target for a request.
+
+        Every picked target must be released with release().
+        :param callback: A callable that takes the picked UpstreamTarget, or
+          None if no target is healthy. If all healthy targets are at their
+          limits, this is called once one of them is released, from the
+          releasing thread.
+        :return:
+        """
+        with self._lock:
+            target, healthy = self._pick()
+            if target is None and healthy:
+                self._waiters.append(callback)
+                return
+        callback(target)
+
+    def _pick(self):
+        """
+        Picks the healthy target with the fewest outstanding requests.
+
+        The lock must be held when calling this method.
+        :return: A 2-tuple (target: Optional[UpstreamTarget], healthy: bool),
+          where healthy tells whether any target is healthy.
+        """
+        healthy = False
+        # Sorting is stable, so ties go to the first configured target.
+        for target in sorted(self.targets, key=lambda target: target.outstanding):
+            if CircuitBreaker.OPEN == target.circuit_breaker.state:
+                continue
+            healthy = True
+            if target.max_outstanding is not None and target.outstanding >= target.max_outstanding:
+                continue
+            # Half open circuits allow only a few probe requests.
+            if not target.circuit_breaker.allow():
+                continue
+            target.outstanding += 1
+            target.requests += 1
+            return target, True
+        return None, healthy
+
+    def release(self, target, success):
+        """
+        Records the outcome of a request, and starts waiting requests.
+        :param target: The UpstreamTarget the request was sent to.
+        :param success: Whether the target handled the request.
+        :return:
+        """
+        with self._lock:
+            target.outstanding -= 1
+            if not success:
+                target.failures += 1
+            target.circuit_breaker.record(success)
+            ready = []
+            while self._waiters:
+                picked, healthy = self._pick()
+                if picked is None and healthy:
+                    break
+                ready.append((self._waiters.popleft(), picked))
+        for callback, picked in ready:
+            callback(picked)
+
+    def stats(self):
+        """
+        Gets the targets' statistics.
+        :return: A dictionary keyed by target name, with every target's
+          number of 'outstanding' requests and its limit, total
+          number of 'requests' and 'failures', and CircuitBreaker.stats() as
+          'circuit'.
+        """
+        with self._lock:
+            return {
+                target.name: {
+                    'outstanding': target.outstanding,
+                    'max_outstanding': target.max_outstanding,
+                    'requests': target.requests,
+                    'failures': target.failures,
+                    'circuit': target.circuit_breaker.stats(),
+                } for target in self.targets
+            }
+
+
+def build_circuit_breaker(config):
+    """
+    Builds the configured upstream circuit breaker.
+    :param config: The application configuration.
+    :return: CircuitBreaker
+    """
+    return CircuitBreaker(config['UPSTREAM_CIRCUIT_FAILURE_THRESHOLD'],
+                          config['UPSTREAM_CIRCUIT_RESET_TIMEOUT'],
+                          config['UPSTREAM_CIRCUIT_PROBES'])
+
+
+def build_retry_policy(config):
+    """
+    Builds the configured upstream retry policy.
+    :param config: The application configuration.
+    :return: RetryPolicy
+    """
+    return RetryPolicy(config['UPSTREAM_RETRIES'],
+                       config['UPSTREAM_RETRY_BACKOFF'],
+                       config['UPSTREAM_RETRY_MAX_BACKOFF'],
+                       config['UPSTREAM_RETRY_BUDGET_RATIO'],
+                       config['UPSTREAM_RETRY_BUDGET_SIZE'])
+
+
+def build_upstream_targets(config):
+    """
+    Builds the configured Sourcebox targets.
+    :param config: The application configuration.
+    :return: A list of UpstreamTarget instances.
+    """
+    targets = config['SOURCEBOX_TARGETS'] or [{
+        'url': config['SOURCEBOX_URL'],
+        'account_name': config['SOURCEBOX_ACCOUNT_NAME'],
+        'user_name': config['SOURCEBOX_USER_NAME'],
+        'password': config['SOURCEBOX_PASSWORD'],
+    }]
+    return [UpstreamTarget(target['url'], target['account_name'],
+                           target['user_name'], target['password'],
+                           target.get('max_outstanding'),
+                           build_circuit_breaker(config), target.get('name'))
+            for target in targets]
@@ -0,0 +1,163 @@
+import base64
+import hashlib
+import hmac
+import os
+import time
+from threading import Lock
+
+from tk.cache import LruCache
+
+PASSWORD_HASH_ALGORITHM = 'pbkdf2_sha256'
+
+
+def hash_password(password, iterations=100000, salt=None):
+    """
+    Hashes a password using a salted, deliberately slow key derivation.
+    :param password: The plain-text password.
+    :param iterations: The number of PBKDF2 iterations.
+    :param salt: The salt as bytes, or None to generate a random one.
+    :return: The password hash as a str, in the format
+      "pbkdf2_sha256$iterations$salt$hash".
+    """
+    if salt is None:
+        salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt,
+                                 iterations)
+    return '$'.join((PASSWORD_HASH_ALGORITHM, str(iterations),
+                     base64.b64encode(salt).decode('ascii'),
+                     base64.b64encode(digest).decode('ascii')))
+
+
+def is_password_hash(password):
+    """
+    Checks whether a configured password is a hash produced by hash_password().
+    :param password:
+    :return: bool
+    """
+    return password.startswith(PASSWORD_HASH_ALGORITHM + '$') and 4 == len(
+        password.split('$'))
+
+
+def verify_password(password, password_hash):
+    """
+    Verifies a plain-text password against a hash.
+    :param password: The plain-text password.
+    :param password_hash: A hash produced by hash_password().
+    :return: bool. Malformed hashes verify no password.
+    """
+    try:
+        algorithm, iterations, salt, expected_digest = password_hash.split('$')
+        salt = base64.b64decode(salt)
+        expected_digest = base64.b64decode(expected_digest)
+        iterations = int(iterations)
+    # binascii.Error is a ValueError.
+    except ValueError:
+        return False
+    if PASSWORD_HASH_ALGORITHM != algorithm or iterations < 1:
+        return False
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt,
+                                 iterations)
+    return hmac.compare_digest(digest, expected_digest)
+
+
+class UserStore:
+    """
+    Stores users and their hashed passwords, indexed by user name.
+    """
+
+    def __init__(self, hash_iterations=100000, cache_size=1024, cache_ttl=300):
+        """
+        :param hash_iterations: The number of PBKDF2 iterations to hash
+          plain-text passwords with.
+        :param cache_size: The maximum number of verified credentials to
+          remember.
+        :param cache_ttl: The number of seconds to remember verified
+          credentials for.
+        """
+        self._hash_iterations = hash_iterations
+        # Keys are user names, values are password hashes, or plain-text
+        # passwords until their users first authenticate.
+        self._users = {}
+        # The hash to verify unknown users' passwords against, so they take as
+        # long to reject as known users'.
+        self._dummy_password_hash = None
+        self._lock = Lock()
+        # Keys are credential fingerprints, values are the password hashes the
+        # credentials were verified against, so that changing a user's
+        # password invalidates any cached verifications.
+        self._verified_credentials = LruCache(cache_size)
+        self._cache_ttl = cache_ttl
+        # A per-process key, so credential fingerprints cannot be used to
+        # recover passwords.
+        self._fingerprint_key = os.urandom(32)
+
+    def __contains__(self, name):
+        return name in self._users
+
+    def __len__(self):
+        return len(self._users)
+
+    def add(self, name, password):
+        """
+        Adds a user, or changes an existing user's password.
+        :param name: The user name.
+        :param password: A plain-text password, or a hash produced by
+          hash_password(). Plain-text passwords are hashed when the user first
+          authenticates, so adding many users is fast.
+        :return:
+        """
+        with self._lock:
+            self._users[name] = password
+
+    def verify(self, name, password):
+        """
+        Verifies a user's credentials.
+        :param name: The user name.
+        :param password: The plain-text password.
+        :return: bool
+        """
+        password_hash = self._password_hash(name)
+        if password_hash is None:
+            verify_password(password, self._password_hash_for_unknown_users())
+            return False
+
+        fingerprint = hmac.new(self._fingerprint_key, b'\0'.join(
+            (name.encode('utf-8'), password.encode('utf-8'))),
+            hashlib.sha256).digest()
+        if self._verified_credentials.get(fingerprint) == password_hash:
+            return True
+
+        if not verify_password(password, password_hash):
+            return False
+        self._verified_credentials.set(fingerprint, password_hash,
+                                       time.time() + self._cache_ttl)
+        return True
+
+    def _password_hash(self, name):
+        """
+        Gets a user's password hash, and hashes their plain-text password if
+        that has not been done yet.
+        :param name: The user name.
+        :return: The password hash, or None if the user does not exist.
+        """
+        password = self._users.get(name)
+        if password is None or is_password_hash(password):
+            return password
+        password_hash = hash_password(password, self._hash_iterations)
+        with self._lock:
+            if self._users.get(name) is password:
+                self._users[name] = password_hash
+                return password_hash
+        # The password was changed in the meantime.
+        return self._password_hash(name)
+
+    def _password_hash_for_unknown_users(self):
+        """
+        Gets the hash to verify unknown users' passwords against.
+        :return: str
+        """
+        if self._dummy_password_hash is None:
+            self._dummy_password_hash = hash_password(
+                base64.b64encode(os.urandom(16)).decode('ascii'),
+                self._hash_iterations)
+        return self._dummy_password_hash
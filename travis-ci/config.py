@@ -1,2 +1,4 @@
 # A secret (private) key for symmetric encryption.
 SECRET_KEY = 'I am not so secret'
+# Serve metrics, so they can be tested.
+METRICS_ENABLED = True